@@ -0,0 +1,213 @@
+"""
+Vectorized batch recommendation scorer.
+
+Loads the preference tables and the catalog links into sparse matrices and
+scores every user against every track with a few sparse products instead
+of running the three recommendation queries once per user:
+
+    artist signal = UserArtist @ ArtistTrack
+    genre signal  = UserGenre  @ GenreTrack
+    album signal  = (UserTrack @ TrackAlbum > 0) @ AlbumTrack
+
+Tracks the user already likes are excluded. Results are written to the
+UserRecommendation store (see rec_store.py).
+
+    python batch_scorer.py [--top 15] [--dry-run]
+"""
+import time
+
+import numpy as np
+from scipy import sparse
+from sqlalchemy import text
+
+import rec_store
+
+ARTIST_WEIGHT = 3.0
+ALBUM_WEIGHT = 2.0
+GENRE_WEIGHT = 1.0
+# Popularity (0-100) only breaks ties between equally scored tracks
+POPULARITY_WEIGHT = 0.001
+
+# Users scored per sparse matrix product
+USER_BLOCK = 4096
+
+
+def _index(keys):
+    return {key: i for i, key in enumerate(keys)}
+
+
+def _matrix(pairs, row_index, col_index):
+    """0/1 CSR matrix from (row key, col key) pairs; unknown keys are dropped"""
+    rows, cols = [], []
+    for row_key, col_key in pairs:
+        r = row_index.get(row_key)
+        c = col_index.get(col_key)
+        if r is not None and c is not None:
+            rows.append(r)
+            cols.append(c)
+    m = sparse.csr_matrix((np.ones(len(rows), dtype=np.float32), (rows, cols)),
+                          shape=(len(row_index), len(col_index)))
+    m.sum_duplicates()
+    m.data[:] = 1
+    return m
+
+
+class ScoringData:
+    """Catalog and preference snapshot as index maps and sparse matrices"""
+
+    def __init__(self, conn):
+        tracks = conn.execute(text("""
+            SELECT track_id, track_name, genre_name, album_id,
+                   COALESCE(track_popularity, 0)
+            FROM Track
+        """)).fetchall()
+        self.track_ids = [row[0] for row in tracks]
+        self.track_names = [row[1] for row in tracks]
+        self.popularity = np.array([row[4] for row in tracks], dtype=np.float32)
+        track_index = _index(self.track_ids)
+
+        self.artist_names = dict(conn.execute(text(
+            "SELECT artist_id::TEXT, artist_name FROM Artist")).fetchall())
+        self.album_names = dict(conn.execute(text(
+            "SELECT album_id, album_name FROM Album")).fetchall())
+        self.artist_ids = list(self.artist_names)
+        self.genres = sorted({row[2] for row in tracks})
+        self.albums = sorted({row[3] for row in tracks if row[3] is not None})
+        artist_index = _index(self.artist_ids)
+        genre_index = _index(self.genres)
+        album_index = _index(self.albums)
+
+        # Make sure every user has a state row before reading versions, so
+        # a preference change after this point always bumps the version.
+        conn.execute(text("""
+            INSERT INTO RecommendationState (user_id)
+            SELECT user_id FROM "User"
+            ON CONFLICT (user_id) DO NOTHING
+        """))
+        conn.commit()
+        self.versions = dict(conn.execute(text(
+            "SELECT user_id, pref_version FROM RecommendationState")).fetchall())
+        self.user_ids = sorted(self.versions)
+        user_index = _index(self.user_ids)
+
+        self.track_artist = _matrix(conn.execute(text(
+            "SELECT track_id, artist_id::TEXT FROM ArtistTrack")).fetchall(),
+            track_index, artist_index)
+        self.track_genre = _matrix(((row[0], row[2]) for row in tracks), track_index, genre_index)
+        self.track_album = _matrix(((row[0], row[3]) for row in tracks), track_index, album_index)
+        # Column of each track's genre / album, -1 for tracks without an album
+        self.genre_of = np.array([genre_index[row[2]] for row in tracks], dtype=np.int32)
+        self.album_of = np.array([album_index.get(row[3], -1) for row in tracks], dtype=np.int32)
+
+        self.user_track = _matrix(conn.execute(text(
+            "SELECT user_id, track_id FROM UserTrackPreference")).fetchall(),
+            user_index, track_index)
+        self.user_artist = _matrix(conn.execute(text(
+            "SELECT user_id, artist_id::TEXT FROM UserArtistPreference")).fetchall(),
+            user_index, artist_index)
+        self.user_genre = _matrix(conn.execute(text(
+            "SELECT user_id, genre_name FROM UserGenrePreference")).fetchall(),
+            user_index, genre_index)
+
+
+def score(data, top_n=15):
+    """Yield (user row, track rows, scores) for every user, best tracks first"""
+    artist_track = data.track_artist.T.tocsr()
+    genre_track = data.track_genre.T.tocsr()
+    album_track = data.track_album.T.tocsr()
+    tie_break = data.popularity * POPULARITY_WEIGHT
+
+    n_users = data.user_track.shape[0]
+    for start in range(0, n_users, USER_BLOCK):
+        stop = min(start + USER_BLOCK, n_users)
+        liked = data.user_track[start:stop]
+        liked_albums = (liked @ data.track_album).astype(bool).astype(np.float32)
+
+        signal = (ARTIST_WEIGHT * (data.user_artist[start:stop] @ artist_track)
+                  + GENRE_WEIGHT * (data.user_genre[start:stop] @ genre_track)
+                  + ALBUM_WEIGHT * (liked_albums @ album_track))
+        # Drop already-liked tracks, then add the popularity tie-break to the
+        # remaining candidates only; the matrix stays sparse throughout
+        signal = (signal - signal.multiply(liked)).tocsr()
+        signal.eliminate_zeros()
+        signal.data += tie_break[signal.indices]
+
+        for offset in range(stop - start):
+            lo, hi = signal.indptr[offset], signal.indptr[offset + 1]
+            tracks, scores = signal.indices[lo:hi], signal.data[lo:hi]
+            if hi - lo > top_n:
+                best = np.argpartition(-scores, top_n - 1)[:top_n]
+                tracks, scores = tracks[best], scores[best]
+            order = np.argsort(-scores, kind='stable')
+            yield start + offset, tracks[order], scores[order]
+
+
+def explain(data, user_row, track_rows):
+    """Recommendation dicts for one user's picks, worded as in rec_store"""
+    ptr, idx = data.user_artist.indptr, data.user_artist.indices
+    liked_artists = set(idx[ptr[user_row]:ptr[user_row + 1]].tolist())
+    ptr, idx = data.user_track.indptr, data.user_track.indices
+    source_by_album = {}
+    for liked in idx[ptr[user_row]:ptr[user_row + 1]].tolist():
+        source_by_album.setdefault(int(data.album_of[liked]), liked)
+
+    ptr, idx = data.track_artist.indptr, data.track_artist.indices
+    recommendations = []
+    for track_row in track_rows.tolist():
+        artists = [a for a in idx[ptr[track_row]:ptr[track_row + 1]].tolist() if a in liked_artists]
+        album = int(data.album_of[track_row])
+        if artists:
+            name = data.artist_names[data.artist_ids[artists[0]]]
+            reason, rec_type = f"Similar artist: {name}", 'artist'
+        elif album >= 0 and album in source_by_album:
+            album_name = data.album_names.get(data.albums[album])
+            source_name = data.track_names[source_by_album[album]]
+            reason, rec_type = f"From album '{album_name}' (you liked: {source_name})", 'album'
+        else:
+            genre = data.genres[data.genre_of[track_row]]
+            reason, rec_type = f"Same genre: {genre}", 'genre'
+        recommendations.append({
+            'track_id': data.track_ids[track_row],
+            'track_name': data.track_names[track_row],
+            'reason': reason,
+            'type': rec_type
+        })
+    return recommendations
+
+
+def run(conn, top_n=15, write=True):
+    """Score every user and (optionally) store the lists; returns stats"""
+    started = time.perf_counter()
+    data = ScoringData(conn)
+    loaded = time.perf_counter()
+
+    built = {}
+    for user_row, track_rows, _ in score(data, top_n):
+        built[data.user_ids[user_row]] = explain(data, user_row, track_rows)
+    scored = time.perf_counter()
+
+    stored = rec_store.store_many(conn, built, data.versions) if write and built else 0
+    return {
+        'users': len(data.user_ids),
+        'tracks': len(data.track_ids),
+        'stored': stored,
+        'load_seconds': loaded - started,
+        'score_seconds': scored - loaded,
+        'store_seconds': time.perf_counter() - scored,
+    }
+
+
+if __name__ == "__main__":
+    import argparse
+    from server import engine
+
+    parser = argparse.ArgumentParser(description="Score every user in one vectorized pass")
+    parser.add_argument('--top', type=int, default=15, help="recommendations kept per user")
+    parser.add_argument('--dry-run', action='store_true', help="score without writing results")
+    args = parser.parse_args()
+
+    with engine.connect() as conn:
+        stats = run(conn, top_n=args.top, write=not args.dry_run)
+    print(f"Scored {stats['users']} users x {stats['tracks']} tracks: "
+          f"load {stats['load_seconds']:.2f}s, score {stats['score_seconds']:.2f}s, "
+          f"store {stats['store_seconds']:.2f}s ({stats['stored']} users written)")
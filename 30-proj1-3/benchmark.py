@@ -0,0 +1,463 @@
+"""
+End-to-end benchmark for the Flask routes against a local database.
+
+    # create the schema in a local Postgres and load the CSVs, scaled 10x
+    python benchmark.py seed --url postgresql://localhost/musicbench --scale 10 --reset
+
+    # start the server on that database and drive every route for 30s
+    python benchmark.py run --url postgresql://localhost/musicbench --start-server \
+        --concurrency 16 --duration 30 --output results.json
+
+    # compare two result files; exits 1 if any route's p95 regressed
+    python benchmark.py compare before.json after.json --threshold 10
+
+seed builds the tables from sql.txt (in foreign-key order), applies the
+migrations, synthesizes an Artist table from ArtistTrack.csv/track.csv (no
+artist export is checked in), bulk loads the CSVs with loader.py and gives
+every user random track/artist/genre preferences. --scale N clones the
+catalog and users N-1 extra times with suffixed ids.
+
+run logs each worker in as a seeded user and cycles through the routes,
+recording per-route throughput and p50/p95/p99 latency as JSON.
+"""
+import argparse
+import csv
+import http.client
+import json
+import os
+import random
+import re
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.parse
+from collections import defaultdict
+from datetime import datetime, timezone
+
+from sqlalchemy import create_engine, text
+
+import loader
+import migrate
+import top_tracks
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+SCHEMA_FILE = os.path.join(HERE, 'sql.txt')
+
+NATIONS = ["US", "UK", "KR", "JP", "FR", "DE", "SE", "BR", "CA", "AU"]
+
+
+# -- seeding ------------------------------------------------------------------
+
+def schema_statements():
+    """CREATE TABLE statements from sql.txt, parents before children"""
+    with open(SCHEMA_FILE, encoding='utf-8') as f:
+        statements = [s.strip() for s in f.read().split(';') if s.strip()]
+
+    tables = {}
+    for statement in statements:
+        name = re.search(r'CREATE TABLE\s+("?\w+"?)', statement).group(1).strip('"').lower()
+        refs = {ref.strip('"').lower() for ref in re.findall(r'REFERENCES\s+("?\w+"?)', statement)}
+        tables[name] = (statement, refs - {name})
+
+    ordered, done = [], set()
+
+    def visit(name):
+        if name in done:
+            return
+        done.add(name)
+        for ref in tables[name][1]:
+            visit(ref)
+        ordered.append(tables[name][0])
+
+    for name in tables:
+        visit(name)
+    return ordered, list(tables)
+
+
+def create_schema(conn, reset=False):
+    statements, tables = schema_statements()
+    if reset:
+        quoted = ", ".join(f'"{name}"' if name == 'user' else name for name in tables)
+        conn.execute(text(f"DROP TABLE IF EXISTS {quoted}, schema_migrations CASCADE"))
+    for statement in statements:
+        conn.execute(text(statement.replace("CREATE TABLE", "CREATE TABLE IF NOT EXISTS", 1)))
+    conn.commit()
+
+
+def write_artist_csv(data_dir, path):
+    """Artist rows for every artist in ArtistTrack.csv, named after track_artist"""
+    tracks = {}
+    with open(os.path.join(data_dir, 'track.csv'), encoding='utf-8-sig', newline='') as f:
+        for row in csv.DictReader(f):
+            tracks[row['track_id']] = row
+
+    artists = {}
+    with open(os.path.join(data_dir, 'ArtistTrack.csv'), encoding='utf-8-sig', newline='') as f:
+        for row in csv.DictReader(f):
+            track = tracks.get(row['track_id'])
+            if track and row['artist_id'] not in artists:
+                artists[row['artist_id']] = track
+
+    rng = random.Random(4111)
+    with open(path, 'w', encoding='utf-8', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(['artist_id', 'artist_name', 'artist_nation', 'artist_tag',
+                         'artist_popularity_score'])
+        for artist_id, track in artists.items():
+            writer.writerow([artist_id, track['track_artist'][:100], rng.choice(NATIONS),
+                             track['genre_name'], track['track_popularity'] or 0])
+    return len(artists)
+
+
+def scale_catalog(conn, factor):
+    """Clone catalog rows and users factor-1 times with suffixed ids"""
+    if factor <= 1:
+        return
+    params = {"copies": factor - 1}
+    conn.execute(text("""
+        INSERT INTO Album (album_id, album_name, album_release_date)
+        SELECT album_id || '_' || k, album_name || ' #' || k, album_release_date
+        FROM Album, generate_series(1, :copies) k
+    """), params)
+    conn.execute(text("""
+        INSERT INTO Artist (artist_id, artist_name, artist_nation, artist_tag, artist_popularity_score)
+        SELECT md5(artist_id::TEXT || k)::UUID, LEFT(artist_name || ' #' || k, 100),
+               artist_nation, artist_tag, artist_popularity_score
+        FROM Artist, generate_series(1, :copies) k
+    """), params)
+    conn.execute(text("""
+        INSERT INTO Track (track_id, track_name, track_artist, genre_name, track_popularity, album_id)
+        SELECT track_id || '_' || k, track_name || ' #' || k, track_artist, genre_name,
+               track_popularity, album_id || '_' || k
+        FROM Track, generate_series(1, :copies) k
+    """), params)
+    conn.execute(text("""
+        INSERT INTO ArtistTrack (artist_id, track_id)
+        SELECT md5(artist_id::TEXT || k)::UUID, track_id || '_' || k
+        FROM ArtistTrack, generate_series(1, :copies) k
+    """), params)
+    conn.execute(text("""
+        INSERT INTO "User" (user_id, user_name, user_email, registration_date)
+        SELECT user_id + k * 1000000, user_name || '_' || k, k || '_' || user_email, registration_date
+        FROM "User", generate_series(1, :copies) k
+    """), params)
+    conn.commit()
+
+
+def seed_preferences(conn, tracks=5, artists=2, genres=2):
+    rng = random.Random(4111)
+    track_ids = conn.execute(text("SELECT track_id FROM Track")).scalars().all()
+    artist_ids = conn.execute(text("SELECT artist_id FROM Artist")).scalars().all()
+    genre_names = conn.execute(text("SELECT genre_name FROM Genre")).scalars().all()
+    user_ids = conn.execute(text('SELECT user_id FROM "User"')).scalars().all()
+
+    for table, column, pool, count in (
+            ("UserTrackPreference", "track_id", track_ids, tracks),
+            ("UserArtistPreference", "artist_id", artist_ids, artists),
+            ("UserGenrePreference", "genre_name", genre_names, genres)):
+        rows = [{"user_id": user_id, "item": item}
+                for user_id in user_ids
+                for item in rng.sample(pool, min(count, len(pool)))]
+        if rows:
+            conn.execute(text(f"""
+                INSERT INTO {table} (user_id, {column}) VALUES (:user_id, :item)
+                ON CONFLICT DO NOTHING
+            """), rows)
+    conn.commit()
+
+
+def seed(url, scale=1, reset=False, data_dir=loader.DATA_DIR):
+    engine = create_engine(url)
+    with engine.connect() as conn:
+        create_schema(conn, reset)
+        try:
+            for name in migrate.migrate(conn):
+                print(f"applied {name}")
+        except Exception as e:
+            conn.rollback()
+            print(f"Migration error (continuing without it): {str(e).splitlines()[0]}")
+
+    with tempfile.TemporaryDirectory() as tmp:
+        artist_csv = os.path.join(tmp, 'Artists_data.csv')
+        print(f"synthesized {write_artist_csv(data_dir, artist_csv)} artists")
+        loader.LEVELS[0][2].files = [artist_csv]
+        for stats in loader.load_all(engine, data_dir):
+            print(f"loaded {stats['table']:<16} {stats['inserted']:>8} rows")
+
+    with engine.connect() as conn:
+        scale_catalog(conn, scale)
+        seed_preferences(conn)
+        top_tracks.refresh(conn, full=True)
+        for table in ("Album", "Artist", "Track", "ArtistTrack", '"User"',
+                      "UserTrackPreference", "UserArtistPreference", "UserGenrePreference"):
+            conn.execute(text(f"ANALYZE {table}"))
+        conn.commit()
+        counts = {table: conn.execute(text(f"SELECT COUNT(*) FROM {table}")).scalar()
+                  for table in ("Track", "Artist", "Album", '"User"')}
+    print("seeded " + ", ".join(f"{table.strip(chr(34))}={count}" for table, count in counts.items()))
+
+
+# -- load generation ----------------------------------------------------------
+
+class Samples:
+    """Ids and terms the workers draw request parameters from"""
+
+    def __init__(self, url, size=500):
+        engine = create_engine(url)
+        with engine.connect() as conn:
+            self.emails = conn.execute(text(
+                'SELECT user_email FROM "User" ORDER BY random() LIMIT :n'), {"n": size}).scalars().all()
+            self.tracks = conn.execute(text(
+                "SELECT track_id FROM Track ORDER BY random() LIMIT :n"), {"n": size}).scalars().all()
+            self.artists = [str(a) for a in conn.execute(text(
+                "SELECT artist_id FROM Artist ORDER BY random() LIMIT :n"), {"n": size}).scalars()]
+            self.genres = conn.execute(text("SELECT genre_name FROM Genre")).scalars().all()
+            names = conn.execute(text(
+                "SELECT track_name FROM Track ORDER BY random() LIMIT :n"), {"n": size}).scalars().all()
+        engine.dispose()
+        words = [w for name in names for w in re.findall(r"\w{3,}", name)]
+        self.terms = words or ["love"]
+
+
+ROUTES = {
+    'index': lambda s, r: ('GET', '/', None),
+    'search': lambda s, r: ('GET', '/search?' + urllib.parse.urlencode({'q': r.choice(s.terms)}), None),
+    'recommendations': lambda s, r: ('GET', '/recommendations', None),
+    'preferences': lambda s, r: ('GET', '/preferences', None),
+    'preferences_add': lambda s, r: ('POST', '/preferences',
+                                     {'item_id': r.choice(s.tracks), 'type': 'track'}),
+    'track': lambda s, r: ('GET', '/track/' + urllib.parse.quote(r.choice(s.tracks)), None),
+    'artist': lambda s, r: ('GET', '/artist/' + r.choice(s.artists), None),
+    'genre': lambda s, r: ('GET', '/genre/' + urllib.parse.quote(r.choice(s.genres)), None),
+}
+
+
+class Worker(threading.Thread):
+    def __init__(self, host, port, samples, routes, deadline, warmup_until, seed):
+        super().__init__(daemon=True)
+        self.host, self.port = host, port
+        self.samples = samples
+        self.routes = routes
+        self.deadline = deadline
+        self.warmup_until = warmup_until
+        self.rng = random.Random(seed)
+        self.latencies = defaultdict(list)
+        self.errors = defaultdict(int)
+        self.cookie = None
+        self.conn = None
+
+    def request(self, method, path, form=None):
+        if self.conn is None:
+            self.conn = http.client.HTTPConnection(self.host, self.port, timeout=30)
+        headers = {'Cookie': self.cookie} if self.cookie else {}
+        body = None
+        if form is not None:
+            body = urllib.parse.urlencode(form)
+            headers['Content-Type'] = 'application/x-www-form-urlencoded'
+        try:
+            self.conn.request(method, path, body=body, headers=headers)
+            resp = self.conn.getresponse()
+            resp.read()
+        except (OSError, http.client.HTTPException):
+            self.conn.close()
+            self.conn = None
+            raise
+        cookie = resp.getheader('Set-Cookie')
+        if cookie:
+            self.cookie = cookie.split(';', 1)[0]
+        return resp.status
+
+    def run(self):
+        email = self.rng.choice(self.samples.emails)
+        self.request('POST', '/', {'email': email, 'name': email.split('@')[0]})
+
+        names = list(self.routes)
+        i = self.rng.randrange(len(names))
+        while True:
+            now = time.perf_counter()
+            if now >= self.deadline:
+                break
+            name = names[i % len(names)]
+            i += 1
+            method, path, form = ROUTES[name](self.samples, self.rng)
+            started = time.perf_counter()
+            try:
+                status = self.request(method, path, form)
+                failed = status >= 500
+            except (OSError, http.client.HTTPException):
+                failed = True
+            elapsed = time.perf_counter() - started
+            if started < self.warmup_until:
+                continue
+            if failed:
+                self.errors[name] += 1
+            else:
+                self.latencies[name].append(elapsed)
+
+
+def percentile(ordered, q):
+    if not ordered:
+        return None
+    rank = max(0, min(len(ordered) - 1, int(round(q / 100 * len(ordered) + 0.5)) - 1))
+    return ordered[rank]
+
+
+def summarize(latencies, errors, seconds):
+    ordered = sorted(latencies)
+    ms = lambda value: round(value * 1000, 3) if value is not None else None
+    return {
+        "requests": len(ordered),
+        "errors": errors,
+        "throughput_rps": round(len(ordered) / seconds, 2) if seconds else 0.0,
+        "mean_ms": ms(sum(ordered) / len(ordered)) if ordered else None,
+        "p50_ms": ms(percentile(ordered, 50)),
+        "p95_ms": ms(percentile(ordered, 95)),
+        "p99_ms": ms(percentile(ordered, 99)),
+        "max_ms": ms(ordered[-1]) if ordered else None,
+    }
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=HERE,
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def start_server(url, port):
+    env = dict(os.environ, DATABASE_URL=url)
+    proc = subprocess.Popen(
+        [sys.executable, '-c',
+         f"import server; server.app.run(host='127.0.0.1', port={port}, threaded=True)"],
+        cwd=HERE, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    for _ in range(100):
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=0.2).close()
+            return proc
+        except OSError:
+            time.sleep(0.1)
+    proc.terminate()
+    raise RuntimeError(f"server did not start on port {port}")
+
+
+def run(url, base_url, routes, concurrency=8, duration=30.0, warmup=2.0, start=False):
+    parsed = urllib.parse.urlparse(base_url)
+    host, port = parsed.hostname, parsed.port or 80
+    samples = Samples(url)
+
+    proc = start_server(url, port) if start else None
+    try:
+        begin = time.perf_counter()
+        warmup_until = begin + warmup
+        deadline = warmup_until + duration
+        workers = [Worker(host, port, samples, routes, deadline, warmup_until, seed)
+                   for seed in range(concurrency)]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+    finally:
+        if proc:
+            proc.terminate()
+            proc.wait()
+
+    per_route = {}
+    all_latencies, all_errors = [], 0
+    for name in routes:
+        latencies = [v for w in workers for v in w.latencies[name]]
+        errors = sum(w.errors[name] for w in workers)
+        per_route[name] = summarize(latencies, errors, duration)
+        all_latencies.extend(latencies)
+        all_errors += errors
+
+    return {
+        "meta": {
+            "commit": git_commit(),
+            "timestamp": datetime.now(timezone.utc).isoformat(timespec='seconds'),
+            "base_url": base_url,
+            "concurrency": concurrency,
+            "duration_s": duration,
+            "warmup_s": warmup,
+        },
+        "total": summarize(all_latencies, all_errors, duration),
+        "routes": per_route,
+    }
+
+
+def compare(before, after, threshold):
+    """Print per-route deltas; returns the routes whose p95 regressed"""
+    regressed = []
+    print(f"{'route':<18}{'p50 ms':>20}{'p95 ms':>20}{'p99 ms':>20}{'rps':>20}")
+    for name in sorted(set(before['routes']) | set(after['routes'])):
+        old, new = before['routes'].get(name), after['routes'].get(name)
+        if not old or not new:
+            print(f"{name:<18} only in {'after' if new else 'before'}")
+            continue
+        cells = []
+        for key in ('p50_ms', 'p95_ms', 'p99_ms', 'throughput_rps'):
+            a, b = old.get(key), new.get(key)
+            change = f"{(b - a) / a * 100:+.1f}%" if a and b is not None else "n/a"
+            cells.append(f"{b} ({change})".rjust(20))
+        print(f"{name:<18}" + "".join(cells))
+        if old.get('p95_ms') and new.get('p95_ms') and \
+                (new['p95_ms'] - old['p95_ms']) / old['p95_ms'] * 100 > threshold:
+            regressed.append(name)
+    return regressed
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Seed a local database and benchmark the routes")
+    sub = parser.add_subparsers(dest='command', required=True)
+
+    p = sub.add_parser('seed', help="create and load a local benchmark database")
+    p.add_argument('--url', required=True, help="local database URL")
+    p.add_argument('--scale', type=int, default=1, help="catalog/user multiplier, e.g. 10 or 100")
+    p.add_argument('--reset', action='store_true', help="drop existing tables first")
+
+    p = sub.add_parser('run', help="drive the routes and report latency")
+    p.add_argument('--url', required=True, help="database the server uses (for sample ids)")
+    p.add_argument('--base-url', default='http://127.0.0.1:8111')
+    p.add_argument('--start-server', action='store_true', help="launch server.py against --url")
+    p.add_argument('--routes', default=",".join(ROUTES), help="comma separated subset of: " + ", ".join(ROUTES))
+    p.add_argument('--concurrency', type=int, default=8)
+    p.add_argument('--duration', type=float, default=30.0, help="measured seconds")
+    p.add_argument('--warmup', type=float, default=2.0, help="unmeasured seconds first")
+    p.add_argument('--output', help="write JSON here instead of stdout")
+
+    p = sub.add_parser('compare', help="compare two result files")
+    p.add_argument('before')
+    p.add_argument('after')
+    p.add_argument('--threshold', type=float, default=10.0, help="allowed p95 increase, percent")
+
+    args = parser.parse_args()
+
+    if args.command == 'seed':
+        seed(args.url, args.scale, args.reset)
+
+    elif args.command == 'run':
+        routes = [name.strip() for name in args.routes.split(',') if name.strip()]
+        unknown = [name for name in routes if name not in ROUTES]
+        if unknown:
+            parser.error("unknown route(s): " + ", ".join(unknown))
+        result = run(args.url, args.base_url, routes, args.concurrency, args.duration,
+                     args.warmup, args.start_server)
+        output = json.dumps(result, indent=2)
+        if args.output:
+            with open(args.output, 'w') as f:
+                f.write(output + "\n")
+        else:
+            print(output)
+
+    else:
+        with open(args.before) as f:
+            before = json.load(f)
+        with open(args.after) as f:
+            after = json.load(f)
+        regressed = compare(before, after, args.threshold)
+        if regressed:
+            print("p95 regressed: " + ", ".join(regressed))
+            sys.exit(1)
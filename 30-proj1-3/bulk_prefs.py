@@ -0,0 +1,160 @@
+"""
+Set-based bulk add/remove of a user's track, artist and genre preferences.
+
+A request carries any mix of items; they are grouped by type and each group
+is applied with one statement over an array parameter (unnest for inserts,
+= ANY for deletes), so a whole library import is at most six statements,
+one mark_dirty and one commit, however many items it holds.
+
+Every item gets an outcome:
+
+    add:    added | already_present | unknown_item | invalid | duplicate
+    remove: removed | not_present | invalid | duplicate
+
+An item repeated within one list is applied once: its first occurrence
+gets the outcome above and every later one "duplicate". Removals are
+applied before additions, so an item listed in both ends up present.
+"""
+import os
+import uuid
+
+from sqlalchemy import text
+
+import profiles
+import rec_store
+
+MAX_ITEMS = int(os.environ.get("BULK_PREFERENCE_MAX_ITEMS", 5000))
+
+
+class BulkRequestError(ValueError):
+    pass
+
+
+class PreferenceKind:
+    def __init__(self, table, column, parent, name, sql_type):
+        self.table = table
+        self.column = column
+        self.sql_type = sql_type
+        # Only ids that exist in the parent table are inserted; the LEFT JOIN
+        # tells newly added ids from ones the user already had
+        self.add = text(f"""
+            WITH req AS (
+                SELECT DISTINCT unnest(CAST(:ids AS {sql_type}[])) AS id
+            ),
+            known AS (
+                SELECT p.{column} AS id, p.{name} AS name
+                FROM {parent} p JOIN req ON p.{column} = req.id
+            ),
+            ins AS (
+                INSERT INTO {table} (user_id, {column})
+                SELECT :user_id, id FROM known
+                ON CONFLICT DO NOTHING
+                RETURNING {column} AS id
+            )
+            SELECT known.id, known.name, ins.id IS NOT NULL AS added
+            FROM known LEFT JOIN ins ON ins.id = known.id
+        """)
+        self.remove = text(f"""
+            DELETE FROM {table}
+            WHERE user_id = :user_id AND {column} = ANY(CAST(:ids AS {sql_type}[]))
+            RETURNING {column} AS id
+        """)
+
+    def normalize(self, item_id):
+        """Canonical string form of an id, or None if it cannot be one"""
+        if not isinstance(item_id, str) or not item_id.strip():
+            return None
+        if self.sql_type == "UUID":
+            try:
+                return str(uuid.UUID(item_id))
+            except ValueError:
+                return None
+        return item_id
+
+
+KINDS = {
+    "track": PreferenceKind("UserTrackPreference", "track_id", "Track", "track_name", "VARCHAR"),
+    "artist": PreferenceKind("UserArtistPreference", "artist_id", "Artist", "artist_name", "UUID"),
+    "genre": PreferenceKind("UserGenrePreference", "genre_name", "Genre", "genre_name", "VARCHAR"),
+}
+
+
+def _parse(items, op):
+    """[(outcome dict, kind name or None, normalized id)] for one list"""
+    if items is None:
+        return []
+    if not isinstance(items, list):
+        raise BulkRequestError(f'"{op}" must be a list of {{"type", "id"}} objects')
+    parsed, seen = [], set()
+    for item in items:
+        item = item if isinstance(item, dict) else {}
+        pref_type, item_id = item.get("type"), item.get("id")
+        outcome = {"op": op, "type": pref_type, "id": item_id}
+        kind = KINDS.get(pref_type)
+        key = kind.normalize(item_id) if kind else None
+        if key is None:
+            outcome["status"] = "invalid"
+            parsed.append((outcome, None, None))
+        elif (pref_type, key) in seen:
+            outcome["status"] = "duplicate"
+            parsed.append((outcome, None, None))
+        else:
+            seen.add((pref_type, key))
+            parsed.append((outcome, pref_type, key))
+    return parsed
+
+
+def _ids_by_kind(parsed):
+    grouped = {}
+    for _, pref_type, key in parsed:
+        if pref_type is not None:
+            grouped.setdefault(pref_type, set()).add(key)
+    return grouped
+
+
+def apply(conn, user_id, add=None, remove=None):
+    """Apply one bulk request in a single transaction; returns the outcomes.
+
+    Outcomes are in request order, removals first. Raises BulkRequestError
+    for a malformed request, before touching the database.
+    """
+    removals = _parse(remove, "remove")
+    additions = _parse(add, "add")
+    if len(removals) + len(additions) > MAX_ITEMS:
+        raise BulkRequestError(f"at most {MAX_ITEMS} items per request")
+
+    try:
+        removed = {}
+        for pref_type, ids in _ids_by_kind(removals).items():
+            rows = conn.execute(KINDS[pref_type].remove, {"user_id": user_id, "ids": sorted(ids)})
+            removed[pref_type] = {str(row.id) for row in rows}
+
+        added, names = {}, []
+        for pref_type, ids in _ids_by_kind(additions).items():
+            rows = conn.execute(KINDS[pref_type].add, {"user_id": user_id, "ids": sorted(ids)}).fetchall()
+            added[pref_type] = {str(row.id): row.added for row in rows}
+            names += [(pref_type, str(row.id), row.name) for row in rows if row.added]
+
+        version = None
+        if removals or additions:
+            version = rec_store.mark_dirty(conn, user_id)
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+
+    if version is not None:
+        profiles.apply(user_id, version, added=names,
+                       removed=[(pref_type, item_id) for pref_type, ids in removed.items() for item_id in ids])
+
+    for outcome, pref_type, key in removals:
+        if pref_type is not None:
+            outcome["status"] = "removed" if key in removed[pref_type] else "not_present"
+    for outcome, pref_type, key in additions:
+        if pref_type is not None:
+            known = added[pref_type]
+            if key not in known:
+                outcome["status"] = "unknown_item"
+            else:
+                outcome["status"] = "added" if known[key] else "already_present"
+    return [outcome for outcome, _, _ in removals + additions]
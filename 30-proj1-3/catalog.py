@@ -0,0 +1,185 @@
+"""
+Read-only in-memory snapshot of the catalog: Track (with its artist and
+album), Artist and Genre rows, in the shape the detail routes render.
+
+prefork.py loads it in the master before forking, so every worker process
+shares one copy of these pages copy-on-write. Rows are kept as plain
+tuples in dicts keyed by id, which keeps the snapshot small and means
+lookups never write to the shared objects beyond reference counts.
+
+The detail routes look a row up here first and fall back to SQL on a miss
+(a row added since the snapshot) or when no snapshot is loaded, as under
+the development server. Each row carries the same xmin row_version as the
+detail queries, so ETags agree whichever path served the row. A reload
+(SIGHUP to the prefork master, or every WEB_RELOAD_INTERVAL seconds when
+that is set) replaces the snapshot.
+
+A snapshot is only trusted for MAX_AGE seconds; after that every lookup
+misses and the routes read the live rows, so an edit made behind the
+server's back (and its new ETag) shows up within that time even without
+a reload. /cache/invalidate marks rows, kinds or the whole snapshot
+stale the same way, in every prefork worker. Stale rows are only recorded, never
+deleted, so the shared pages stay untouched.
+
+    CATALOG_MAX_AGE     seconds a snapshot is served (default 900)
+
+    python catalog.py [--url URL]
+"""
+import argparse
+import os
+import threading
+import time
+import tracemalloc
+import uuid
+
+from sqlalchemy import create_engine, text
+
+MAX_AGE = float(os.environ.get("CATALOG_MAX_AGE", 900))
+
+# One row per track; a track with several artists is shown with the first
+TRACKS_QUERY = text("""
+    SELECT DISTINCT ON (t.track_id)
+        t.track_id,
+        t.track_name,
+        t.track_popularity,
+        t.genre_name,
+        a.artist_id::TEXT AS artist_id,
+        a.artist_name,
+        al.album_name,
+        concat_ws(':', t.xmin, a.xmin, al.xmin) AS row_version
+    FROM Track t
+    JOIN ArtistTrack at ON t.track_id = at.track_id
+    JOIN Artist a ON at.artist_id = a.artist_id
+    LEFT JOIN Album al ON t.album_id = al.album_id
+    ORDER BY t.track_id, a.artist_id
+""")
+
+ARTISTS_QUERY = text("""
+    SELECT
+        artist_id::TEXT AS id,
+        artist_name AS name,
+        artist_nation AS nation,
+        artist_popularity_score AS popularity,
+        artist_tag AS tags,
+        xmin::TEXT AS row_version
+    FROM Artist
+""")
+
+GENRES_QUERY = text("""
+    SELECT *, xmin::TEXT AS row_version FROM Genre
+""")
+
+
+class Table:
+    """Rows of one query as tuples keyed by one of its columns"""
+
+    def __init__(self, result, key):
+        self.columns = tuple(result.keys())
+        position = self.columns.index(key)
+        self.rows = {row[position]: tuple(row) for row in result}
+
+    def __len__(self):
+        return len(self.rows)
+
+    def get(self, key):
+        row = self.rows.get(key)
+        return None if row is None else dict(zip(self.columns, row))
+
+
+class Catalog:
+    def __init__(self, max_age=MAX_AGE):
+        self.max_age = max_age
+        self._lock = threading.Lock()
+        self.tracks = self.artists = self.genres = None
+        self.loaded_at = None
+        self._expired = False
+        self._stale_kinds = set()
+        self._stale_rows = set()        # (kind, key) changed since the load
+
+    @property
+    def loaded(self):
+        return self.loaded_at is not None
+
+    @property
+    def current(self):
+        """Loaded, not invalidated as a whole and younger than max_age"""
+        return (self.loaded and not self._expired
+                and time.time() - self.loaded_at <= self.max_age)
+
+    def load(self, conn):
+        tracks = Table(conn.execute(TRACKS_QUERY), "track_id")
+        artists = Table(conn.execute(ARTISTS_QUERY), "id")
+        genres = Table(conn.execute(GENRES_QUERY), "genre_name")
+        with self._lock:
+            self.tracks, self.artists, self.genres = tracks, artists, genres
+            self.loaded_at = time.time()
+            self._expired = False
+            self._stale_kinds, self._stale_rows = set(), set()
+
+    def invalidate(self, kind=None, key=None):
+        """Stop serving one row, one kind, or (no arguments) everything"""
+        with self._lock:
+            if kind is None:
+                self._expired = True
+            elif key is None:
+                self._stale_kinds.add(kind)
+            else:
+                if kind == "artist":
+                    try:
+                        key = str(uuid.UUID(str(key)))
+                    except ValueError:
+                        return
+                self._stale_rows.add((kind, key))
+
+    def _get(self, kind, table, key):
+        if not self.current or kind in self._stale_kinds or (kind, key) in self._stale_rows:
+            return None
+        return table.get(key)
+
+    def track(self, track_id):
+        """Track detail row, or None when not in a current snapshot"""
+        return self._get("track", self.tracks, track_id)
+
+    def artist(self, artist_id):
+        """Artist detail row, or None; raises ValueError for a malformed id"""
+        if not self.current:
+            return None
+        return self._get("artist", self.artists, str(uuid.UUID(str(artist_id))))
+
+    def genre(self, genre_name):
+        return self._get("genre", self.genres, genre_name)
+
+    def stats(self):
+        if not self.loaded:
+            return {"loaded": False}
+        return {
+            "loaded": True,
+            "current": self.current,
+            "tracks": len(self.tracks),
+            "artists": len(self.artists),
+            "genres": len(self.genres),
+            "stale_rows": len(self._stale_rows),
+            "age_seconds": round(time.time() - self.loaded_at, 1),
+        }
+
+
+snapshot = Catalog()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Load the catalog snapshot and report its size")
+    parser.add_argument("--url", help="database URL (defaults to the server's)")
+    args = parser.parse_args()
+
+    if args.url:
+        engine = create_engine(args.url)
+    else:
+        from server import engine
+
+    tracemalloc.start()
+    started = time.perf_counter()
+    with engine.connect() as conn:
+        snapshot.load(conn)
+    elapsed = time.perf_counter() - started
+    size, _ = tracemalloc.get_traced_memory()
+    print(f"Loaded in {elapsed:.3f}s, {size / 2 ** 20:.1f} MiB: {snapshot.stats()}")
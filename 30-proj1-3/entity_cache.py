@@ -0,0 +1,118 @@
+"""
+Read-through LRU/TTL cache for the track, artist and genre detail pages.
+
+Catalog rows almost never change, so the detail routes keep the result of
+their joins here keyed by track_id / artist_id / genre_name. Entries expire
+after DETAIL_CACHE_TTL seconds and the least recently used entry is evicted
+once a cache holds DETAIL_CACHE_SIZE keys. The loader calls invalidate()
+(directly, or through the server's /cache/invalidate route) after a reload.
+"""
+import os
+import threading
+import time
+from collections import OrderedDict
+
+DEFAULT_SIZE = int(os.environ.get("DETAIL_CACHE_SIZE", 1024))
+DEFAULT_TTL = float(os.environ.get("DETAIL_CACHE_TTL", 600))
+FRAGMENT_CACHE_SIZE = int(os.environ.get("FRAGMENT_CACHE_SIZE", 4096))
+PROFILE_CACHE_SIZE = int(os.environ.get("PROFILE_CACHE_SIZE", 10000))
+
+
+class EntityCache:
+    """Bounded mapping with LRU eviction, per-entry expiry and counters"""
+
+    def __init__(self, name, maxsize=DEFAULT_SIZE, ttl=DEFAULT_TTL):
+        self.name = name
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()   # key -> (expires_at, value)
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key, default=None):
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                if entry[0] > now:
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return entry[1]
+                del self._entries[key]
+                self.expirations += 1
+            self.misses += 1
+            return default
+
+    def put(self, key, value):
+        with self._lock:
+            self._entries[key] = (time.monotonic() + self.ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def get_or_load(self, key, loader):
+        """Cached value for `key`, calling loader() and storing it on a miss.
+
+        The loader runs outside the lock, so two concurrent misses for the
+        same key may both query the database; the later put wins.
+        """
+        marker = _MISSING
+        value = self.get(key, marker)
+        if value is marker:
+            value = loader()
+            self.put(key, value)
+        return value
+
+    def invalidate(self, key=None):
+        """Drop one key, or everything when key is None"""
+        with self._lock:
+            if key is None:
+                self._entries.clear()
+            else:
+                self._entries.pop(key, None)
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "size": len(self._entries),
+                "maxsize": self.maxsize,
+                "ttl": self.ttl,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_ratio": round(self.hits / lookups, 4) if lookups else 0.0,
+                "evictions": self.evictions,
+                "expirations": self.expirations,
+            }
+
+
+_MISSING = object()
+
+tracks = EntityCache("track")
+artists = EntityCache("artist")
+genres = EntityCache("genre")
+# Rendered template blocks keyed by (block, key, version) (page_cache.py);
+# versioned keys never go stale, so these only expire to bound memory
+fragments = EntityCache("fragment", maxsize=FRAGMENT_CACHE_SIZE, ttl=24 * 3600)
+# Per-user preference profiles (profiles.py), validated by pref_version
+profiles = EntityCache("profile", maxsize=PROFILE_CACHE_SIZE, ttl=3600)
+
+CACHES = {cache.name: cache for cache in (tracks, artists, genres, fragments, profiles)}
+
+
+def invalidate(kind=None, key=None):
+    """Invalidation hook: one entry, one cache, or (no arguments) all of them"""
+    for name, cache in CACHES.items():
+        if kind is None or kind == name:
+            cache.invalidate(key)
+
+
+def stats():
+    return {name: cache.stats() for name, cache in CACHES.items()}
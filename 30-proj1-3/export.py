@@ -0,0 +1,148 @@
+"""
+Streaming NDJSON / CSV export of the catalog and preference tables.
+
+Rows are read through a server-side cursor (stream_results with
+yield_per), so neither the server nor the CLI ever holds more than one
+batch in memory, and output is produced as a generator: the first bytes
+go out as soon as the first batch arrives.
+
+    python export.py track [--format csv] [--out track.csv] [--url URL]
+    python export.py --all --out-dir exports/ [--format ndjson]
+
+The server exposes the same streams as /export/<name>?format=ndjson|csv.
+"""
+import argparse
+import csv
+import datetime
+import decimal
+import io
+import json
+import os
+import sys
+import uuid
+
+from sqlalchemy import create_engine, text
+
+BATCH_SIZE = int(os.environ.get("EXPORT_BATCH_SIZE", 2000))
+
+# Export name -> query; ordered by primary key so repeated exports diff cleanly
+EXPORTS = {
+    "track": text("""
+        SELECT track_id, track_name, track_artist, genre_name, track_popularity, album_id
+        FROM Track ORDER BY track_id
+    """),
+    "artist": text("""
+        SELECT artist_id, artist_name, artist_nation, artist_tag, artist_popularity_score
+        FROM Artist ORDER BY artist_id
+    """),
+    "album": text("""
+        SELECT album_id, album_name, album_release_date
+        FROM Album ORDER BY album_id
+    """),
+    "genre": text("""
+        SELECT genre_id, genre_name, genre_description
+        FROM Genre ORDER BY genre_name
+    """),
+    "user_track_preference": text("""
+        SELECT user_id, track_id FROM UserTrackPreference ORDER BY user_id, track_id
+    """),
+    "user_artist_preference": text("""
+        SELECT user_id, artist_id FROM UserArtistPreference ORDER BY user_id, artist_id
+    """),
+    "user_genre_preference": text("""
+        SELECT user_id, genre_name FROM UserGenrePreference ORDER BY user_id, genre_name
+    """),
+}
+
+USER_EXPORTS = {"user_track_preference", "user_artist_preference", "user_genre_preference"}
+
+FORMATS = {"ndjson": "application/x-ndjson", "csv": "text/csv"}
+
+
+def _json_default(value):
+    if isinstance(value, (datetime.date, uuid.UUID)):
+        return str(value)
+    if isinstance(value, decimal.Decimal):
+        return float(value)
+    raise TypeError(f"cannot serialize {type(value).__name__}")
+
+
+def stream_rows(engine, name, batch_size=BATCH_SIZE):
+    """Yield (columns, batch of row tuples) for one export.
+
+    Uses its own connection rather than the request's g.conn, since a
+    streamed response is still being read after the request is torn down.
+    """
+    with engine.connect() as conn:
+        result = conn.execution_options(stream_results=True, yield_per=batch_size) \
+                     .execute(EXPORTS[name])
+        columns = list(result.keys())
+        for batch in result.partitions():
+            yield columns, batch
+        conn.rollback()
+
+
+def ndjson_chunks(batches):
+    for columns, batch in batches:
+        yield "".join(json.dumps(dict(zip(columns, row)), default=_json_default) + "\n"
+                      for row in batch)
+
+
+def csv_chunks(batches):
+    header = True
+    for columns, batch in batches:
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        if header:
+            writer.writerow(columns)
+            header = False
+        writer.writerows(batch)
+        yield buffer.getvalue()
+
+
+def export_chunks(engine, name, fmt="ndjson", batch_size=BATCH_SIZE):
+    """Text chunks of one export, one per fetched batch"""
+    if name not in EXPORTS:
+        raise KeyError(name)
+    if fmt not in FORMATS:
+        raise ValueError(f"unknown format {fmt}")
+    batches = stream_rows(engine, name, batch_size)
+    return ndjson_chunks(batches) if fmt == "ndjson" else csv_chunks(batches)
+
+
+def export_to(engine, name, fmt, out, batch_size=BATCH_SIZE):
+    for chunk in export_chunks(engine, name, fmt, batch_size):
+        out.write(chunk)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Stream tables out as NDJSON or CSV")
+    parser.add_argument("name", nargs="?", choices=sorted(EXPORTS), help="table to export")
+    parser.add_argument("--all", action="store_true", help="export every table into --out-dir")
+    parser.add_argument("--format", default="ndjson", choices=sorted(FORMATS))
+    parser.add_argument("--out", help="output file (default stdout)")
+    parser.add_argument("--out-dir", default=".", help="directory for --all")
+    parser.add_argument("--batch-size", type=int, default=BATCH_SIZE, help="rows fetched per round trip")
+    parser.add_argument("--url", help="database URL (defaults to the server's)")
+    args = parser.parse_args()
+
+    if not args.all and not args.name:
+        parser.error("give a table name or --all")
+
+    if args.url:
+        engine = create_engine(args.url)
+    else:
+        from server import engine
+
+    if args.all:
+        os.makedirs(args.out_dir, exist_ok=True)
+        for name in EXPORTS:
+            path = os.path.join(args.out_dir, f"{name}.{args.format}")
+            with open(path, "w", encoding="utf-8", newline="") as f:
+                export_to(engine, name, args.format, f, args.batch_size)
+            print(f"{name:<24} -> {path}")
+    elif args.out:
+        with open(args.out, "w", encoding="utf-8", newline="") as f:
+            export_to(engine, args.name, args.format, f, args.batch_size)
+    else:
+        export_to(engine, args.name, args.format, sys.stdout, args.batch_size)
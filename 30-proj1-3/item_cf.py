@@ -0,0 +1,344 @@
+"""
+Item-item collaborative filtering over UserTrackPreference.
+
+Two tracks are similar when the same users like both: the similarity is
+the cosine of their binary user vectors,
+
+    sim(i, j) = users(i and j) / sqrt(users(i) * users(j))
+
+computed for all pairs at once as the sparse product X^T X of the
+user x track matrix. Each track keeps only its NEIGHBORS most similar
+tracks, stored CSR style in three flat arrays (row offsets, int32 track
+rows, float32 scores), so the whole model is a few bytes per neighbor and
+a lookup is two array slices.
+
+Preference changes are applied in place (update/remove): the changed
+track's row and the rows of the user's other liked tracks are recomputed
+from the in-memory user/track sets and kept in a small overlay that is
+folded back into the arrays once it grows past COMPACT_AFTER rows. All of
+one request's changes are applied together, so each affected row is
+recomputed once. Similarities of tracks only indirectly affected are
+refreshed by the periodic full rebuild, which also picks up changes made
+by other server processes; ensure_fresh runs it on a background thread
+(refresh.py) while requests keep using the current model.
+
+A rebuild reads the preferences before it swaps in the new arrays, so
+changes applied meanwhile are logged from the moment load() starts
+reading and replayed onto the new model in the same locked section as the
+swap. Replaying is idempotent (adding a liked track or removing an
+unliked one changes nothing), so a change the read already saw is
+harmless.
+
+Lookups copy the references they need under the lock and do the
+arithmetic outside it. Rebuilds and compactions replace the arrays rather
+than writing into them, so those references stay consistent.
+
+Recommendation rows (system output) are not used as input, so the model
+never feeds on its own suggestions.
+
+    python item_cf.py [--url URL] [--track TRACK_ID] [--user USER_ID]
+"""
+import argparse
+import os
+import threading
+import time
+from collections import Counter
+
+import numpy as np
+from scipy import sparse
+from sqlalchemy import create_engine, text
+
+import refresh
+
+NEIGHBORS = int(os.environ.get("ITEM_CF_NEIGHBORS", 50))
+REFRESH_INTERVAL = int(os.environ.get("ITEM_CF_REFRESH", 600))
+COMPACT_AFTER = 1024
+
+PREFERENCES_QUERY = text("""
+    SELECT utp.user_id, utp.track_id, t.track_name
+    FROM UserTrackPreference utp
+    JOIN Track t ON t.track_id = utp.track_id
+""")
+
+
+def _top(indices, scores, k):
+    """The k best (indices, scores), best first, as int32 / float32 arrays"""
+    if len(scores) > k:
+        keep = np.argpartition(-scores, k - 1)[:k]
+        indices, scores = indices[keep], scores[keep]
+    order = np.lexsort((indices, -scores))
+    return indices[order].astype(np.int32), scores[order].astype(np.float32)
+
+
+class ItemNeighbors:
+    """Top-K similar tracks per track, in CSR arrays plus an update overlay"""
+
+    def __init__(self, k=NEIGHBORS):
+        self.k = k
+        self._lock = threading.Lock()
+        self.track_ids = []         # row -> track_id
+        self.names = []             # row -> track_name
+        self.row_of = {}            # track_id -> row
+        self.user_items = {}        # user_id -> set of rows
+        self.item_users = []        # row -> set of user_ids
+        self._indptr = np.zeros(1, dtype=np.int64)
+        self._indices = np.zeros(0, dtype=np.int32)
+        self._scores = np.zeros(0, dtype=np.float32)
+        self._overlay = {}          # row -> (indices, scores), newer than the arrays
+        self._log = None            # [(user_id, added, removed)] while load() reads
+        self.loaded_at = None
+        self.refresher = refresh.Refresher("item_cf", self)
+
+    def __len__(self):
+        return len(self.track_ids)
+
+    # -- building -----------------------------------------------------------
+
+    def build(self, rows):
+        """Full rebuild from (user_id, track_id, track_name) rows"""
+        track_ids, names, row_of = [], [], {}
+        user_items, item_users = {}, []
+        for user_id, track_id, track_name in rows:
+            row = row_of.get(track_id)
+            if row is None:
+                row = row_of[track_id] = len(track_ids)
+                track_ids.append(track_id)
+                names.append(track_name)
+                item_users.append(set())
+            user_items.setdefault(user_id, set()).add(row)
+            item_users[row].add(user_id)
+
+        user_rows = {user_id: n for n, user_id in enumerate(user_items)}
+        pairs = [(user_rows[user_id], row) for user_id, items in user_items.items() for row in items]
+        n_items = len(track_ids)
+        if pairs:
+            u, i = np.array(pairs, dtype=np.int64).T
+            x = sparse.csr_matrix((np.ones(len(u), dtype=np.float32), (u, i)),
+                                  shape=(len(user_rows), n_items))
+            co = (x.T @ x).tocsr()
+            co.setdiag(0)
+            co.eliminate_zeros()
+            counts = np.asarray(x.sum(axis=0)).ravel()
+            row_index = np.repeat(np.arange(n_items), np.diff(co.indptr))
+            co.data = co.data / np.sqrt(counts[row_index] * counts[co.indices])
+        else:
+            co = sparse.csr_matrix((n_items, n_items), dtype=np.float32)
+
+        indptr = np.zeros(n_items + 1, dtype=np.int64)
+        indices, scores = [], []
+        for row in range(n_items):
+            start, end = co.indptr[row], co.indptr[row + 1]
+            top_indices, top_scores = _top(co.indices[start:end], co.data[start:end], self.k)
+            indices.append(top_indices)
+            scores.append(top_scores)
+            indptr[row + 1] = indptr[row] + len(top_indices)
+
+        with self._lock:
+            self.track_ids, self.names, self.row_of = track_ids, names, row_of
+            self.user_items, self.item_users = user_items, item_users
+            self._indptr = indptr
+            self._indices = np.concatenate(indices) if indices else np.zeros(0, dtype=np.int32)
+            self._scores = np.concatenate(scores) if scores else np.zeros(0, dtype=np.float32)
+            self._overlay = {}
+            self.loaded_at = time.monotonic()
+            log, self._log = self._log, None
+            for user_id, added, removed in log or ():
+                self._apply(user_id, added, removed)
+
+    def load(self, conn):
+        with self._lock:
+            self._log = []
+        try:
+            self.build(conn.execute(PREFERENCES_QUERY).tuples())
+        finally:
+            with self._lock:
+                self._log = None
+
+    def ensure_fresh(self, conn, max_age=REFRESH_INTERVAL):
+        """Build on first use; rebuild in the background once older than max_age"""
+        self.refresher.ensure_fresh(conn, max_age)
+
+    # -- incremental updates ------------------------------------------------
+
+    def _row_neighbors(self, row):
+        """Recompute one row's top-K from the user/track sets (caller holds the lock)"""
+        co = Counter()
+        for user_id in self.item_users[row]:
+            co.update(self.user_items[user_id])
+        co.pop(row, None)
+        if not co:
+            return np.zeros(0, dtype=np.int32), np.zeros(0, dtype=np.float32)
+        indices = np.fromiter(co.keys(), dtype=np.int64, count=len(co))
+        counts = np.fromiter(co.values(), dtype=np.float64, count=len(co))
+        sizes = np.array([len(self.item_users[j]) for j in indices], dtype=np.float64)
+        scores = counts / np.sqrt(len(self.item_users[row]) * sizes)
+        return _top(indices, scores, self.k)
+
+    def _touch(self, user_id, rows):
+        """Refresh the rows whose co-occurrence counts the user's changes moved"""
+        for affected in self.user_items.get(user_id, set()) | rows:
+            self._overlay[affected] = self._row_neighbors(affected)
+        if len(self._overlay) > COMPACT_AFTER:
+            self._compact()
+
+    def _compact(self):
+        """Fold the overlay back into the flat arrays"""
+        n_items = len(self.track_ids)
+        indptr = np.zeros(n_items + 1, dtype=np.int64)
+        indices, scores = [], []
+        for row in range(n_items):
+            row_indices, row_scores = self._stored(row)
+            indices.append(row_indices)
+            scores.append(row_scores)
+            indptr[row + 1] = indptr[row] + len(row_indices)
+        self._indptr = indptr
+        self._indices = np.concatenate(indices) if indices else np.zeros(0, dtype=np.int32)
+        self._scores = np.concatenate(scores) if scores else np.zeros(0, dtype=np.float32)
+        self._overlay = {}
+
+    def remove(self, user_id, track_id):
+        """Record that user_id no longer likes track_id"""
+        self.update(user_id, removed=[track_id])
+
+    def update(self, user_id, added=(), removed=()):
+        """Apply one request's changes: `added` holds (track_id, track_name)
+        pairs, `removed` track_ids. Every affected row is recomputed once."""
+        added, removed = list(added), list(removed)
+        with self._lock:
+            if self._log is not None:
+                self._log.append((user_id, added, removed))
+            self._apply(user_id, added, removed)
+
+    def _apply(self, user_id, added, removed):
+        """update() with the lock held"""
+        changed = set()
+        for track_id in removed:
+            row = self.row_of.get(track_id)
+            if row is None or user_id not in self.item_users[row]:
+                continue
+            self.item_users[row].discard(user_id)
+            self.user_items[user_id].discard(row)
+            changed.add(row)
+        for track_id, track_name in added:
+            row = self.row_of.get(track_id)
+            if row is None:
+                row = self.row_of[track_id] = len(self.track_ids)
+                self.track_ids.append(track_id)
+                self.names.append(track_name)
+                self.item_users.append(set())
+            if user_id in self.item_users[row]:
+                continue
+            self.item_users[row].add(user_id)
+            self.user_items.setdefault(user_id, set()).add(row)
+            changed.add(row)
+        if changed:
+            self._touch(user_id, changed)
+
+    # -- lookups ------------------------------------------------------------
+
+    def _stored(self, row):
+        """One row's (indices, scores); caller holds the lock"""
+        patched = self._overlay.get(row)
+        if patched is not None:
+            return patched
+        if row + 1 >= len(self._indptr):
+            return np.zeros(0, dtype=np.int32), np.zeros(0, dtype=np.float32)
+        start, end = self._indptr[row], self._indptr[row + 1]
+        return self._indices[start:end], self._scores[start:end]
+
+    @staticmethod
+    def _result(track_ids, names, row, score, source=None):
+        result = {
+            "track_id": track_ids[row],
+            "track_name": names[row] or track_ids[row],
+            "score": round(float(score), 4),
+        }
+        if source is not None:
+            source_name = names[source] or track_ids[source]
+            result["reason"] = f"Fans of {source_name} also liked this"
+        return result
+
+    def neighbors(self, track_id, limit=10):
+        """Users who liked track_id also liked: [{track_id, track_name, score}]"""
+        with self._lock:
+            row = self.row_of.get(track_id)
+            if row is None:
+                return []
+            indices, scores = self._stored(row)
+            # Rows are only ever appended, so these stay valid for our rows
+            track_ids, names = self.track_ids, self.names
+        return [self._result(track_ids, names, j, s) for j, s in zip(indices[:limit], scores[:limit])]
+
+    def recommend_for_user(self, user_id, limit=10, exclude=()):
+        """Tracks most similar to everything user_id likes, with the best source"""
+        with self._lock:
+            liked = list(self.user_items.get(user_id, ()))
+            if not liked:
+                return []
+            parts = [self._stored(row) for row in liked]
+            skip = set(liked) | {self.row_of[t] for t in exclude if t in self.row_of}
+            track_ids, names = self.track_ids, self.names
+        indices = np.concatenate([p[0] for p in parts])
+        if not len(indices):
+            return []
+        scores = np.concatenate([p[1] for p in parts])
+        sources = np.repeat(np.array(liked), [len(p[0]) for p in parts])
+
+        candidates, inverse = np.unique(indices, return_inverse=True)
+        totals = np.bincount(inverse, weights=scores)
+        totals[[n for n, row in enumerate(candidates) if row in skip]] = -1
+        order = np.argsort(-totals, kind="stable")[:limit]
+
+        results = []
+        for n in order:
+            if totals[n] <= 0:
+                break
+            mask = inverse == n
+            source = sources[mask][np.argmax(scores[mask])]
+            results.append(self._result(track_ids, names, candidates[n], totals[n], source))
+        return results
+
+    def stats(self):
+        with self._lock:
+            return {
+                "tracks": len(self.track_ids),
+                "users": len(self.user_items),
+                "neighbors": int(len(self._indices)),
+                "overlay_rows": len(self._overlay),
+                "bytes": int(self._indptr.nbytes + self._indices.nbytes + self._scores.nbytes),
+                "refreshes": self.refresher.refreshes,
+            }
+
+
+index = ItemNeighbors()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Build the item-item model and time lookups")
+    parser.add_argument("--url", help="database URL (defaults to the server's)")
+    parser.add_argument("--track", help="show the neighbors of this track")
+    parser.add_argument("--user", type=int, help="show recommendations for this user")
+    args = parser.parse_args()
+
+    if args.url:
+        engine = create_engine(args.url)
+    else:
+        from server import engine
+
+    started = time.perf_counter()
+    with engine.connect() as conn:
+        index.load(conn)
+    print(f"Built in {time.perf_counter() - started:.3f}s: {index.stats()}")
+
+    if index.track_ids:
+        track_id = args.track or index.track_ids[0]
+        user_id = args.user if args.user is not None else next(iter(index.user_items))
+        for label, lookup in (("neighbors", lambda: index.neighbors(track_id, 10)),
+                              ("recommend_for_user", lambda: index.recommend_for_user(user_id, 10))):
+            runs = 1000
+            started = time.perf_counter()
+            for _ in range(runs):
+                results = lookup()
+            print(f"{label}: {(time.perf_counter() - started) / runs * 1e6:.1f} us per call")
+            for result in results[:5]:
+                print(f"    {result}")
@@ -0,0 +1,188 @@
+"""
+Bulk loader for the catalog and user CSVs shipped at the repository root.
+
+Each file is streamed into a temporary staging table with COPY FROM STDIN,
+then moved into the real table with one INSERT ... SELECT DISTINCT ON the
+primary key, so duplicate rows in the exports (album.csv and track.csv
+repeat ids) and rows already present are skipped instead of failing the
+load. Rows whose foreign key has no parent are skipped and counted.
+
+Tables are loaded in foreign-key order; tables at the same level are
+independent and load in parallel on separate connections:
+
+    level 0: Genre, Album, Artist, "User"
+    level 1: Track, UserPreference
+    level 2: ArtistTrack, Recommendation
+
+Usage:
+    python loader.py [--data-dir DIR] [--url DATABASE_URL] [--truncate]
+                     [--artists Artists_data.csv] [--workers 4]
+                     [--notify http://localhost:8111]
+
+--notify posts to the running server's /cache/invalidate route so the
+detail page cache and search index pick up the new rows immediately;
+under prefork.py the worker taking it passes it on to all the others.
+"""
+import argparse
+import os
+import time
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+from sqlalchemy import create_engine
+
+import top_tracks
+
+DATA_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+class TableSpec:
+    def __init__(self, table, files, key, parents=()):
+        self.table = table
+        self.files = files
+        self.key = key
+        # (column, parent table, parent column) checked before insert
+        self.parents = parents
+
+    @property
+    def stage(self):
+        return "stage_" + self.table.strip('"').lower()
+
+
+LEVELS = [
+    [
+        TableSpec("Genre", ["genre.csv"], "genre_name"),
+        TableSpec("Album", ["album.csv", "albums.csv", "albums_(1).csv", "albums_.csv"], "album_id"),
+        TableSpec("Artist", ["Artists_data.csv"], "artist_id"),
+        TableSpec('"User"', ["User.csv"], "user_id"),
+    ],
+    [
+        TableSpec("Track", ["track.csv", "tracks.csv"], "track_id",
+                  [("album_id", "Album", "album_id"), ("genre_name", "Genre", "genre_name")]),
+        TableSpec("UserPreference", ["UserPreference.csv"], "user_id",
+                  [("user_id", '"User"', "user_id")]),
+    ],
+    [
+        TableSpec("ArtistTrack", ["ArtistTrack.csv"], "artist_id, track_id",
+                  [("artist_id", "Artist", "artist_id"), ("track_id", "Track", "track_id")]),
+        TableSpec("Recommendation", ["Recommendations.csv"], "rec_id",
+                  [("user_id", '"User"', "user_id"), ("track_id", "Track", "track_id")]),
+    ],
+]
+
+
+def load_table(engine, spec, data_dir):
+    """Stream every file of one table through staging; returns a stats dict"""
+    paths = [os.path.join(data_dir, name) for name in spec.files]
+    paths = [path for path in paths if os.path.exists(path)]
+    stats = {"table": spec.table, "files": len(paths), "staged": 0, "inserted": 0}
+    if not paths:
+        return stats
+
+    started = time.perf_counter()
+    raw = engine.raw_connection()
+    try:
+        cur = raw.cursor()
+        cur.execute(f"CREATE TEMP TABLE {spec.stage} (LIKE {spec.table}) ON COMMIT DROP")
+        for path in paths:
+            # utf-8-sig drops the BOM that the album/track exports start with;
+            # the header is read here so COPY gets the file's column order
+            with open(path, encoding="utf-8-sig", newline="") as f:
+                columns = f.readline().strip().split(",")
+                cur.copy_expert(
+                    f"COPY {spec.stage} ({', '.join(columns)}) FROM STDIN WITH (FORMAT csv)", f)
+                stats["staged"] += cur.rowcount
+
+        conditions = [f"(s.{col} IS NULL OR EXISTS (SELECT 1 FROM {parent} p WHERE p.{parent_col} = s.{col}))"
+                      for col, parent, parent_col in spec.parents]
+        where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+        cur.execute(f"""
+            INSERT INTO {spec.table}
+            SELECT DISTINCT ON ({spec.key}) * FROM {spec.stage} s
+            {where}
+            ON CONFLICT DO NOTHING
+        """)
+        stats["inserted"] = cur.rowcount
+        raw.commit()
+        cur.execute(f"ANALYZE {spec.table}")
+        raw.commit()
+    except Exception:
+        raw.rollback()
+        raise
+    finally:
+        raw.close()
+
+    stats["seconds"] = round(time.perf_counter() - started, 3)
+    return stats
+
+
+def truncate(engine):
+    """Empty every loaded table (and, through CASCADE, rows that reference them)"""
+    tables = ", ".join(spec.table for level in LEVELS for spec in level)
+    raw = engine.raw_connection()
+    try:
+        raw.cursor().execute(f"TRUNCATE {tables} CASCADE")
+        raw.commit()
+    finally:
+        raw.close()
+
+
+def notify_server(base_url):
+    """Ask a running server to drop its cached catalog data"""
+    url = base_url.rstrip("/") + "/cache/invalidate"
+    with urllib.request.urlopen(urllib.request.Request(url, data=b"", method="POST"), timeout=10) as resp:
+        return resp.status
+
+
+def load_all(engine, data_dir=DATA_DIR, workers=4, reset=False):
+    if reset:
+        truncate(engine)
+
+    results = []
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        for level in LEVELS:
+            results.extend(pool.map(lambda spec: load_table(engine, spec, data_dir), level))
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Bulk load the CSV exports with COPY")
+    parser.add_argument("--data-dir", default=DATA_DIR, help="directory holding the CSV files")
+    parser.add_argument("--url", help="database URL (defaults to the server's)")
+    parser.add_argument("--artists", help="CSV for the Artist table, if not Artists_data.csv in --data-dir")
+    parser.add_argument("--truncate", action="store_true", help="empty the tables first (full reload)")
+    parser.add_argument("--workers", type=int, default=4, help="tables loaded in parallel per level")
+    parser.add_argument("--notify", metavar="SERVER_URL", help="invalidate a running server's caches afterwards")
+    args = parser.parse_args()
+
+    if args.url:
+        engine = create_engine(args.url, pool_size=args.workers)
+    else:
+        from server import engine
+
+    if args.artists:
+        LEVELS[0][2].files = [os.path.abspath(args.artists)]
+
+    started = time.perf_counter()
+    for stats in load_all(engine, args.data_dir, args.workers, reset=args.truncate):
+        if not stats["files"]:
+            print(f"{stats['table']:<16} no input files, skipped")
+            continue
+        print(f"{stats['table']:<16} staged {stats['staged']:>8}  inserted {stats['inserted']:>8}"
+              f"  ({stats['seconds']}s)")
+    print(f"Done in {time.perf_counter() - started:.2f}s")
+
+    # Triggers marked every genre and artist the load touched
+    try:
+        with engine.connect() as conn:
+            rebuilt = top_tracks.refresh(conn)
+        print("Refreshed top tracks: " + ", ".join(f"{scope} {count}" for scope, count in rebuilt.items()))
+    except Exception as e:
+        print(f"Top tracks refresh error: {str(e)}")
+
+    if args.notify:
+        try:
+            notify_server(args.notify)
+            print(f"Invalidated caches on {args.notify}")
+        except Exception as e:
+            print(f"Cache invalidation error: {str(e)}")
@@ -0,0 +1,413 @@
+"""
+Per-route request and query instrumentation with a Prometheus-style /metrics.
+
+install(app, engine) hooks the Flask request lifecycle and the engine's
+cursor events. For every request it records latency, the number of SQL
+statements, total time spent in the database, rows returned and time spent
+waiting for a pooled connection, aggregated per route rule (so
+/track/<track_id> is one series, not one per id).
+
+Statements slower than SLOW_QUERY_MS are kept, with their parameters, in a
+bounded slow-query log served as JSON from /metrics/slow. The parameters
+include user data such as login emails, so that route only answers
+requests from this host, like /cache/invalidate.
+
+Statements on read replica engines are counted the same way. Work done
+on helper threads is attributed to the request when the thread runs
+inside a copy of the request's context (contextvars.copy_context().run).
+
+Under prefork.py each worker process records its own requests, so the
+workers pool them through a directory the master creates: share(directory)
+makes a worker write a snapshot of its metrics there every SHARE_INTERVAL
+seconds, and /metrics and /metrics/slow answer from every worker's latest
+snapshot plus the live one of the worker serving the scrape. Counters and
+histograms are summed, with those of exited workers kept (see retire()) so
+they never go backwards; gauges are reported per worker with a worker
+label.
+
+    METRICS_SHARE_INTERVAL  seconds between a worker's snapshots (default 5)
+"""
+import contextvars
+import json
+import os
+import threading
+import time
+from collections import defaultdict, deque
+
+from flask import Response, abort, g, jsonify, request
+from sqlalchemy import event
+
+SLOW_QUERY_MS = float(os.environ.get("SLOW_QUERY_MS", 100))
+SLOW_QUERY_LOG_SIZE = int(os.environ.get("SLOW_QUERY_LOG_SIZE", 200))
+SHARE_INTERVAL = float(os.environ.get("METRICS_SHARE_INTERVAL", 5))
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+_current = contextvars.ContextVar("request_stats", default=None)
+
+# Directory shared with the other worker processes, once share() is called
+_shared_dir = None
+# (engine, extra_gauges) given to install(), for the snapshots share() writes
+_sources = (None, None)
+
+
+class RequestStats:
+    """Counters for one request; shared with helper threads, hence the lock"""
+
+    def __init__(self, route):
+        self.route = route
+        self.lock = threading.Lock()
+        self.statements = 0
+        self.db_seconds = 0.0
+        self.rows = 0
+
+    def add_statement(self, seconds, rows):
+        with self.lock:
+            self.statements += 1
+            self.db_seconds += seconds
+            self.rows += max(rows, 0)
+
+
+class Histogram:
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.total = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+                break
+        else:
+            self.counts[-1] += 1
+        self.total += value
+        self.count += 1
+
+
+class Registry:
+    """Process-wide aggregates keyed by route"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.requests = defaultdict(int)            # (route, method, status) -> count
+        self.latency = defaultdict(Histogram)       # route -> request seconds
+        self.db_time = defaultdict(Histogram)       # route -> db seconds per request
+        self.statements = defaultdict(int)          # route -> statements
+        self.rows = defaultdict(int)                # route -> rows returned
+        self.pool_wait = defaultdict(float)         # route -> seconds waiting for a connection
+        self.slow_queries = deque(maxlen=SLOW_QUERY_LOG_SIZE)
+        self.untracked_statements = 0               # statements outside any request
+
+    def record_request(self, stats, method, status, seconds, pool_wait):
+        with self.lock:
+            self.requests[(stats.route, method, status)] += 1
+            self.latency[stats.route].observe(seconds)
+            self.db_time[stats.route].observe(stats.db_seconds)
+            self.statements[stats.route] += stats.statements
+            self.rows[stats.route] += stats.rows
+            self.pool_wait[stats.route] += pool_wait
+
+    def record_slow(self, entry):
+        with self.lock:
+            self.slow_queries.append(entry)
+
+    def dump(self):
+        """The counters and histograms as JSON-able data, for add() elsewhere"""
+        with self.lock:
+            return {
+                "requests": [[*key, count] for key, count in self.requests.items()],
+                "latency": {route: [h.counts, h.total, h.count] for route, h in self.latency.items()},
+                "db_time": {route: [h.counts, h.total, h.count] for route, h in self.db_time.items()},
+                "statements": dict(self.statements),
+                "rows": dict(self.rows),
+                "pool_wait": dict(self.pool_wait),
+                "untracked_statements": self.untracked_statements,
+            }
+
+    def add(self, data):
+        """Sum another registry's dump() into this one"""
+        with self.lock:
+            for route, method, status, count in data["requests"]:
+                self.requests[(route, method, status)] += count
+            for name in ("latency", "db_time"):
+                for route, (counts, total, count) in data[name].items():
+                    hist = getattr(self, name)[route]
+                    hist.counts = [a + b for a, b in zip(hist.counts, counts)]
+                    hist.total += total
+                    hist.count += count
+            for name in ("statements", "rows", "pool_wait"):
+                for route, value in data[name].items():
+                    getattr(self, name)[route] += value
+            self.untracked_statements += data["untracked_statements"]
+
+
+registry = Registry()
+
+
+def _short(value, limit=200):
+    text = repr(value)
+    return text if len(text) <= limit else text[:limit] + "..."
+
+
+def _install_engine_hooks(engine):
+    @event.listens_for(engine, "before_cursor_execute")
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault("query_started", []).append(time.perf_counter())
+
+    @event.listens_for(engine, "after_cursor_execute")
+    def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        elapsed = time.perf_counter() - conn.info["query_started"].pop()
+        if context is not None and context.execution_options.get("plan_sample"):
+            # statements.py's sampled EXPLAINs are overhead, not route work
+            return
+        stats = _current.get()
+        if stats is None:
+            with registry.lock:
+                registry.untracked_statements += 1
+        else:
+            stats.add_statement(elapsed, cursor.rowcount if cursor.description else 0)
+
+        if elapsed * 1000 >= SLOW_QUERY_MS:
+            route = stats.route if stats else None
+            print(f"Slow query ({elapsed * 1000:.1f} ms, {route}): {' '.join(statement.split())[:200]}")
+            registry.record_slow({
+                "route": route,
+                "ms": round(elapsed * 1000, 3),
+                "statement": " ".join(statement.split()),
+                "parameters": _short(parameters),
+                "at": time.time(),
+            })
+
+    @event.listens_for(engine, "handle_error")
+    def handle_error(exception_context):
+        # after_cursor_execute does not run for a failed statement
+        conn = exception_context.connection
+        if conn is not None and conn.info.get("query_started"):
+            conn.info["query_started"].pop()
+
+
+def _install_request_hooks(app):
+    @app.before_request
+    def start_request_metrics():
+        route = request.url_rule.rule if request.url_rule else "unmatched"
+        g.metrics_started = time.perf_counter()
+        g.metrics_status = 500
+        g.metrics_token = _current.set(RequestStats(route))
+
+    @app.after_request
+    def capture_status(response):
+        g.metrics_status = response.status_code
+        return response
+
+    @app.teardown_request
+    def finish_request_metrics(exception):
+        started = g.pop("metrics_started", None)
+        token = g.pop("metrics_token", None)
+        if started is None or token is None:
+            return
+        stats = _current.get()
+        _current.reset(token)
+        conn = g.get("conn")
+        pool_wait = getattr(conn, "wait_seconds", 0.0) or 0.0
+        registry.record_request(stats, request.method, g.get("metrics_status", 500),
+                                time.perf_counter() - started, pool_wait)
+
+
+def _label(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"')
+
+
+def _histogram_lines(name, route, hist):
+    lines = []
+    cumulative = 0
+    for bound, count in zip(hist.buckets, hist.counts):
+        cumulative += count
+        lines.append(f'{name}_bucket{{route="{_label(route)}",le="{bound}"}} {cumulative}')
+    lines.append(f'{name}_bucket{{route="{_label(route)}",le="+Inf"}} {hist.count}')
+    lines.append(f'{name}_sum{{route="{_label(route)}"}} {hist.total:.6f}')
+    lines.append(f'{name}_count{{route="{_label(route)}"}} {hist.count}')
+    return lines
+
+
+def snapshot(engine=None, extra_gauges=None):
+    """This process's metrics as JSON-able data: registry counters, gauges and slow queries"""
+    data = registry.dump()
+    gauges = {}
+    pool_stats = getattr(engine, "pool_stats", None)
+    if pool_stats is not None:
+        for key, value in pool_stats.snapshot().items():
+            if value is not None:
+                gauges[f"app_db_pool_{key}"] = value
+    gauges.update(extra_gauges or {})
+    with registry.lock:
+        slow_queries = list(registry.slow_queries)
+    data.update(pid=os.getpid(), gauges=gauges, slow_queries=slow_queries)
+    return data
+
+
+def _read(path):
+    with open(path) as f:
+        return json.load(f)
+
+
+def _write(path, data):
+    # Readers must never see a half written file
+    with open(f"{path}.tmp", "w") as f:
+        json.dump(data, f)
+    os.replace(f"{path}.tmp", path)
+
+
+def publish():
+    """Write this process's snapshot to the shared directory, if there is one"""
+    if _shared_dir is None:
+        return
+    engine, extra_gauges = _sources
+    try:
+        data = snapshot(engine, extra_gauges() if extra_gauges else None)
+        _write(os.path.join(_shared_dir, f"{os.getpid()}.json"), data)
+    except Exception as e:
+        print(f"Metrics publish error: {str(e)}")
+
+
+def share(directory):
+    """Pool this process's metrics with the others writing to `directory`.
+
+    Starts the thread writing this process's snapshots, so call it in each
+    worker after the fork.
+    """
+    global _shared_dir
+    _shared_dir = directory
+
+    def publish_loop():
+        while True:
+            time.sleep(SHARE_INTERVAL)
+            publish()
+
+    threading.Thread(target=publish_loop, name="metrics-share", daemon=True).start()
+
+
+def retire(directory, pid):
+    """Fold the counters of exited process `pid` into the directory's retired totals"""
+    path = os.path.join(directory, f"{pid}.json")
+    retired_path = os.path.join(directory, "retired.json")
+    try:
+        data = _read(path)
+    except FileNotFoundError:
+        return
+    retired = Registry()
+    if os.path.exists(retired_path):
+        retired.add(_read(retired_path))
+    retired.add(data)
+    _write(retired_path, retired.dump())
+    os.remove(path)
+
+
+def _snapshots(engine=None, extra_gauges=None):
+    """This process's live snapshot, then the other processes' latest ones"""
+    own = snapshot(engine, extra_gauges)
+    if _shared_dir is None:
+        return [own]
+    snapshots = [own]
+    for name in sorted(os.listdir(_shared_dir)):
+        if not name.endswith(".json") or name == f"{own['pid']}.json":
+            continue
+        try:
+            snapshots.append(_read(os.path.join(_shared_dir, name)))
+        except FileNotFoundError:
+            # Retired since the listing
+            continue
+    return snapshots
+
+
+def _with_label(name, label):
+    if name.endswith("}"):
+        return f"{name[:-1]},{label}}}"
+    return f"{name}{{{label}}}"
+
+
+def render(engine=None, extra_gauges=None):
+    """Prometheus text exposition of everything recorded so far, in every shared process"""
+    snapshots = _snapshots(engine, extra_gauges)
+    merged = Registry()
+    for data in snapshots:
+        merged.add(data)
+
+    lines = []
+    with merged.lock:
+        lines += ["# HELP app_requests_total Requests handled, by route, method and status",
+                  "# TYPE app_requests_total counter"]
+        for (route, method, status), count in sorted(merged.requests.items()):
+            lines.append(f'app_requests_total{{route="{_label(route)}",method="{method}",status="{status}"}} {count}')
+
+        lines += ["# HELP app_request_duration_seconds Request latency",
+                  "# TYPE app_request_duration_seconds histogram"]
+        for route, hist in sorted(merged.latency.items()):
+            lines += _histogram_lines("app_request_duration_seconds", route, hist)
+
+        lines += ["# HELP app_request_db_seconds Database time per request",
+                  "# TYPE app_request_db_seconds histogram"]
+        for route, hist in sorted(merged.db_time.items()):
+            lines += _histogram_lines("app_request_db_seconds", route, hist)
+
+        for name, help_text, values in (
+                ("app_db_statements_total", "SQL statements executed", merged.statements),
+                ("app_db_rows_total", "Rows returned by SELECTs", merged.rows),
+                # Not app_db_pool_*: those are the pool's own totals below
+                ("app_request_pool_wait_seconds_total", "Time spent waiting for a pooled connection",
+                 merged.pool_wait)):
+            lines += [f"# HELP {name} {help_text}", f"# TYPE {name} counter"]
+            for route, value in sorted(values.items()):
+                lines.append(f'{name}{{route="{_label(route)}"}} {value}')
+
+        lines += ["# HELP app_db_untracked_statements_total Statements run outside a request",
+                  "# TYPE app_db_untracked_statements_total counter",
+                  f"app_db_untracked_statements_total {merged.untracked_statements}"]
+
+    # One series per worker, each name's series together
+    gauges = defaultdict(list)
+    for data in snapshots:
+        if "gauges" not in data:
+            # retired.json: counters only
+            continue
+        label = f'worker="{data["pid"]}"'
+        for name, value in dict(app_slow_queries_logged=len(data["slow_queries"]), **data["gauges"]).items():
+            gauges[name].append((_with_label(name, label) if _shared_dir is not None else name, value))
+    lines += ["# HELP app_slow_queries_logged Slow queries currently in the log",
+              "# TYPE app_slow_queries_logged gauge"]
+    for series in gauges.values():
+        lines += [f"{name} {value}" for name, value in series]
+
+    return "\n".join(lines) + "\n"
+
+
+def install(app, engine, extra_gauges=None, replicas=()):
+    """Hook app and engine, and register /metrics and /metrics/slow.
+
+    `extra_gauges` is an optional callable returning {metric name: value}
+    evaluated at scrape time. Statements on the `replicas` engines are
+    counted with the primary's.
+    """
+    global _sources
+    _sources = (engine, extra_gauges)
+    for hooked in [engine, *replicas]:
+        _install_engine_hooks(hooked)
+    _install_request_hooks(app)
+
+    @app.route('/metrics')
+    def metrics():
+        gauges = extra_gauges() if extra_gauges else None
+        return Response(render(engine, gauges), mimetype="text/plain; version=0.0.4")
+
+    @app.route('/metrics/slow')
+    def slow_queries():
+        if request.remote_addr not in ('127.0.0.1', '::1'):
+            abort(403)
+        if _shared_dir is None:
+            with registry.lock:
+                entries = list(registry.slow_queries)
+        else:
+            entries = sorted((entry for data in _snapshots() for entry in data.get("slow_queries", ())),
+                             key=lambda entry: entry["at"])[-SLOW_QUERY_LOG_SIZE:]
+        return jsonify({"threshold_ms": SLOW_QUERY_MS, "queries": entries[::-1]})
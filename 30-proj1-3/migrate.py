@@ -0,0 +1,156 @@
+"""
+Versioned schema migrations and query plan verification.
+
+Migrations are the numbered .sql files in migrations/, applied in order,
+each in its own transaction, and recorded in the schema_migrations table.
+
+    python migrate.py [--url URL]                  # apply pending migrations
+    python migrate.py status [--url URL]
+    python migrate.py verify [--url URL] [--force-index]
+
+verify runs EXPLAIN for every route query with sample parameters taken from
+the database and reports each sequential scan; it exits non-zero if any of
+them is on Track. --force-index disables sequential scans for the session,
+which checks that an index path exists even on tables small enough that
+the planner would rather scan them.
+"""
+import argparse
+import os
+import sys
+
+from sqlalchemy import create_engine, text
+
+import profiles
+import rec_store
+import server
+import top_tracks
+
+MIGRATIONS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'migrations')
+
+# (route, statement) for every query a route runs, as the routes register
+# them; parameters are filled from sample_params()
+ROUTE_QUERIES = [
+    ('/ (login)', server.USER_BY_EMAIL),
+    ('/search', server.SEARCH_FALLBACK_QUERY),
+    ('/recommendations (stored)', rec_store.READ_QUERY),
+    ('/recommendations (build)', rec_store.RECOMMENDATION_QUERY),
+    ('/preferences (profile)', profiles.PROFILE_QUERY),
+    ('/preferences (version)', profiles.PREF_VERSION),
+    ('/track/<id>', server.TRACK_DETAIL),
+    ('/genre/<name>', server.GENRE_TRACKS[False]),
+    ('/genre/<name>?after=', server.GENRE_TRACKS[True]),
+    ('/genre/<name> (top)', top_tracks.GENRE_TOP),
+    ('/artist/<id> (top)', top_tracks.ARTIST_TOP),
+    ('/artist/<id>', server.ARTIST_TRACKS[False]),
+    ('/artist/<id>?after=', server.ARTIST_TRACKS[True]),
+]
+
+
+def migration_files():
+    return sorted(name for name in os.listdir(MIGRATIONS_DIR) if name.endswith('.sql'))
+
+
+def applied_versions(conn):
+    conn.execute(text("""
+        CREATE TABLE IF NOT EXISTS schema_migrations (
+            version VARCHAR(200) PRIMARY KEY,
+            applied_at TIMESTAMP NOT NULL DEFAULT NOW()
+        )
+    """))
+    conn.commit()
+    return set(conn.execute(text("SELECT version FROM schema_migrations")).scalars())
+
+
+def migrate(conn):
+    """Apply pending migrations in order; returns the versions applied"""
+    done = applied_versions(conn)
+    applied = []
+    for name in migration_files():
+        if name in done:
+            continue
+        with open(os.path.join(MIGRATIONS_DIR, name), encoding='utf-8') as f:
+            conn.exec_driver_sql(f.read())
+        conn.execute(text("INSERT INTO schema_migrations (version) VALUES (:version)"),
+                     {"version": name})
+        conn.commit()
+        applied.append(name)
+    return applied
+
+
+def sample_params(conn):
+    """Real ids for the EXPLAINs, so the planner sees typical selectivity"""
+    row = conn.execute(text("""
+        SELECT t.track_id, t.genre_name, at.artist_id
+        FROM Track t JOIN ArtistTrack at ON at.track_id = t.track_id
+        ORDER BY t.track_popularity DESC NULLS LAST
+        LIMIT 1
+    """)).first()
+    user = conn.execute(text('SELECT user_id, user_email FROM "User" LIMIT 1')).first()
+    return {
+        "track_id": row.track_id if row else "",
+        "genre_name": row.genre_name if row else "",
+        "artist_id": row.artist_id if row else None,
+        "tracks": [row.track_id] if row else [],
+        "artists": [str(row.artist_id)] if row else [],
+        "genres": [row.genre_name] if row else [],
+        "user_id": user.user_id if user else 0,
+        "email": user.user_email if user else "",
+        "term": "%love%",
+        "limit": 11,
+        "after_pop": 50,
+        "after_id": row.track_id if row else "",
+    }
+
+
+def _scans(plan, found):
+    if plan.get('Node Type') == 'Seq Scan':
+        found.append(plan.get('Relation Name', '?'))
+    for child in plan.get('Plans', ()):
+        _scans(child, found)
+    return found
+
+
+def verify(conn, force_index=False):
+    """EXPLAIN every route query; returns [(route, [seq scanned tables])]"""
+    params = sample_params(conn)
+    if force_index:
+        conn.execute(text("SET enable_seqscan = off"))
+    report = []
+    for route, statement in ROUTE_QUERIES:
+        plan = conn.execute(text("EXPLAIN (FORMAT JSON) " + statement.text), statement.bind(params)).scalar()
+        report.append((route, _scans(plan[0]['Plan'], [])))
+    conn.rollback()
+    return report
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Apply migrations or verify query plans")
+    parser.add_argument('command', nargs='?', default='migrate', choices=['migrate', 'status', 'verify'])
+    parser.add_argument('--url', help="database URL (defaults to the server's)")
+    parser.add_argument('--force-index', action='store_true', help="verify with enable_seqscan = off")
+    args = parser.parse_args()
+
+    if args.url:
+        engine = create_engine(args.url)
+    else:
+        engine = server.engine
+
+    with engine.connect() as conn:
+        if args.command == 'migrate':
+            applied = migrate(conn)
+            print("\n".join(f"applied {name}" for name in applied) or "Nothing to apply")
+
+        elif args.command == 'status':
+            done = applied_versions(conn)
+            for name in migration_files():
+                print(f"{'applied' if name in done else 'pending'}  {name}")
+
+        else:
+            track_scans = 0
+            for route, tables in verify(conn, args.force_index):
+                scans = ", ".join(tables) if tables else "no sequential scans"
+                print(f"{route:<28} {scans}")
+                track_scans += sum(1 for table in tables if table.lower() == 'track')
+            if track_scans:
+                print(f"{track_scans} sequential scan(s) on Track")
+                sys.exit(1)
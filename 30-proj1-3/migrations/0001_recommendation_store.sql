@@ -0,0 +1,21 @@
+-- Tables behind the precomputed recommendation store (rec_store.py), for
+-- databases created from sql.txt before they were added there.
+CREATE TABLE IF NOT EXISTS RecommendationState (
+    user_id INT PRIMARY KEY,
+    pref_version INT NOT NULL DEFAULT 1,
+    built_version INT NOT NULL DEFAULT 0,
+    built_at TIMESTAMP,
+    FOREIGN KEY (user_id) REFERENCES "User"(user_id) ON DELETE CASCADE
+);
+
+CREATE TABLE IF NOT EXISTS UserRecommendation (
+    user_id INT NOT NULL,
+    rank INT NOT NULL,
+    track_id VARCHAR(100) NOT NULL,
+    track_name TEXT NOT NULL,
+    reason TEXT NOT NULL,
+    rec_type VARCHAR(10) NOT NULL,
+    PRIMARY KEY (user_id, rank),
+    FOREIGN KEY (user_id) REFERENCES "User"(user_id) ON DELETE CASCADE,
+    FOREIGN KEY (track_id) REFERENCES Track(track_id) ON DELETE CASCADE
+);
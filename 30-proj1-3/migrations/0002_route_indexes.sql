@@ -0,0 +1,22 @@
+-- B-tree indexes for the filters and orderings used by the routes.
+
+-- genre_detail top-10 and genre-based recommendations
+CREATE INDEX IF NOT EXISTS track_genre_popularity_idx
+    ON Track (genre_name, track_popularity DESC);
+
+-- album-based recommendations join Track back on album_id
+CREATE INDEX IF NOT EXISTS track_album_popularity_idx
+    ON Track (album_id, track_popularity DESC);
+
+-- catalog-wide popularity ordering
+CREATE INDEX IF NOT EXISTS track_popularity_idx
+    ON Track (track_popularity DESC, track_id);
+
+-- ArtistTrack's primary key is (artist_id, track_id); track_detail and the
+-- recommendation joins look rows up by track_id
+CREATE INDEX IF NOT EXISTS artisttrack_track_idx
+    ON ArtistTrack (track_id, artist_id);
+
+-- login looks users up by email
+CREATE INDEX IF NOT EXISTS user_email_idx
+    ON "User" (user_email);
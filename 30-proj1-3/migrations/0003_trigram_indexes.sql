@@ -0,0 +1,15 @@
+-- pg_trgm GIN indexes so the leading-wildcard ILIKE in /search (and its
+-- fallback query) can use an index instead of scanning each table.
+CREATE EXTENSION IF NOT EXISTS pg_trgm;
+
+CREATE INDEX IF NOT EXISTS track_name_trgm_idx
+    ON Track USING gin (track_name gin_trgm_ops);
+
+CREATE INDEX IF NOT EXISTS artist_name_trgm_idx
+    ON Artist USING gin (artist_name gin_trgm_ops);
+
+CREATE INDEX IF NOT EXISTS album_name_trgm_idx
+    ON Album USING gin (album_name gin_trgm_ops);
+
+CREATE INDEX IF NOT EXISTS genre_name_trgm_idx
+    ON Genre USING gin (genre_name gin_trgm_ops);
@@ -0,0 +1,9 @@
+-- Keyset pagination of the genre track listing. The listing is ordered by
+-- (COALESCE(track_popularity, -1) DESC, track_id DESC) so every page,
+-- including the ones after the first, is a range scan of this index.
+CREATE INDEX IF NOT EXISTS track_genre_keyset_idx
+    ON Track (genre_name, (COALESCE(track_popularity, -1)) DESC, track_id DESC);
+
+-- The keyset index leads with genre_name too, so it also serves every
+-- lookup the (genre_name, track_popularity DESC) index from 0002 did
+DROP INDEX IF EXISTS track_genre_popularity_idx;
@@ -0,0 +1,144 @@
+-- Materialized top tracks per genre and per artist (top_tracks.py).
+--
+-- Rows are kept in listing order, (COALESCE(track_popularity, -1) DESC,
+-- track_id DESC), so the first page of /genre and /artist is a primary key
+-- range read. Statement-level triggers on Track and ArtistTrack record the
+-- genres and artists whose lists a change may affect in TopTrackDirty;
+-- `python top_tracks.py refresh` rebuilds just those keys.
+
+CREATE TABLE IF NOT EXISTS GenreTopTrack (
+    genre_name VARCHAR(100) NOT NULL,
+    rank INT NOT NULL,
+    track_id VARCHAR(100) NOT NULL,
+    track_name TEXT NOT NULL,
+    track_popularity INT,
+    PRIMARY KEY (genre_name, rank),
+    FOREIGN KEY (genre_name) REFERENCES Genre(genre_name) ON DELETE CASCADE,
+    FOREIGN KEY (track_id) REFERENCES Track(track_id) ON DELETE CASCADE
+);
+
+CREATE TABLE IF NOT EXISTS ArtistTopTrack (
+    artist_id UUID NOT NULL,
+    rank INT NOT NULL,
+    track_id VARCHAR(100) NOT NULL,
+    track_name TEXT NOT NULL,
+    track_popularity INT,
+    PRIMARY KEY (artist_id, rank),
+    FOREIGN KEY (artist_id) REFERENCES Artist(artist_id) ON DELETE CASCADE,
+    FOREIGN KEY (track_id) REFERENCES Track(track_id) ON DELETE CASCADE
+);
+
+CREATE TABLE IF NOT EXISTS TopTrackDirty (
+    scope VARCHAR(10) NOT NULL,
+    key TEXT NOT NULL,
+    marked_at TIMESTAMP NOT NULL DEFAULT NOW(),
+    PRIMARY KEY (scope, key)
+);
+
+CREATE TABLE IF NOT EXISTS TopTrackState (
+    scope VARCHAR(10) PRIMARY KEY,
+    top_n INT NOT NULL,
+    refreshed_at TIMESTAMP,
+    full_refreshed_at TIMESTAMP
+);
+
+CREATE OR REPLACE FUNCTION top_tracks_mark_track() RETURNS trigger AS $$
+BEGIN
+    IF TG_OP = 'INSERT' THEN
+        INSERT INTO TopTrackDirty (scope, key)
+        SELECT DISTINCT 'genre', genre_name FROM new_rows
+        ON CONFLICT DO NOTHING;
+    ELSIF TG_OP = 'DELETE' THEN
+        -- ArtistTrack rows go with the track (ON DELETE CASCADE), which
+        -- marks the artists
+        INSERT INTO TopTrackDirty (scope, key)
+        SELECT DISTINCT 'genre', genre_name FROM old_rows
+        ON CONFLICT DO NOTHING;
+    ELSE
+        WITH changed AS (
+            SELECT n.track_id, n.genre_name AS new_genre, o.genre_name AS old_genre
+            FROM new_rows n
+            JOIN old_rows o ON o.track_id = n.track_id
+            WHERE (n.track_popularity, n.track_name, n.genre_name)
+                  IS DISTINCT FROM (o.track_popularity, o.track_name, o.genre_name)
+        )
+        INSERT INTO TopTrackDirty (scope, key)
+        SELECT 'genre', new_genre FROM changed
+        UNION SELECT 'genre', old_genre FROM changed
+        UNION SELECT 'artist', at.artist_id::TEXT
+              FROM changed JOIN ArtistTrack at ON at.track_id = changed.track_id
+        ON CONFLICT DO NOTHING;
+    END IF;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE FUNCTION top_tracks_mark_artisttrack() RETURNS trigger AS $$
+BEGIN
+    IF TG_OP = 'INSERT' THEN
+        INSERT INTO TopTrackDirty (scope, key)
+        SELECT DISTINCT 'artist', artist_id::TEXT FROM new_rows
+        ON CONFLICT DO NOTHING;
+    ELSE
+        INSERT INTO TopTrackDirty (scope, key)
+        SELECT DISTINCT 'artist', artist_id::TEXT FROM old_rows
+        ON CONFLICT DO NOTHING;
+    END IF;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+-- Transition tables allow only one event per trigger
+DROP TRIGGER IF EXISTS top_tracks_track_insert ON Track;
+CREATE TRIGGER top_tracks_track_insert AFTER INSERT ON Track
+    REFERENCING NEW TABLE AS new_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION top_tracks_mark_track();
+
+DROP TRIGGER IF EXISTS top_tracks_track_update ON Track;
+CREATE TRIGGER top_tracks_track_update AFTER UPDATE ON Track
+    REFERENCING OLD TABLE AS old_rows NEW TABLE AS new_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION top_tracks_mark_track();
+
+DROP TRIGGER IF EXISTS top_tracks_track_delete ON Track;
+CREATE TRIGGER top_tracks_track_delete AFTER DELETE ON Track
+    REFERENCING OLD TABLE AS old_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION top_tracks_mark_track();
+
+DROP TRIGGER IF EXISTS top_tracks_artisttrack_insert ON ArtistTrack;
+CREATE TRIGGER top_tracks_artisttrack_insert AFTER INSERT ON ArtistTrack
+    REFERENCING NEW TABLE AS new_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION top_tracks_mark_artisttrack();
+
+DROP TRIGGER IF EXISTS top_tracks_artisttrack_delete ON ArtistTrack;
+CREATE TRIGGER top_tracks_artisttrack_delete AFTER DELETE ON ArtistTrack
+    REFERENCING OLD TABLE AS old_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION top_tracks_mark_artisttrack();
+
+-- Initial fill with top_tracks.TOP_N (50) rows per key; later changes go
+-- through TopTrackDirty and top_tracks.py refresh
+INSERT INTO GenreTopTrack (genre_name, rank, track_id, track_name, track_popularity)
+SELECT genre_name, rank, track_id, track_name, track_popularity
+FROM (
+    SELECT t.genre_name, t.track_id, t.track_name, t.track_popularity,
+           row_number() OVER (PARTITION BY t.genre_name
+                              ORDER BY COALESCE(t.track_popularity, -1) DESC, t.track_id DESC) AS rank
+    FROM Track t
+) ranked
+WHERE rank <= 50
+ON CONFLICT DO NOTHING;
+
+INSERT INTO ArtistTopTrack (artist_id, rank, track_id, track_name, track_popularity)
+SELECT artist_id, rank, track_id, track_name, track_popularity
+FROM (
+    SELECT at.artist_id, t.track_id, t.track_name, t.track_popularity,
+           row_number() OVER (PARTITION BY at.artist_id
+                              ORDER BY COALESCE(t.track_popularity, -1) DESC, t.track_id DESC) AS rank
+    FROM ArtistTrack at
+    JOIN Track t ON t.track_id = at.track_id
+) ranked
+WHERE rank <= 50
+ON CONFLICT DO NOTHING;
+
+INSERT INTO TopTrackState (scope, top_n, refreshed_at, full_refreshed_at)
+VALUES ('genre', 50, NOW(), NOW()), ('artist', 50, NOW(), NOW())
+ON CONFLICT DO NOTHING;
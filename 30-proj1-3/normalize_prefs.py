@@ -0,0 +1,179 @@
+"""
+One-off normalizer from the legacy UserPreference text columns to the
+UserTrackPreference / UserArtistPreference / UserGenrePreference tables.
+
+liked_genres, liked_artists and liked_tracks hold comma-separated names,
+and many track and artist names contain commas themselves ("Piano Concerto
+No. 2 in C Minor, Op. 18: ..."), so a plain split is wrong. Each column is
+split on commas and then matched greedily against an in-memory
+name -> id hash index built from Track / Artist / Genre, trying the longest
+run of pieces that forms a known name first. Where a name maps to several
+rows the most popular one wins.
+
+Resolved pairs are written with one INSERT ... SELECT unnest(...) per
+table, ON CONFLICT DO NOTHING, so the tool can be re-run safely; users
+that gained rows are marked dirty for rec_store.
+
+    python normalize_prefs.py [--url URL] [--dry-run] [--show-unresolved 20]
+"""
+import argparse
+import re
+from collections import Counter
+
+from sqlalchemy import create_engine, text
+
+import rec_store
+
+_COMMA = re.compile(r"\s*,\s*")
+
+# Best row first, so the first id seen for a name is the one kept
+NAME_QUERIES = {
+    "track": text("""
+        SELECT track_name AS name, track_id AS id FROM Track
+        ORDER BY track_popularity DESC NULLS LAST, track_id
+    """),
+    "artist": text("""
+        SELECT artist_name AS name, artist_id::TEXT AS id FROM Artist
+        ORDER BY artist_popularity_score DESC NULLS LAST, artist_id
+    """),
+    "genre": text("SELECT genre_name AS name, genre_name AS id FROM Genre ORDER BY genre_name"),
+}
+
+COLUMNS = {"genre": "liked_genres", "artist": "liked_artists", "track": "liked_tracks"}
+
+INSERTS = {
+    "track": text("""
+        INSERT INTO UserTrackPreference (user_id, track_id)
+        SELECT * FROM unnest(CAST(:user_ids AS INT[]), CAST(:ids AS VARCHAR[]))
+        ON CONFLICT DO NOTHING
+        RETURNING user_id
+    """),
+    "artist": text("""
+        INSERT INTO UserArtistPreference (user_id, artist_id)
+        SELECT * FROM unnest(CAST(:user_ids AS INT[]), CAST(:ids AS UUID[]))
+        ON CONFLICT DO NOTHING
+        RETURNING user_id
+    """),
+    "genre": text("""
+        INSERT INTO UserGenrePreference (user_id, genre_name)
+        SELECT * FROM unnest(CAST(:user_ids AS INT[]), CAST(:ids AS VARCHAR[]))
+        ON CONFLICT DO NOTHING
+        RETURNING user_id
+    """),
+}
+
+
+def name_key(name):
+    return _COMMA.sub(", ", name.strip()).casefold()
+
+
+class NameIndex:
+    """Normalized name -> id, plus the most comma pieces any name has"""
+
+    def __init__(self, rows):
+        self.ids = {}
+        self.ambiguous = Counter()
+        self.max_parts = 1
+        for name, item_id in rows:
+            if not name:
+                continue
+            key = name_key(name)
+            if key in self.ids:
+                self.ambiguous[key] += 1
+                continue
+            self.ids[key] = item_id
+            self.max_parts = max(self.max_parts, key.count(", ") + 1)
+
+    def __len__(self):
+        return len(self.ids)
+
+    def resolve(self, value):
+        """(ids, unresolved pieces) for one comma-separated column value"""
+        parts = [part for part in _COMMA.split(value.strip()) if part] if value else []
+        ids, unresolved = [], []
+        i = 0
+        while i < len(parts):
+            for j in range(min(len(parts), i + self.max_parts), i, -1):
+                item_id = self.ids.get(", ".join(parts[i:j]).casefold())
+                if item_id is not None:
+                    ids.append(item_id)
+                    i = j
+                    break
+            else:
+                unresolved.append(parts[i])
+                i += 1
+        return ids, unresolved
+
+
+def build_indexes(conn):
+    return {kind: NameIndex(conn.execute(query).tuples()) for kind, query in NAME_QUERIES.items()}
+
+
+def normalize(conn, write=True):
+    """Resolve every UserPreference row and write the join tables.
+
+    Returns a report: per kind, names resolved, rows inserted, ambiguous
+    names hit, and the unresolved (user_id, name) pairs.
+    """
+    indexes = build_indexes(conn)
+    pairs = {kind: set() for kind in COLUMNS}
+    report = {kind: {"indexed": len(indexes[kind]), "resolved": 0, "inserted": 0,
+                     "ambiguous": 0, "unresolved": []} for kind in COLUMNS}
+
+    rows = conn.execute(text("""
+        SELECT user_id, liked_genres, liked_artists, liked_tracks
+        FROM UserPreference ORDER BY user_id
+    """), execution_options={"yield_per": 1000}).mappings()
+    for row in rows:
+        for kind, column in COLUMNS.items():
+            ids, unresolved = indexes[kind].resolve(row[column])
+            stats = report[kind]
+            stats["resolved"] += len(ids)
+            stats["unresolved"] += [(row["user_id"], name) for name in unresolved]
+            for item_id in ids:
+                pairs[kind].add((row["user_id"], item_id))
+
+    for kind, index in indexes.items():
+        ambiguous_ids = {index.ids[key] for key in index.ambiguous}
+        report[kind]["ambiguous"] = sum(1 for _, item_id in pairs[kind] if item_id in ambiguous_ids)
+
+    if not write:
+        conn.rollback()
+        return report
+
+    changed_users = set()
+    for kind, kind_pairs in pairs.items():
+        if not kind_pairs:
+            continue
+        user_ids, ids = zip(*sorted(kind_pairs))
+        inserted = conn.execute(INSERTS[kind], {"user_ids": list(user_ids), "ids": list(ids)}).scalars().all()
+        report[kind]["inserted"] = len(inserted)
+        changed_users.update(inserted)
+    if changed_users:
+        conn.execute(rec_store.MARK_DIRTY.clause, [{"user_id": user_id} for user_id in sorted(changed_users)])
+    conn.commit()
+    return report
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Move UserPreference name lists into the ID join tables")
+    parser.add_argument("--url", help="database URL (defaults to the server's)")
+    parser.add_argument("--dry-run", action="store_true", help="resolve and report without writing")
+    parser.add_argument("--show-unresolved", type=int, default=20, metavar="N",
+                        help="unresolved names to list per kind")
+    args = parser.parse_args()
+
+    if args.url:
+        engine = create_engine(args.url)
+    else:
+        from server import engine
+
+    with engine.connect() as conn:
+        report = normalize(conn, write=not args.dry_run)
+
+    for kind, stats in report.items():
+        print(f"{kind:<7} indexed {stats['indexed']:>7}  resolved {stats['resolved']:>6}  "
+              f"inserted {stats['inserted']:>6}  ambiguous {stats['ambiguous']:>4}  "
+              f"unresolved {len(stats['unresolved']):>4}")
+        for user_id, name in stats["unresolved"][:args.show_unresolved]:
+            print(f"    user {user_id}: {name!r}")
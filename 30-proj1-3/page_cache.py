@@ -0,0 +1,65 @@
+"""
+Conditional GET and rendered-fragment caching for the detail pages.
+
+A page's ETag is a digest of the versions of everything it shows: the
+PostgreSQL row version (xmin, which changes on every UPDATE) of each
+catalog row read by the detail query, a digest of the track list, and the
+ids in the in-memory panels. The detail caches keep those versions with
+the rows, so a revalidation whose If-None-Match still matches is answered
+with a 304 without a query or a render.
+
+Pages carry no Last-Modified: none of the versions is a time, and a
+clock reading taken when a process first saw an ETag would differ between
+workers and reset on every reload. Browsers revalidate with If-None-Match
+alone. Responses carry Cache-Control: private, no-cache so browsers
+revalidate every view.
+
+fragment() keeps rendered template blocks, such as the track lists and
+the recommendation list, keyed by a version of their data, so even a full
+200 response only renders the page around them.
+"""
+import hashlib
+
+from flask import make_response, render_template, request
+from markupsafe import Markup
+
+import entity_cache
+
+
+def version_of(*parts):
+    """Short stable digest of any repr()-able values"""
+    return hashlib.sha1(repr(parts).encode("utf-8")).hexdigest()[:20]
+
+
+def etag(page, key, *versions):
+    """ETag of one page built from `versions`"""
+    return version_of(page, key, *versions)
+
+
+def respond(etag, render):
+    """304 for a current client copy, otherwise the rendered page, with its ETag"""
+    if request.if_none_match.contains(etag):
+        response = make_response("", 304)
+    else:
+        response = make_response(render())
+    response.set_etag(etag)
+    response.cache_control.private = True
+    response.cache_control.no_cache = True
+    return response
+
+
+def fragment(block, key, version, template, context):
+    """Rendered `template` for (block, key, version), rendering only on a miss.
+
+    `context` is a callable returning the template variables, so the data
+    behind a cached block is not even fetched. A None version (data with
+    no known version) is rendered without caching.
+    """
+    if version is None:
+        return Markup(render_template(template, **context()))
+    cache_key = (block, key, version)
+    html = entity_cache.fragments.get(cache_key)
+    if html is None:
+        html = Markup(render_template(template, **context()))
+        entity_cache.fragments.put(cache_key, html)
+    return html
@@ -0,0 +1,46 @@
+"""
+Opaque continuation tokens for keyset pagination.
+
+A token is the sort key of the last row on the previous page, serialized
+as JSON and base64url encoded. Pages then start with a "key greater than
+the token" condition instead of an OFFSET, so page N costs the same as
+page 1.
+"""
+import base64
+import binascii
+import json
+
+
+class InvalidCursor(ValueError):
+    pass
+
+
+def encode_cursor(*values):
+    raw = json.dumps(values, separators=(",", ":")).encode("utf-8")
+    return base64.urlsafe_b64encode(raw).decode("ascii").rstrip("=")
+
+
+def decode_cursor(token, size=None):
+    """Key tuple from a token; None for a missing token (first page)"""
+    if not token:
+        return None
+    try:
+        raw = base64.urlsafe_b64decode(token + "=" * (-len(token) % 4))
+        values = json.loads(raw.decode("utf-8"))
+    except (binascii.Error, ValueError, UnicodeDecodeError):
+        raise InvalidCursor("malformed cursor")
+    if not isinstance(values, list) or (size is not None and len(values) != size):
+        raise InvalidCursor("cursor does not match this listing")
+    return tuple(values)
+
+
+def page_of(rows, limit, key):
+    """Split rows fetched with LIMIT limit + 1 into (page, next token).
+
+    `key` maps a row to the values its listing is ordered by; the token is
+    None when there is no further page.
+    """
+    page = list(rows[:limit])
+    if len(rows) > limit and page:
+        return page, encode_cursor(*key(page[-1]))
+    return page, None
@@ -0,0 +1,329 @@
+"""
+Production entry point: a prefork master running the app in N worker
+processes on one shared listening socket.
+
+The master imports the server (app, routes, registered statements) and
+loads the read-only catalog snapshot (catalog.py), the search and
+typeahead indexes and the item-item model before forking, so the workers
+share those pages copy-on-write instead of each building its own copy;
+gc.freeze() keeps the collector from touching them afterwards. The master
+then holds no database connections: every worker opens its own pool. Each
+worker runs a WSGI server (one request at a time, or on threads with
+--threaded) accepting from the socket the master opened, so requests are
+spread over all cores.
+
+    python prefork.py [--workers N] [--threaded] [HOST] [PORT]
+
+    WEB_WORKERS             worker processes (default: one per CPU)
+    WEB_GRACEFUL_TIMEOUT    seconds a stopping worker may spend finishing
+                            its in-flight requests before it is killed
+                            (default 30)
+    WEB_KEEPALIVE           seconds an idle keep-alive connection is kept
+                            open (default 5)
+    WEB_RELOAD_INTERVAL     seconds between automatic reloads (default 0:
+                            only on SIGHUP); past CATALOG_MAX_AGE the
+                            workers read live rows instead of the snapshot,
+                            so this is only worth setting when a reload
+                            (a full preload and a new set of workers) is
+                            cheaper than those reads
+
+Signals to the master:
+
+    HUP         graceful reload: load a fresh snapshot, start a new set of
+                workers from it, then stop the old ones; the socket stays
+                open throughout, so no connection is refused
+    USR1        a worker took a /cache/invalidate: forwarded to every worker
+    TERM, INT   graceful shutdown
+
+A worker that dies is replaced. Code changes need a restart.
+
+Each worker has its own caches, so the worker that takes a
+/cache/invalidate appends it to an invalidation log in the master's state
+directory and signals the master, which sends USR1 to every worker; each
+worker then applies the entries it has not seen yet. Workers also publish
+their /metrics there (metrics.share), so a scrape reports the whole
+server whichever worker answers it.
+"""
+import argparse
+import gc
+import json
+import os
+import shutil
+import signal
+import socket
+import sys
+import tempfile
+import threading
+import time
+
+from werkzeug.serving import WSGIRequestHandler, make_server
+
+import catalog
+import item_cf
+import metrics
+import search_index
+import server
+import suggest
+
+WORKERS = int(os.environ.get("WEB_WORKERS", os.cpu_count() or 1))
+GRACEFUL_TIMEOUT = float(os.environ.get("WEB_GRACEFUL_TIMEOUT", 30))
+KEEPALIVE = float(os.environ.get("WEB_KEEPALIVE", 5))
+RELOAD_INTERVAL = float(os.environ.get("WEB_RELOAD_INTERVAL", 0))
+BACKLOG = 2048
+
+
+class RequestHandler(WSGIRequestHandler):
+    # Idle keep-alive connections time out, so clients that never hang up
+    # cannot hold a stopping worker open
+    timeout = KEEPALIVE
+
+
+def listen(host, port):
+    family = socket.AF_INET6 if ":" in host else socket.AF_INET
+    sock = socket.socket(family, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind((host, port))
+    sock.listen(BACKLOG)
+    return sock
+
+
+class InvalidationLog:
+    """/cache/invalidate calls taken by any worker, one JSON line each"""
+
+    def __init__(self, path, offset=0):
+        self.path = path
+        self.offset = offset        # entries before it are applied
+        self.lock = threading.Lock()
+
+    def size(self):
+        try:
+            return os.path.getsize(self.path)
+        except FileNotFoundError:
+            return 0
+
+    def append(self, kind, key):
+        line = json.dumps({"kind": kind, "key": key}) + "\n"
+        # One O_APPEND write, so lines from concurrent workers never interleave
+        fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o600)
+        try:
+            os.write(fd, line.encode())
+        finally:
+            os.close(fd)
+
+    def apply_new(self):
+        """Invalidate this process's caches for the entries past the offset"""
+        with self.lock:
+            try:
+                with open(self.path, "rb") as f:
+                    f.seek(self.offset)
+                    data = f.read()
+            except FileNotFoundError:
+                return
+            # A line still being written is read next time
+            data = data[:data.rfind(b"\n") + 1]
+            self.offset += len(data)
+            for line in data.splitlines():
+                entry = json.loads(line)
+                server.invalidate_caches(entry["kind"], entry["key"])
+
+
+def preload():
+    """Load the shared in-memory data in the master, then close its connections"""
+    started = time.perf_counter()
+    with server.engine.connect() as conn:
+        catalog.snapshot.load(conn)
+        search_index.index.load(conn)
+        item_cf.index.load(conn)
+        suggest.index.load(conn)
+    # Connections must not be inherited by the workers
+    for engine in [server.engine, *server.replicas, server.export_engine]:
+        engine.dispose()
+    gc.collect()
+    gc.freeze()
+    print(f"Preloaded in {time.perf_counter() - started:.2f}s: {catalog.snapshot.stats()}")
+
+
+def run_worker(sock, threaded, state_dir, log_offset):
+    """Serve from the inherited socket until SIGTERM, then drain and exit"""
+    log = InvalidationLog(os.path.join(state_dir, "invalidations.log"), log_offset)
+    master = os.getppid()
+
+    def broadcast(kind, key):
+        log.append(kind, key)
+        os.kill(master, signal.SIGUSR1)
+
+    def invalidated(signum, frame):
+        # The caches' locks may be held by the interrupted code
+        threading.Thread(target=log.apply_new).start()
+
+    signal.signal(signal.SIGUSR1, invalidated)
+    # Invalidations since the master loaded the snapshot this worker shares
+    log.apply_new()
+    server.broadcast_invalidation = broadcast
+    metrics.share(os.path.join(state_dir, "metrics"))
+
+    srv = make_server(*sock.getsockname()[:2], server.app, threaded=threaded,
+                      request_handler=RequestHandler, fd=sock.fileno())
+    # Track request threads so server_close() waits for them
+    srv.daemon_threads = False
+
+    def stop(signum, frame):
+        # shutdown() blocks until serve_forever() returns, so not from here
+        threading.Thread(target=srv.shutdown).start()
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGHUP, signal.SIG_IGN)
+
+    srv.serve_forever()
+    srv.server_close()
+    metrics.publish()
+    for engine in [server.engine, *server.replicas, server.export_engine]:
+        engine.dispose()
+
+
+class Master:
+    def __init__(self, sock, workers, threaded):
+        self.sock = sock
+        self.size = workers
+        self.threaded = threaded
+        self.workers = {}           # pid -> generation
+        self.stopping = {}          # pid -> kill deadline
+        self.generation = 0
+        self.reload_requested = False
+        self.shutdown_requested = False
+        self.invalidation_requested = False
+        self.loaded_at = time.monotonic()
+        # Invalidation log and worker metrics; the snapshot preloaded before
+        # the master started predates every entry in the new log
+        self.state_dir = tempfile.mkdtemp(prefix="prefork-")
+        os.mkdir(os.path.join(self.state_dir, "metrics"))
+        self.log = InvalidationLog(os.path.join(self.state_dir, "invalidations.log"))
+
+    def spawn(self):
+        # Unflushed output would be written again by the child
+        sys.stdout.flush()
+        pid = os.fork()
+        if pid == 0:
+            status = 0
+            try:
+                run_worker(self.sock, self.threaded, self.state_dir, self.log.offset)
+            except BaseException as e:
+                print(f"Worker {os.getpid()} error: {str(e)}")
+                status = 1
+            finally:
+                # Skip the master's atexit handlers
+                sys.stdout.flush()
+                os._exit(status)
+        self.workers[pid] = self.generation
+        return pid
+
+    def stop(self, pids):
+        deadline = time.monotonic() + GRACEFUL_TIMEOUT
+        for pid in pids:
+            if pid not in self.stopping:
+                self.stopping[pid] = deadline
+                self._signal(pid, signal.SIGTERM)
+
+    def _signal(self, pid, signum):
+        try:
+            os.kill(pid, signum)
+        except ProcessLookupError:
+            pass
+
+    def reap(self):
+        """Forget exited workers; returns how many current ones died unexpectedly"""
+        died = 0
+        while self.workers:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                break
+            if pid == 0:
+                break
+            generation = self.workers.pop(pid, None)
+            try:
+                metrics.retire(os.path.join(self.state_dir, "metrics"), pid)
+            except Exception as e:
+                print(f"Worker {pid} metrics error: {str(e)}")
+            if self.stopping.pop(pid, None) is None:
+                print(f"Worker {pid} exited unexpectedly (status {status})")
+                died += generation == self.generation
+        return died
+
+    def reload(self):
+        """Fresh snapshot and workers; the old generation drains in the background"""
+        # The new snapshot reflects every invalidation logged before it loads
+        offset = self.log.size()
+        try:
+            preload()
+        except Exception as e:
+            print(f"Reload error: {str(e)}")
+            return
+        finally:
+            # A failed reload is retried at the next interval, not at once
+            self.loaded_at = time.monotonic()
+        self.log.offset = offset
+        old = [pid for pid, generation in self.workers.items() if generation == self.generation]
+        self.generation += 1
+        for _ in range(self.size):
+            self.spawn()
+        self.stop(old)
+        print(f"Reloaded: generation {self.generation}, stopping {len(old)} old workers")
+
+    def run(self):
+        signal.signal(signal.SIGHUP, lambda signum, frame: setattr(self, "reload_requested", True))
+        signal.signal(signal.SIGUSR1, lambda signum, frame: setattr(self, "invalidation_requested", True))
+        for signum in (signal.SIGTERM, signal.SIGINT):
+            signal.signal(signum, lambda signum, frame: setattr(self, "shutdown_requested", True))
+
+        for _ in range(self.size):
+            self.spawn()
+        print(f"Master {os.getpid()} serving on {self.sock.getsockname()[:2]} "
+              f"with {self.size} workers")
+
+        while True:
+            if self.invalidation_requested:
+                self.invalidation_requested = False
+                for pid in list(self.workers):
+                    self._signal(pid, signal.SIGUSR1)
+            died = self.reap()
+            if self.shutdown_requested:
+                self.stop(list(self.workers))
+                if not self.workers:
+                    break
+            elif self.reload_requested or (
+                    RELOAD_INTERVAL and time.monotonic() - self.loaded_at > RELOAD_INTERVAL):
+                self.reload_requested = False
+                self.reload()
+            elif died:
+                # Replace crashed workers, but do not fork in a tight loop
+                # when they die on startup
+                time.sleep(1)
+                for _ in range(died):
+                    self.spawn()
+
+            now = time.monotonic()
+            for pid, deadline in list(self.stopping.items()):
+                if now > deadline:
+                    print(f"Worker {pid} did not stop in {GRACEFUL_TIMEOUT:.0f}s, killing it")
+                    self._signal(pid, signal.SIGKILL)
+                    self.stopping[pid] = float("inf")
+            time.sleep(0.2)
+
+        self.sock.close()
+        shutil.rmtree(self.state_dir, ignore_errors=True)
+        print("Stopped")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run the server as a prefork master with N workers")
+    parser.add_argument("--workers", type=int, default=WORKERS, help="worker processes")
+    parser.add_argument("--threaded", action="store_true", help="serve each worker's requests on threads")
+    parser.add_argument("host", nargs="?", default="0.0.0.0")
+    parser.add_argument("port", nargs="?", type=int, default=8111)
+    args = parser.parse_args()
+
+    sock = listen(args.host, args.port)
+    preload()
+    Master(sock, args.workers, args.threaded).run()
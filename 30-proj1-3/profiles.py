@@ -0,0 +1,127 @@
+"""
+Per-user preference profiles: everything a user likes, cached in memory.
+
+A profile maps each kind of preference to the liked ids and their names
+(track_id -> track name, artist UUID -> artist name, genre name -> genre
+name) and records the user's pref_version from RecommendationState. The
+preference pages, exclusion filters and the recommendation builder read
+it instead of joining the three preference tables on every call.
+
+Every preference change bumps pref_version in its own transaction
+(rec_store.mark_dirty), so a cached profile is current exactly when its
+version has caught up with the database's. That keeps the separate caches
+of all server workers coherent: a worker that did not make a change sees
+the version move on its next lookup (one primary-key read) and reloads
+the profile with one query. The handlers that make a change apply it to
+their own worker's profile in place (apply()), so that worker never
+reloads.
+
+Profiles are replaced, never mutated, so readers on other threads always
+see a consistent one.
+"""
+import threading
+
+import entity_cache
+import statements
+
+KINDS = ("track", "artist", "genre")
+
+PREF_VERSION = statements.register("pref_version", """
+    SELECT pref_version FROM RecommendationState
+    WHERE user_id = :user_id
+""", user_id="int")
+
+PROFILE_QUERY = statements.register("user_profile", """
+    SELECT 'track' AS kind, t.track_id AS id, t.track_name AS name
+    FROM UserTrackPreference utp
+    JOIN Track t ON t.track_id = utp.track_id
+    WHERE utp.user_id = :user_id
+    UNION ALL
+    SELECT 'artist', a.artist_id::TEXT, a.artist_name
+    FROM UserArtistPreference uap
+    JOIN Artist a ON a.artist_id = uap.artist_id
+    WHERE uap.user_id = :user_id
+    UNION ALL
+    SELECT 'genre', genre_name, genre_name
+    FROM UserGenrePreference
+    WHERE user_id = :user_id
+""", user_id="int")
+
+_CHECK = object()
+_lock = threading.Lock()
+
+
+class Profile:
+    """What one user likes as of pref_version `version` (None: never changed)"""
+
+    __slots__ = ("version", "liked")
+
+    def __init__(self, version, liked=None):
+        self.version = version
+        self.liked = liked or {kind: {} for kind in KINDS}     # kind -> {id: name}
+
+    @property
+    def tracks(self):
+        return self.liked["track"]
+
+    @property
+    def artists(self):
+        return self.liked["artist"]
+
+    @property
+    def genres(self):
+        return self.liked["genre"]
+
+    def likes(self, kind, item_id):
+        return item_id in self.liked[kind]
+
+    def is_current(self, version):
+        # Versions only grow; a profile a handler already advanced is newer
+        # than what a lagging replica reports
+        return (self.version or 0) >= (version or 0)
+
+
+def load(conn, user_id, version):
+    """Profile read from the database; `version` must be read before it"""
+    profile = Profile(version)
+    for kind, item_id, name in statements.execute(conn, PROFILE_QUERY, {"user_id": user_id}):
+        profile.liked[kind][item_id] = name
+    return profile
+
+
+def get(conn, user_id, version=_CHECK):
+    """The user's current profile.
+
+    Pass `version` when the caller has just read the user's pref_version
+    (rec_store does); otherwise it is read here.
+    """
+    if version is _CHECK:
+        version = statements.execute(conn, PREF_VERSION, {"user_id": user_id}).scalar()
+    profile = entity_cache.profiles.get(user_id)
+    if profile is None or not profile.is_current(version):
+        profile = load(conn, user_id, version)
+        entity_cache.profiles.put(user_id, profile)
+    return profile
+
+
+def apply(user_id, version, added=(), removed=()):
+    """Fold a committed change into this worker's cached profile.
+
+    `version` is the pref_version the change's mark_dirty returned;
+    `added` holds (kind, id, name) and `removed` (kind, id). The change is
+    applied only on top of the version right before it; if another change
+    came in between, the profile is dropped and reloaded on next use.
+    """
+    with _lock:
+        profile = entity_cache.profiles.get(user_id)
+        if profile is None:
+            return
+        if version is None or (profile.version or 0) + 1 != version:
+            entity_cache.profiles.invalidate(user_id)
+            return
+        liked = {kind: dict(items) for kind, items in profile.liked.items()}
+        for kind, item_id in removed:
+            liked[kind].pop(item_id, None)
+        for kind, item_id, name in added:
+            liked[kind][item_id] = name
+        entity_cache.profiles.put(user_id, Profile(version, liked))
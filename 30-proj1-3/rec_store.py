@@ -0,0 +1,542 @@
+"""
+Precomputed recommendation store.
+
+Each user's recommendation list is built once and kept in the
+UserRecommendation table. RecommendationState tracks a preference version
+per user: the /preferences handlers bump it (mark_dirty) and the list is
+only rebuilt when pref_version has moved past built_version, so a normal
+/recommendations hit is a single indexed read.
+
+Serving a list never writes: a stale or missing list is computed in
+memory for the request (one read-only query, so a replica can answer it)
+and the stored copy is rebuilt on the primary by a background queue
+(rebuilds). A user the queue has no room for stays dirty for the next
+view or the batch rebuild below.
+
+Run as a script to rebuild in batch:
+    python rec_store.py          # users that are dirty or never built
+    python rec_store.py --all    # every user
+    python rec_store.py --compare 200   # combined vs per-source queries
+
+--compare is a check as well as a benchmark: it exits non-zero when the
+combined query's results are worse than the per-source ones, or it takes
+more than a third of their DB time (see check()).
+"""
+import os
+import sys
+import threading
+import time
+
+from sqlalchemy import text
+
+import entity_cache
+import profiles
+import statements
+
+READ_QUERY = statements.register("read_recommendations", """
+    SELECT s.pref_version, s.built_version, s.built_at,
+           r.track_id, r.track_name, r.reason, r.rec_type
+    FROM RecommendationState s
+    LEFT JOIN UserRecommendation r ON r.user_id = s.user_id
+    WHERE s.user_id = :user_id
+    ORDER BY r.rank
+""", user_id="int")
+
+MARK_DIRTY = statements.register("mark_dirty", """
+    INSERT INTO RecommendationState (user_id)
+    VALUES (:user_id)
+    ON CONFLICT (user_id) DO UPDATE
+    SET pref_version = RecommendationState.pref_version + 1
+    RETURNING pref_version
+""", user_id="int")
+
+DIRTY_USERS_QUERY = text("""
+    SELECT u.user_id
+    FROM "User" u
+    LEFT JOIN RecommendationState s ON s.user_id = u.user_id
+    WHERE s.user_id IS NULL OR s.pref_version > s.built_version
+    ORDER BY u.user_id
+""")
+
+# Users waiting for a background rebuild
+REBUILD_QUEUE_MAX = int(os.environ.get("REC_REBUILD_QUEUE_MAX", 1000))
+
+PER_SOURCE = 5
+MAX_RECOMMENDATIONS = 3 * PER_SOURCE
+# --compare fails unless the combined query needs at most this share of
+# the per-source queries' DB time
+TARGET_TIME_SHARE = 1 / 3
+
+# All three sources in one round trip. The liked tracks, artists and
+# genres come from the user's cached profile (profiles.py) as array
+# parameters, so no preference table is read; liked tracks are excluded
+# with anti-joins. Each source keeps its PER_SOURCE most popular distinct
+# tracks, and a track suggested by several sources becomes one row
+# carrying every reason, ranked by the summed source weights (artist 3,
+# album 2, genre 1) and then popularity. Planning this statement takes
+# several times longer than running it, and its plan does not depend on
+# the arrays, so it always runs its cached generic plan (statements.py).
+RECOMMENDATION_QUERY = statements.register("build_recommendations", f"""
+    WITH liked AS (
+        SELECT unnest(CAST(:tracks AS TEXT[])) AS track_id
+    ),
+    artist_recs AS (
+        SELECT t.track_id, t.track_name, t.track_popularity,
+               'artist' AS rec_type, 3 AS weight,
+               'Similar artist: ' || string_agg(DISTINCT a.artist_name, ', ') AS reason
+        FROM Artist a
+        JOIN ArtistTrack at ON at.artist_id = a.artist_id
+        JOIN Track t ON t.track_id = at.track_id
+        WHERE a.artist_id = ANY(CAST(:artists AS UUID[]))
+          AND NOT EXISTS (SELECT 1 FROM liked l WHERE l.track_id = t.track_id)
+        GROUP BY t.track_id
+        ORDER BY COALESCE(t.track_popularity, -1) DESC, t.track_id DESC
+        LIMIT {PER_SOURCE}
+    ),
+    -- enough rows per genre even if every liked track ranks first
+    genre_top AS (
+        SELECT gt.genre_name, gt.rank, gt.track_id, gt.track_name, gt.track_popularity
+        FROM GenreTopTrack gt
+        WHERE gt.genre_name = ANY(CAST(:genres AS TEXT[]))
+          AND gt.rank <= {PER_SOURCE} + (SELECT COUNT(*) FROM liked)
+          AND NOT EXISTS (SELECT 1 FROM TopTrackDirty d
+                          WHERE d.scope = 'genre' AND d.key = gt.genre_name)
+        UNION ALL
+        -- A genre waiting in TopTrackDirty may have a stale stored list,
+        -- so it is read live in the same order (top_tracks.py)
+        SELECT d.key, top.rank, top.track_id, top.track_name, top.track_popularity
+        FROM TopTrackDirty d
+        CROSS JOIN LATERAL (
+            SELECT t.track_id, t.track_name, t.track_popularity,
+                   row_number() OVER (ORDER BY COALESCE(t.track_popularity, -1) DESC,
+                                               t.track_id DESC) AS rank
+            FROM Track t
+            WHERE t.genre_name = d.key
+            ORDER BY COALESCE(t.track_popularity, -1) DESC, t.track_id DESC
+            LIMIT {PER_SOURCE} + (SELECT COUNT(*) FROM liked)
+        ) top
+        WHERE d.scope = 'genre' AND d.key = ANY(CAST(:genres AS TEXT[]))
+    ),
+    genre_recs AS (
+        SELECT gt.track_id, MIN(gt.track_name) AS track_name,
+               MIN(gt.track_popularity) AS track_popularity,
+               'genre' AS rec_type, 1 AS weight,
+               'Same genre: ' || string_agg(gt.genre_name, ', ') AS reason
+        FROM genre_top gt
+        WHERE NOT EXISTS (SELECT 1 FROM liked l WHERE l.track_id = gt.track_id)
+        GROUP BY gt.track_id
+        ORDER BY MIN(gt.rank), gt.track_id
+        LIMIT {PER_SOURCE}
+    ),
+    album_recs AS (
+        SELECT t.track_id, t.track_name, t.track_popularity,
+               'album' AS rec_type, 2 AS weight,
+               'From album ''' || MIN(al.album_name) || ''' (you liked: '
+                   || string_agg(DISTINCT src.track_name, ', ') || ')' AS reason
+        FROM liked l
+        JOIN Track src ON src.track_id = l.track_id
+        JOIN Track t ON t.album_id = src.album_id
+        JOIN Album al ON al.album_id = t.album_id
+        WHERE NOT EXISTS (SELECT 1 FROM liked l2 WHERE l2.track_id = t.track_id)
+        GROUP BY t.track_id
+        ORDER BY COALESCE(t.track_popularity, -1) DESC, t.track_id DESC
+        LIMIT {PER_SOURCE}
+    ),
+    candidates AS (
+        SELECT * FROM artist_recs
+        UNION ALL SELECT * FROM genre_recs
+        UNION ALL SELECT * FROM album_recs
+    )
+    SELECT track_id,
+           MIN(track_name) AS track_name,
+           string_agg(reason, '; ' ORDER BY weight DESC) AS reason,
+           (array_agg(rec_type ORDER BY weight DESC))[1] AS rec_type
+    FROM candidates
+    GROUP BY track_id
+    ORDER BY SUM(weight) DESC, COALESCE(MAX(track_popularity), -1) DESC, track_id
+    LIMIT {MAX_RECOMMENDATIONS}
+""", generic=True, tracks="text[]", artists="text[]", genres="text[]")
+
+# The former per-source queries, each with its own exclusion subquery;
+# kept for compare()
+
+# Artist-based recommendations
+ARTIST_QUERY = text("""
+    SELECT
+        t.track_id,
+        t.track_name,
+        a.artist_id,
+        a.artist_name AS recommendation_source,
+        'artist' AS recommendation_type
+    FROM Track t
+    JOIN ArtistTrack at ON t.track_id = at.track_id
+    JOIN Artist a ON at.artist_id = a.artist_id
+    WHERE a.artist_id IN (
+        SELECT artist_id FROM userartistpreference
+        WHERE user_id = :user_id
+    )
+    AND t.track_id NOT IN (
+        SELECT track_id FROM usertrackpreference
+        WHERE user_id = :user_id
+    )
+    LIMIT 5
+""")
+
+# Genre-based recommendations, from the materialized per-genre top tracks
+# (top_tracks.py), most popular first
+GENRE_QUERY = text("""
+    SELECT
+        gt.track_id,
+        gt.track_name,
+        gt.genre_name AS recommendation_source,
+        'genre' AS recommendation_type
+    FROM GenreTopTrack gt
+    WHERE gt.genre_name IN (
+        SELECT genre_name FROM usergenrepreference
+        WHERE user_id = :user_id
+    )
+    AND gt.track_id NOT IN (
+        SELECT track_id FROM usertrackpreference
+        WHERE user_id = :user_id
+    )
+    ORDER BY gt.rank, gt.genre_name
+    LIMIT 5
+""")
+
+# Album-based recommendations
+ALBUM_QUERY = text("""
+    SELECT
+        t.track_id,
+        t.track_name,
+        a.album_name,
+        utp.source_track_name
+    FROM (
+        -- 获取用户收藏曲目对应的专辑ID和曲目名称
+        SELECT DISTINCT
+            Track.album_id,
+            Track.track_name AS source_track_name
+        FROM UserTrackPreference
+        JOIN Track USING (track_id)
+        WHERE user_id = :user_id
+    ) utp
+    JOIN Track t USING (album_id)
+    JOIN Album a USING (album_id)
+    WHERE t.track_id NOT IN (
+        SELECT track_id FROM UserTrackPreference
+        WHERE user_id = :user_id
+    )
+    ORDER BY t.track_popularity DESC
+    LIMIT 5
+""")
+
+def compute_recommendations(conn, user_id, profile=None):
+    """Recommendations for one user from the artist, genre and album sources"""
+    if profile is None:
+        profile = profiles.get(conn, user_id)
+    rows = statements.execute(conn, RECOMMENDATION_QUERY, {
+        "tracks": list(profile.tracks),
+        "artists": list(profile.artists),
+        "genres": list(profile.genres),
+    }).mappings().fetchall()
+    return [{
+        'track_id': row['track_id'],
+        'track_name': row['track_name'],
+        'reason': row['reason'],
+        'type': row['rec_type']
+    } for row in rows]
+
+
+def _per_source_recommendations(conn, user_id):
+    """The three per-source queries, results concatenated as they used to be"""
+    recommendations = []
+    for query, rec_type in ((ARTIST_QUERY, 'artist'), (GENRE_QUERY, 'genre'), (ALBUM_QUERY, 'album')):
+        for rec in conn.execute(query, {"user_id": user_id}).mappings():
+            recommendations.append({'track_id': rec['track_id'], 'type': rec_type})
+    return recommendations
+
+
+def _cold_profile(conn, user_id):
+    entity_cache.profiles.invalidate(user_id)
+
+
+def _cached_profile(conn, user_id):
+    profiles.get(conn, user_id)
+
+
+# (name, statements per user, setup run untimed before each build, build).
+# "combined" starts from a cold profile cache, so it pays for reading the
+# preferences just as per_source does; "combined_cached" is the usual
+# case of a profile already in memory, checked with one version read.
+COMPARED = (
+    ("per_source", 3, None, _per_source_recommendations),
+    ("combined", 3, _cold_profile, compute_recommendations),
+    ("combined_cached", 2, _cached_profile, compute_recommendations),
+)
+
+
+def compare(conn, user_ids):
+    """DB time and result quality of the combined query vs the per-source ones.
+
+    Quality is counted per approach as rows returned, distinct tracks,
+    duplicate rows, liked tracks that slipped through and the mean
+    popularity of the suggested tracks. Timings include one client round
+    trip per statement, which is where the combined query saves most
+    against a remote database.
+    """
+    report = {}
+    for name, statement_count, setup, build in COMPARED:
+        seconds, rows, suggested, liked_hits, distinct = 0.0, 0, [], 0, 0
+        for user_id in user_ids:
+            liked = set(conn.execute(text("""
+                SELECT track_id FROM UserTrackPreference WHERE user_id = :user_id
+            """), {"user_id": user_id}).scalars())
+            if setup is not None:
+                setup(conn, user_id)
+            started = time.perf_counter()
+            track_ids = [rec['track_id'] for rec in build(conn, user_id)]
+            seconds += time.perf_counter() - started
+            rows += len(track_ids)
+            distinct += len(set(track_ids))
+            suggested += track_ids
+            liked_hits += sum(1 for track_id in track_ids if track_id in liked)
+        popularity = conn.execute(text("""
+            SELECT AVG(COALESCE(t.track_popularity, 0))
+            FROM unnest(CAST(:track_ids AS VARCHAR[])) AS s(track_id)
+            JOIN Track t ON t.track_id = s.track_id
+        """), {"track_ids": suggested}).scalar()
+        report[name] = {
+            "users": len(user_ids),
+            "statements_per_user": statement_count,
+            "db_ms_per_user": round(seconds * 1000 / max(len(user_ids), 1), 3),
+            "rows": rows,
+            "distinct_tracks": distinct,
+            "duplicates": rows - distinct,
+            "liked_included": liked_hits,
+            "mean_popularity": round(float(popularity or 0), 2),
+        }
+    conn.rollback()
+    return report
+
+
+def check(report):
+    """Ways the combined query falls short of the per-source ones"""
+    old = report["per_source"]
+    problems = []
+    for name in ("combined", "combined_cached"):
+        new = report[name]
+        if new["db_ms_per_user"] > old["db_ms_per_user"] * TARGET_TIME_SHARE:
+            problems.append(f"{name}: {new['db_ms_per_user']} ms per user, more than "
+                            f"{TARGET_TIME_SHARE:.0%} of {old['db_ms_per_user']} ms")
+        if new["duplicates"]:
+            problems.append(f"{name}: {new['duplicates']} duplicate rows")
+        if new["liked_included"] > old["liked_included"]:
+            problems.append(f"{name}: {new['liked_included']} liked tracks recommended")
+        if new["mean_popularity"] < old["mean_popularity"]:
+            problems.append(f"{name}: mean popularity {new['mean_popularity']} "
+                            f"below {old['mean_popularity']}")
+    return problems
+
+
+def mark_dirty(conn, user_id):
+    """Flag a user's stored list as stale; runs in the caller's transaction.
+
+    Returns the new pref_version, for profiles.apply().
+    """
+    return statements.execute(conn, MARK_DIRTY, {"user_id": user_id}).scalar()
+
+
+def build_user(conn, user_id):
+    """Recompute and store one user's list, then commit"""
+    conn.execute(text("""
+        INSERT INTO RecommendationState (user_id)
+        VALUES (:user_id)
+        ON CONFLICT (user_id) DO NOTHING
+    """), {"user_id": user_id})
+    # Row lock serializes concurrent builds and preference changes for
+    # this user; a mark_dirty that lands after we read the version simply
+    # leaves the user dirty for the next read.
+    version = conn.execute(text("""
+        SELECT pref_version FROM RecommendationState
+        WHERE user_id = :user_id
+        FOR UPDATE
+    """), {"user_id": user_id}).scalar()
+
+    recommendations = compute_recommendations(conn, user_id, profiles.get(conn, user_id, version))
+    _replace(conn, {user_id: recommendations})
+    conn.execute(text("""
+        UPDATE RecommendationState
+        SET built_version = :version, built_at = NOW()
+        WHERE user_id = :user_id
+    """), {"user_id": user_id, "version": version})
+    conn.commit()
+    return recommendations
+
+
+def store_many(conn, built, versions):
+    """Write lists computed elsewhere (e.g. batch_scorer) in one transaction.
+
+    `built` maps user_id -> recommendation list and `versions` maps
+    user_id -> the pref_version the lists were computed from. Users whose
+    preferences changed since then are skipped and stay dirty.
+    """
+    current = dict(conn.execute(text("""
+        SELECT user_id, pref_version FROM RecommendationState
+        WHERE user_id = ANY(:user_ids)
+        FOR UPDATE
+    """), {"user_ids": list(built)}).fetchall())
+    fresh = [user_id for user_id in built if current.get(user_id) == versions.get(user_id)]
+
+    if fresh:
+        _replace(conn, {user_id: built[user_id] for user_id in fresh})
+        conn.execute(text("""
+            UPDATE RecommendationState
+            SET built_version = pref_version, built_at = NOW()
+            WHERE user_id = ANY(:user_ids)
+        """), {"user_ids": fresh})
+    conn.commit()
+    return len(fresh)
+
+
+def _replace(conn, built):
+    """Swap the stored lists for the given users; caller commits"""
+    conn.execute(text("""
+        DELETE FROM UserRecommendation WHERE user_id = ANY(:user_ids)
+    """), {"user_ids": list(built)})
+    rows = [dict(rec, user_id=user_id, rank=rank)
+            for user_id, recommendations in built.items()
+            for rank, rec in enumerate(recommendations)]
+    if rows:
+        conn.execute(text("""
+            INSERT INTO UserRecommendation
+                (user_id, rank, track_id, track_name, reason, rec_type)
+            VALUES (:user_id, :rank, :track_id, :track_name, :reason, :type)
+        """), rows)
+
+
+class RebuildQueue:
+    """Users whose stored list is stale, rebuilt one at a time by build_user
+    on a daemon thread with its own connection from the given engine.
+
+    A user already waiting or being rebuilt is not queued again; one whose
+    preferences change during a rebuild stays dirty and is queued by their
+    next view.
+    """
+
+    def __init__(self, max_size=REBUILD_QUEUE_MAX):
+        self.max_size = max_size
+        self._cond = threading.Condition()
+        self._pending = {}          # user_id -> engine, oldest first
+        self._building = None
+        self._thread = None
+        self.built = 0
+        self.failed = 0
+        self.dropped = 0
+
+    def submit(self, engine, user_id):
+        """Queue a rebuild; False if it is already queued or there is no room"""
+        with self._cond:
+            if user_id in self._pending or user_id == self._building:
+                return False
+            if len(self._pending) >= self.max_size:
+                self.dropped += 1
+                return False
+            self._pending[user_id] = engine
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name="rec-rebuild", daemon=True)
+                self._thread.start()
+            self._cond.notify()
+            return True
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._pending:
+                    self._cond.wait()
+                user_id = next(iter(self._pending))
+                engine = self._pending.pop(user_id)
+                self._building = user_id
+            try:
+                with engine.connect() as conn:
+                    build_user(conn, user_id)
+                self.built += 1
+            except Exception as e:
+                print(f"Recommendation rebuild error: {str(e)}")
+                self.failed += 1
+            with self._cond:
+                self._building = None
+
+    def stats(self):
+        with self._cond:
+            pending = len(self._pending) + (self._building is not None)
+        return {"pending": pending, "built": self.built, "failed": self.failed, "dropped": self.dropped}
+
+
+rebuilds = RebuildQueue()
+
+
+def get_versioned(conn, user_id, engine=None):
+    """(version, list) for a user; only reads conn, which may be a replica.
+
+    version is (built_version, built_at) of the stored list, which changes
+    with every rebuild, so it can key rendered copies of the list. A stale
+    or missing list is computed in memory instead and returned with version
+    None, and the stored copy is queued for a rebuild on `engine` (the
+    primary); without an engine it waits for the batch rebuild.
+    """
+    rows = statements.execute(conn, READ_QUERY, {"user_id": user_id}).mappings().fetchall()
+    if not rows or rows[0]['pref_version'] > rows[0]['built_version']:
+        if engine is not None:
+            rebuilds.submit(engine, user_id)
+        profile = profiles.get(conn, user_id, rows[0]['pref_version']) if rows else None
+        return None, compute_recommendations(conn, user_id, profile)
+
+    version = (rows[0]['built_version'], rows[0]['built_at'])
+    return version, [{
+        'track_id': row['track_id'],
+        'track_name': row['track_name'],
+        'reason': row['reason'],
+        'type': row['rec_type']
+    } for row in rows if row['track_id'] is not None]
+
+
+def get_recommendations(conn, user_id, engine=None):
+    """Current list for a user (see get_versioned)"""
+    return get_versioned(conn, user_id, engine)[1]
+
+
+def rebuild(conn, all_users=False):
+    """Batch builder: rebuild dirty users (or everyone), return the count"""
+    if all_users:
+        user_ids = conn.execute(text('SELECT user_id FROM "User" ORDER BY user_id')).scalars().all()
+    else:
+        user_ids = conn.execute(DIRTY_USERS_QUERY).scalars().all()
+
+    for user_id in user_ids:
+        build_user(conn, user_id)
+    return len(user_ids)
+
+
+if __name__ == "__main__":
+    import argparse
+    from server import engine
+
+    parser = argparse.ArgumentParser(description="Rebuild stored recommendations")
+    parser.add_argument('--all', action='store_true', help="rebuild every user, not only dirty ones")
+    parser.add_argument('--compare', type=int, metavar='USERS',
+                        help="time the combined query against the per-source ones for this many users")
+    args = parser.parse_args()
+
+    with engine.connect() as conn:
+        if args.compare:
+            user_ids = conn.execute(text("""
+                SELECT user_id FROM "User" ORDER BY user_id LIMIT :n
+            """), {"n": args.compare}).scalars().all()
+            report = compare(conn, user_ids)
+            for name, stats in report.items():
+                print(f"{name:<16} " + "  ".join(f"{key} {value}" for key, value in stats.items()))
+            problems = check(report)
+            print("\n".join(problems) or "Combined results are at least as good")
+            sys.exit(1 if problems else 0)
+        else:
+            count = rebuild(conn, all_users=args.all)
+            print(f"Rebuilt recommendations for {count} users")
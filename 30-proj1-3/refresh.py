@@ -0,0 +1,88 @@
+"""
+Single-flight background refresh for the in-memory indexes.
+
+An index that is rebuilt from the database every few minutes (item_cf,
+search_index, suggest, ...) owns a Refresher. Its first load still
+happens in the request that needs it, with the other requests waiting
+for that one load instead of each starting their own. A stale index
+keeps serving: the first request to notice starts one rebuild on a
+daemon thread, with its own connection from the request's engine. Every
+other request uses the current index until the new one is swapped in.
+
+The index must provide `loaded_at` (time.monotonic() of its last load,
+None before the first) and `load(conn)`, which must build the new data
+without holding the lock its readers take.
+"""
+import threading
+import time
+
+# Seconds before a failed background refresh is tried again
+RETRY_INTERVAL = 30
+
+
+class Refresher:
+    def __init__(self, name, index):
+        self.name = name
+        self.index = index
+        self._lock = threading.Lock()
+        self._first_load = threading.Lock()
+        self._thread = None
+        self._expired = False
+        self.failed_at = None
+        self.refreshes = 0
+        self.last_seconds = None
+
+    @property
+    def running(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    def expire(self):
+        """Refresh on the next ensure_fresh() whatever the index's age"""
+        self._expired = True
+
+    def ensure_loaded(self, conn):
+        """Load now if the index has never been loaded in this process"""
+        if self.index.loaded_at is None:
+            with self._first_load:
+                if self.index.loaded_at is None:
+                    self.index.load(conn)
+
+    def ensure_fresh(self, conn, max_age):
+        """Load on first use; start a background rebuild once older than max_age"""
+        if self.index.loaded_at is None:
+            self.ensure_loaded(conn)
+        elif self._expired or time.monotonic() - self.index.loaded_at > max_age:
+            self.start(conn.engine)
+
+    def start(self, engine):
+        """Start a rebuild unless one is running or one failed moments ago"""
+        with self._lock:
+            if self.running:
+                return False
+            if self.failed_at is not None and time.monotonic() - self.failed_at < RETRY_INTERVAL:
+                return False
+            self._expired = False
+            self._thread = threading.Thread(target=self._run, args=(engine,),
+                                            name=f"refresh-{self.name}", daemon=True)
+            self._thread.start()
+            return True
+
+    def _run(self, engine):
+        started = time.perf_counter()
+        try:
+            with engine.connect() as conn:
+                self.index.load(conn)
+            self.failed_at = None
+            self.refreshes += 1
+        except Exception as e:
+            print(f"{self.name} refresh error: {str(e)}")
+            self.failed_at = time.monotonic()
+        self.last_seconds = round(time.perf_counter() - started, 3)
+
+    def stats(self):
+        return {
+            "running": self.running,
+            "refreshes": self.refreshes,
+            "last_seconds": self.last_seconds,
+            "failing": self.failed_at is not None,
+        }
@@ -0,0 +1,391 @@
+"""
+In-memory n-gram search index for the /search route.
+
+Every Track, Artist, Album and Genre name is broken into its distinct
+1-, 2- and 3-character n-grams and kept in an inverted index (n-gram ->
+documents), so a search term only walks one posting list instead of
+running ILIKE '%term%' over four tables. Matches are ranked by quality:
+exact name, then prefix, then word prefix, then plain substring, and
+within a rank by (length, name).
+
+Documents are numbered in that (length, name) order and every posting is
+a sorted int32 array, so walking a posting yields matches best first and
+a page stops as soon as it is full. A term longer than an n-gram walks
+its rarest trigram and drops candidates missing its other trigrams a
+chunk at a time, with NumPy. Word-prefix matches walk a second set of
+postings holding only the n-grams that start a word. A page looks at no
+more than MAX_CANDIDATES documents per rank, which only bounds terms
+whose postings are mostly prefix matches of other names.
+
+The documents live in two segments. The base is built from a full row
+set and never changed. A refresh diffs the catalog against the index
+and only the added or renamed rows go into a small delta segment, while
+the base copies they replace (and deleted rows) are marked dead. Once
+the delta holds more than COMPACT_FRACTION of the base the two are
+merged into a new base. Both are built without the lock and swapped in
+together; ensure_fresh starts the refresh on a background thread, one at
+a time (refresh.py).
+
+    python search_index.py bench [--url URL] [--scale 100] [--target-ms 1]
+
+times a set of terms against the catalog cloned --scale times (as
+benchmark.py seed --scale does) and exits non-zero if any median is over
+the target.
+"""
+import argparse
+import bisect
+import heapq
+import statistics
+import sys
+import threading
+import time
+from collections import namedtuple
+
+import numpy as np
+from sqlalchemy import create_engine, text
+
+import refresh
+
+NGRAM = 3
+
+# Seconds between background re-reads of the catalog tables
+REFRESH_INTERVAL = 300
+
+# Candidates a page verifies per rank before it gives up on that rank
+MAX_CANDIDATES = 20000
+# Candidates filtered against the other trigrams at a time
+CHUNK = 256
+# Delta size, relative to the base, at which the segments are merged
+COMPACT_FRACTION = 0.02
+MIN_COMPACT = 1000
+
+SearchResult = namedtuple("SearchResult", ["id", "name", "type"])
+
+CATALOG_QUERY = text("""
+    SELECT track_id::TEXT AS id, track_name AS name, 'track' AS type FROM Track
+    UNION ALL
+    SELECT artist_id::TEXT, artist_name, 'artist' FROM Artist
+    UNION ALL
+    SELECT album_id::TEXT, album_name, 'album' FROM Album
+    UNION ALL
+    SELECT genre_name::TEXT, genre_name, 'genre' FROM Genre
+""")
+
+
+def normalize(name):
+    return (name or "").casefold()
+
+
+def ngrams(value):
+    """Distinct trigrams of an already normalized string"""
+    return {value[i:i + NGRAM] for i in range(len(value) - NGRAM + 1)}
+
+
+# An n-gram of code points packed into one int64, CODE_BITS per character
+# (enough for any code point), first character highest. Code point 0
+# separates names, so no n-gram that spans two names is valid, and
+# n-grams of different lengths never share a code.
+CODE_BITS = 21
+
+
+def _decode(code):
+    chars = []
+    while code:
+        chars.append(chr(code & ((1 << CODE_BITS) - 1)))
+        code >>= CODE_BITS
+    return "".join(reversed(chars))
+
+
+def _postings(codes, docs):
+    """{gram: sorted int32 array of docs} from per-position n-gram codes
+    and the doc at each position, positions in doc order.
+
+    A stable sort by code keeps each posting's docs in order; repeats of
+    a gram within one doc are then dropped. Every posting is a view of
+    one array.
+    """
+    order = np.argsort(codes, kind="stable")
+    codes, docs = codes[order], docs[order]
+    keep = np.ones(len(codes), dtype=bool)
+    keep[1:] = (codes[1:] != codes[:-1]) | (docs[1:] != docs[:-1])
+    codes, docs = codes[keep], docs[keep]
+    starts = np.flatnonzero(np.diff(codes, prepend=-1)).tolist()
+    ends = starts[1:] + [len(codes)]
+    return {_decode(code): docs[start:end]
+            for code, start, end in zip(codes[starts].tolist(), starts, ends)}
+
+
+def _all_postings(norms):
+    """(n-gram postings, word-prefix postings) of names in doc order.
+
+    Both map every 1..NGRAM character gram to the docs having it; the
+    word-prefix ones only count grams at the start of a word other than
+    the first (after a character that is not str.isalnum()).
+    """
+    text_codes = np.frombuffer(("\0".join(norms) + "\0" * NGRAM).encode("utf-32-le", "surrogatepass"),
+                               dtype=np.uint32).astype(np.int64)
+    lengths = np.array([len(norm) + 1 for norm in norms], dtype=np.int64)
+    doc_of = np.repeat(np.arange(len(norms), dtype=np.int32), lengths)
+    positions = len(doc_of)
+    # shifted[n] is the code point n characters after each position
+    shifted = [text_codes[n:n + positions] for n in range(NGRAM)]
+
+    points = np.unique(text_codes)
+    alnum = np.array([chr(point).isalnum() for point in points.tolist()], dtype=bool)
+    word_start = np.zeros(positions, dtype=bool)
+    previous = shifted[0][:-1]
+    word_start[1:] = (previous != 0) & ~alnum[np.searchsorted(points, previous)]
+
+    postings, words = {}, {}
+    code = np.zeros(positions, dtype=np.int64)
+    valid = np.ones(positions, dtype=bool)
+    for n in range(NGRAM):
+        code = (code << CODE_BITS) | shifted[n]
+        valid &= shifted[n] != 0
+        postings.update(_postings(code[valid], doc_of[valid]))
+        at_word = valid & word_start
+        words.update(_postings(code[at_word], doc_of[at_word]))
+    return postings, words
+
+
+def _substring_key(term, norm, item_type, item_id):
+    """Sort key of a word-prefix or substring match, or None"""
+    # pos == 0 means a prefix match, which _prefix_matches covers
+    pos = norm.find(term)
+    if pos <= 0:
+        return None
+    rank = 1 if not norm[pos - 1].isalnum() else 2
+    return (rank, len(norm), norm, item_type, item_id)
+
+
+class Segment:
+    """An immutable set of documents with their postings"""
+
+    def __init__(self, results):
+        entries = sorted(((len(norm), norm, r.type, r.id), r)
+                         for r in results for norm in (normalize(r.name),))
+        self.keys = [key for key, _ in entries]         # doc -> (length, name, type, id)
+        self.results = [r for _, r in entries]          # doc -> SearchResult
+        self.by_key = {(r.type, r.id): doc for doc, r in enumerate(self.results)}
+        self.names = sorted((key[1], key[2], key[3]) for key in self.keys)
+
+        self.postings, self.words = _all_postings([key[1] for key in self.keys])
+
+    def __len__(self):
+        return len(self.keys)
+
+    def prefix_matches(self, term, limit, after, dead):
+        if after is not None and after[0] > 0:
+            return []
+        pos = bisect.bisect_left(self.names, (term,))
+        if after is not None:
+            pos = max(pos, bisect.bisect_right(self.names, after[2:]))
+        matches = []
+        while pos < len(self.names) and len(matches) < limit:
+            norm, item_type, item_id = self.names[pos]
+            if not norm.startswith(term):
+                break
+            if (item_type, item_id) not in dead:
+                key = (0, 0, norm, item_type, item_id)
+                matches.append((key, self.results[self.by_key[(item_type, item_id)]]))
+            pos += 1
+        return matches
+
+    def substring_matches(self, term, rank, limit, after, dead):
+        """Matches of one rank (1: word prefix, 2: substring), best first"""
+        if after is not None and after[0] > rank:
+            return []
+        if len(term) <= NGRAM:
+            # The n-gram postings hold every term this short exactly
+            walk = (self.words if rank == 1 else self.postings).get(term)
+            filters = []
+        else:
+            grams = ngrams(term)
+            if any(gram not in self.postings for gram in grams):
+                return []
+            filters = sorted((self.postings[gram] for gram in grams), key=len)
+            walk = self.words.get(term[:NGRAM]) if rank == 1 else filters.pop(0)
+        if walk is None:
+            return []
+        if after is not None and after[0] == rank:
+            walk = walk[np.searchsorted(walk, bisect.bisect_right(self.keys, after[1:])):]
+
+        matches = []
+        for start in range(0, min(len(walk), MAX_CANDIDATES), CHUNK):
+            chunk = walk[start:start + CHUNK]
+            for posting in filters[:3]:
+                found = np.searchsorted(posting, chunk)
+                chunk = chunk[posting[np.minimum(found, len(posting) - 1)] == chunk]
+            for doc in chunk.tolist():
+                length, norm, item_type, item_id = self.keys[doc]
+                key = _substring_key(term, norm, item_type, item_id)
+                if key is not None and key[0] == rank and (item_type, item_id) not in dead:
+                    matches.append((key, self.results[doc]))
+                    if len(matches) == limit:
+                        return matches
+        return matches
+
+
+class NgramIndex:
+    """N-gram inverted index over (id, name, type) catalog rows"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._base = Segment([])
+        self._delta = Segment([])
+        self._dead = frozenset()    # (type, id) of base docs replaced or deleted
+        self.loaded_at = None
+        self.compactions = 0
+        self.refresher = refresh.Refresher("search_index", self)
+
+    def __len__(self):
+        return len(self._base) - len(self._dead) + len(self._delta)
+
+    # -- maintenance ------------------------------------------------------
+
+    def sync(self, rows):
+        """Bring the index in line with a full (id, name, type) row set.
+
+        Only rows added, renamed or deleted since the last sync are
+        re-indexed (see the module docstring). sync() and its caller, the
+        Refresher, are the only writers, so the diff reads the segments
+        without the lock; searches only wait for the swap.
+        """
+        base, delta, dead = self._base, self._delta, self._dead
+        rows = {(item_type, str(item_id)): name for item_id, name, item_type in rows}
+
+        changed = {}
+        for key, name in rows.items():
+            doc = delta.by_key.get(key)
+            if doc is not None:
+                current = delta.results[doc]
+            else:
+                doc = base.by_key.get(key)
+                current = base.results[doc] if doc is not None and key not in dead else None
+            if current is None or current.name != name:
+                changed[key] = SearchResult(key[1], name, key[0])
+        removed = [key for key in delta.by_key if key not in rows]
+        removed += [key for key in base.by_key if key not in rows and key not in dead]
+
+        if changed or removed or self.loaded_at is None:
+            kept = {key: result for key, result in
+                    ((key, delta.results[doc]) for key, doc in delta.by_key.items())
+                    if key in rows and key not in changed}
+            kept.update(changed)
+            if len(kept) > max(MIN_COMPACT, len(base) * COMPACT_FRACTION):
+                base = Segment(SearchResult(key[1], name, key[0]) for key, name in rows.items())
+                delta, dead = Segment([]), frozenset()
+                self.compactions += 1
+            else:
+                dead = dead | {key for key in (*changed, *removed) if key in base.by_key}
+                delta = Segment(kept.values())
+
+        with self._lock:
+            self._base, self._delta, self._dead = base, delta, dead
+            self.loaded_at = time.monotonic()
+
+    def load(self, conn):
+        """(Re)read the four catalog tables"""
+        self.sync(conn.execute(CATALOG_QUERY).fetchall())
+
+    def ensure_fresh(self, conn, max_age=REFRESH_INTERVAL):
+        """Load on first use; rebuild in the background once older than max_age"""
+        self.refresher.ensure_fresh(conn, max_age)
+
+    # -- queries ----------------------------------------------------------
+
+    def search(self, term, limit=20):
+        """Return up to `limit` SearchResults matching `term`, best first"""
+        return self.page(term, limit)[0]
+
+    def page(self, term, limit=20, after=None):
+        """One page of matches and the sort key to continue after.
+
+        Matches are ordered by (rank, length, name, type, id): exact and
+        prefix matches (rank 0) come straight off the sorted name arrays;
+        the postings are only walked when those do not fill the page, for
+        word-prefix (1) and substring (2) matches. `after` is the key
+        returned for the previous page; the returned key is None on the
+        last page.
+        """
+        term = normalize(term).strip()
+        after = tuple(after) if after else None
+        with self._lock:
+            segments = ((self._base, self._dead), (self._delta, frozenset()))
+
+        wanted = limit + 1
+        matches = []
+        for segment, dead in segments:
+            matches += segment.prefix_matches(term, wanted, after, dead)
+        matches = heapq.nsmallest(wanted, matches)
+        for rank in (1, 2):
+            if len(matches) >= wanted or not term:
+                break
+            found = []
+            for segment, dead in segments:
+                found += segment.substring_matches(term, rank, wanted - len(matches), after, dead)
+            matches += heapq.nsmallest(wanted - len(matches), found)
+
+        results = [result for _, result in matches[:limit]]
+        next_key = matches[limit - 1][0] if len(matches) > limit and limit > 0 else None
+        return results, next_key
+
+    def stats(self):
+        return {"documents": len(self), "delta": len(self._delta), "dead": len(self._dead),
+                "compactions": self.compactions}
+
+
+# Shared by every request in this process
+index = NgramIndex()
+
+
+BENCH_TERMS = ["e", "x", "q", "ie", "zz", "ll", "#5", "the", "love", "feat", "remix",
+               "a #9", "hello world", "in the", "night", "rock"]
+
+
+def benchmark(rows, scale, terms=BENCH_TERMS, runs=20):
+    """Median / max milliseconds of one page per term, on rows cloned
+    scale times with suffixed ids and names"""
+    cloned = [(f"{item_id}_{k}" if k else item_id, f"{name} #{k}" if k else name, item_type)
+              for k in range(scale) for item_id, name, item_type in rows]
+    bench = NgramIndex()
+    started = time.perf_counter()
+    bench.sync(cloned)
+    report = {"documents": len(bench), "load_s": round(time.perf_counter() - started, 2), "terms": {}}
+    for term in terms:
+        times = []
+        for _ in range(runs):
+            started = time.perf_counter()
+            results, _ = bench.page(term, 20)
+            times.append((time.perf_counter() - started) * 1000)
+        report["terms"][term] = {"median_ms": round(statistics.median(times), 3),
+                                 "max_ms": round(max(times), 3), "results": len(results)}
+    return report
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Time /search pages on a scaled catalog")
+    parser.add_argument("command", choices=["bench"])
+    parser.add_argument("--url", help="database URL (defaults to the server's)")
+    parser.add_argument("--scale", type=int, default=100, help="catalog copies")
+    parser.add_argument("--target-ms", type=float, default=1.0, help="largest allowed median")
+    args = parser.parse_args()
+
+    if args.url:
+        engine = create_engine(args.url)
+    else:
+        from server import engine
+    with engine.connect() as conn:
+        rows = conn.execute(CATALOG_QUERY).fetchall()
+
+    report = benchmark(rows, args.scale)
+    print(f"{report['documents']} documents, loaded in {report['load_s']}s")
+    slow = []
+    for term, stats in report["terms"].items():
+        print(f"{term!r:16} median {stats['median_ms']:8.3f} ms  max {stats['max_ms']:8.3f} ms  "
+              f"{stats['results']} results")
+        if stats["median_ms"] > args.target_ms:
+            slow.append(term)
+    if slow:
+        print(f"Over {args.target_ms} ms: {', '.join(map(repr, slow))}")
+        sys.exit(1)
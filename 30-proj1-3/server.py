@@ -3,10 +3,29 @@ Columbia's COMS W4111.001 Introduction to Databases
 Music Recommendation System Web Server
 """
 import os
-import uuid
+import sys
+
+# db_pool.py is shared by the apps in this repository and lives at its root
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
 from sqlalchemy import *
-from sqlalchemy.pool import NullPool
-from flask import Flask, request, render_template, g, redirect, Response, session
+from flask import Flask, request, render_template, g, redirect, Response, session, jsonify
+import bulk_prefs
+import catalog
+import db_pool
+import entity_cache
+import export
+import item_cf
+import metrics
+import page_cache
+import pagination
+import profiles
+import rec_store
+import search_index
+import similar_tracks
+import statements
+import suggest
+import top_tracks
 
 tmpl_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'templates')
 app = Flask(__name__, template_folder=tmpl_dir)
@@ -17,16 +36,44 @@ DATABASE_USERNAME = "zf2342"
 DATABASE_PASSWRD = "399067"
 DATABASE_HOST = "34.148.223.31"
 DATABASEURI = f"postgresql://{DATABASE_USERNAME}:{DATABASE_PASSWRD}@{DATABASE_HOST}/proj1part2"
-
-engine = create_engine(DATABASEURI)
+# Point the server at another database, e.g. a local one for benchmark.py
+DATABASEURI = os.environ.get("DATABASE_URL", DATABASEURI)
+# Comma separated read replica URLs; read-only routes are spread over them
+REPLICA_URIS = [uri.strip() for uri in os.environ.get("DATABASE_REPLICA_URLS", "").split(",") if uri.strip()]
+
+engine = db_pool.create_pooled_engine(DATABASEURI)
+replicas = [db_pool.create_pooled_engine(uri, read_only=True) for uri in REPLICA_URIS]
+router = db_pool.Router(engine, replicas)
+# /export streams for as long as the client keeps reading, so it has its
+# own small pool, on the first replica when there is one, rather than
+# holding one of the request pool's primary connections
+EXPORT_POOL_SIZE = int(os.environ.get("EXPORT_POOL_SIZE", 2))
+export_engine = db_pool.create_pooled_engine(REPLICA_URIS[0] if REPLICA_URIS else DATABASEURI,
+                                             read_only=True, pool_size=EXPORT_POOL_SIZE, max_overflow=0)
+
+# GET routes that only read; everything else runs on the primary
+READ_ONLY_ENDPOINTS = {
+    "top_tracks_status",
+    "search", "search_json", "search_suggest",
+    "recommendations", "recommendations_json",
+    "preferences",
+    "track_detail", "genre_detail", "genre_tracks_json", "artist_detail", "artist_tracks_json",
+}
 
 @app.before_request
 def before_request():
-    try:
-        g.conn = engine.connect()
-    except:
-        print("Database connection error")
-        g.conn = None
+    # Connection is checked out of the pool on first use of g.conn; reads
+    # go to a replica unless this session wrote recently (db_pool.Router)
+    read_only = request.method in ('GET', 'HEAD') and request.endpoint in READ_ONLY_ENDPOINTS
+    g.conn = router.connection(read_only, session)
+
+@app.after_request
+def pin_writer(response):
+    # Read-your-writes: after a successful write the session reads from the
+    # primary until the replicas have had time to catch up
+    if request.method not in ('GET', 'HEAD') and response.status_code < 400 and 'user_id' in session:
+        router.pin(session)
+    return response
 
 @app.before_request
 def method_override():
@@ -40,6 +87,119 @@ def teardown_request(exception):
     except Exception as e:
         pass
 
+@app.route('/pool')
+def pool_status():
+    """Connection pool statistics, with the replicas', the exports' and request routing"""
+    return jsonify(dict(engine.pool_stats.snapshot(), routing=router.stats(),
+                        export=export_engine.pool_stats.snapshot()))
+
+@app.route('/cache/stats')
+def cache_stats():
+    """Detail page cache counters"""
+    return jsonify(entity_cache.stats())
+
+@app.route('/cache/invalidate', methods=['POST'])
+def cache_invalidate():
+    """Invalidation hook for the loader; only accepted from this host"""
+    if request.remote_addr not in ('127.0.0.1', '::1'):
+        return jsonify({"error": "forbidden"}), 403
+
+    kind = request.form.get('kind') or None
+    key = request.form.get('key') or None
+    invalidate_caches(kind, key)
+    if broadcast_invalidation is not None:
+        broadcast_invalidation(kind, key)
+    # Rebuild whatever the change marked in TopTrackDirty
+    top_tracks.refresher.start(engine)
+    return jsonify({"invalidated": kind or "all", "key": key})
+
+def invalidate_caches(kind=None, key=None):
+    """Drop this process's cached copies of a changed row, kind or everything"""
+    entity_cache.invalidate(kind, key)
+    catalog.snapshot.invalidate(kind, key)
+    if kind is None:
+        search_index.index.refresher.expire()
+        suggest.index.refresher.expire()
+
+# Set by prefork.py to pass /cache/invalidate on to the other workers
+broadcast_invalidation = None
+
+@app.route('/export/<name>')
+def export_table(name):
+    """Stream a whole table as NDJSON (default) or CSV via a server-side cursor.
+
+    Catalog tables are open to any logged-in user; preference tables only
+    to this host, like /cache/invalidate.
+    """
+    if name not in export.EXPORTS:
+        return jsonify({"error": f"unknown export {name}", "exports": sorted(export.EXPORTS)}), 404
+    local = request.remote_addr in ('127.0.0.1', '::1')
+    if name in export.USER_EXPORTS and not local:
+        return jsonify({"error": "forbidden"}), 403
+    if 'user_id' not in session and not local:
+        return jsonify({"error": "not logged in"}), 401
+
+    fmt = request.args.get('format', 'ndjson')
+    if fmt not in export.FORMATS:
+        return jsonify({"error": f"unknown format {fmt}"}), 400
+
+    return Response(export.export_chunks(export_engine, name, fmt), mimetype=export.FORMATS[fmt],
+                    headers={"Content-Disposition": f"attachment; filename={name}.{fmt}"})
+
+@app.route('/top-tracks/status')
+def top_tracks_status():
+    """Staleness of the materialized genre/artist top tracks"""
+    try:
+        return jsonify(top_tracks.status(g.conn))
+    except Exception as e:
+        print(f"Top tracks status error: {str(e)}")
+        return jsonify({"error": "Failed to read top track status"}), 500
+
+@app.route('/statements/stats')
+def statement_stats():
+    """Calls, prepares and sampled planning time per registered statement"""
+    return jsonify(statements.stats())
+
+def metric_gauges():
+    """Cache and index sizes sampled on each /metrics scrape"""
+    gauges = {"app_suggest_index_items": len(suggest.index)}
+    for key, value in search_index.index.stats().items():
+        gauges[f"app_search_index_{key}"] = value
+    gauges.update(statements.gauges())
+    routing = router.stats()
+    for target, count in routing["routed"].items():
+        gauges[f'app_db_routed_requests_total{{target="{target}"}}'] = count
+    for n, stats in enumerate(routing["replicas"]):
+        for key in ("checked_out", "connects", "checkouts", "connect_errors", "wait_seconds_total"):
+            if stats[key] is not None:
+                gauges[f'app_db_replica_pool_{key}{{replica="{n}"}}'] = stats[key]
+    for key, value in catalog.snapshot.stats().items():
+        gauges[f"app_catalog_{key}"] = int(value)
+    for key, value in item_cf.index.stats().items():
+        gauges[f"app_item_cf_{key}"] = value
+    for key, value in rec_store.rebuilds.stats().items():
+        gauges[f"app_rec_rebuild_{key}"] = value
+    for name, stats in entity_cache.stats().items():
+        for key in ("size", "hits", "misses", "evictions"):
+            gauges[f'app_detail_cache_{key}{{cache="{name}"}}'] = stats[key]
+    return gauges
+
+# Per-route latency / query counters and the /metrics endpoint
+metrics.install(app, engine, extra_gauges=metric_gauges, replicas=replicas)
+
+# Route SQL is registered once with typed parameters and run as prepared
+# statements on each pooled connection (statements.py)
+USER_BY_EMAIL = statements.register("user_by_email", """
+    SELECT user_id FROM "User"
+    WHERE user_email = :email
+""", email="text")
+
+CREATE_USER = statements.register("create_user", """
+    INSERT INTO "User" (user_name, user_email, registration_date)
+    VALUES (:name, :email, CURRENT_DATE)
+    RETURNING user_id
+""", name="text", email="text")
+
 # Authentication routes
 @app.route('/', methods=['GET', 'POST'])
 def index():
@@ -52,18 +212,11 @@ def index():
         
         try:
             # Check if user exists
-            user = g.conn.execute(text("""
-                SELECT user_id FROM "User"
-                WHERE user_email = :email
-            """), {"email": email}).fetchone()
+            user = statements.execute(g.conn, USER_BY_EMAIL, {"email": email}).fetchone()
             
             if not user:
                 # Create new user
-                result = g.conn.execute(text("""
-                    INSERT INTO "User" (user_name, user_email, registration_date)
-                    VALUES (:name, :email, CURRENT_DATE)
-                    RETURNING user_id
-                """), {"name": name, "email": email})
+                result = statements.execute(g.conn, CREATE_USER, {"name": name, "email": email})
                 user_id = result.fetchone()[0]
                 g.conn.commit()
             else:
@@ -84,37 +237,119 @@ def logout():
     return redirect('/')
 
 # Search functionality
+SEARCH_FALLBACK_QUERY = statements.register("search_fallback", """
+    (SELECT track_id::TEXT AS id, track_name AS name, 'track' AS type
+     FROM Track WHERE track_name ILIKE :term)
+    UNION
+    (SELECT artist_id::TEXT AS id, artist_name AS name, 'artist' AS type
+     FROM Artist WHERE artist_name ILIKE :term)
+    UNION
+    (SELECT album_id::TEXT AS id, album_name AS name, 'album' AS type
+     FROM Album WHERE album_name ILIKE :term)
+    UNION
+    (SELECT genre_name::TEXT AS id, genre_name AS name, 'genre' AS type
+     FROM Genre WHERE genre_name ILIKE :term)
+    LIMIT 20
+""", term="text")
+
+SEARCH_PAGE_SIZE = 20
+TRACK_PAGE_SIZE = 10
+MAX_PAGE_SIZE = 100
+
+def page_size(default):
+    """?limit= for the JSON listings, clamped to 1..MAX_PAGE_SIZE"""
+    try:
+        return min(max(int(request.args.get('limit', default)), 1), MAX_PAGE_SIZE)
+    except ValueError:
+        return default
+
+def search_page(search_term, token, limit):
+    """(results, next token) for one page of search results"""
+    after = pagination.decode_cursor(token, 5)
+    try:
+        # Served from the in-memory n-gram index; refreshed from the
+        # catalog tables every few minutes
+        search_index.index.ensure_fresh(g.conn)
+        results, next_key = search_index.index.page(search_term, limit, after)
+        return results, pagination.encode_cursor(*next_key) if next_key else None
+    except Exception as e:
+        print(f"Search index error: {str(e)}")
+        if after:
+            return [], None
+        try:
+            return statements.execute(g.conn, SEARCH_FALLBACK_QUERY,
+                                      {"term": f"%{search_term}%"}).fetchall(), None
+        except Exception as e:
+            print(f"Search error: {str(e)}")
+            return [], None
+
 @app.route('/search', methods=['GET'])
 def search():
     if 'user_id' not in session:
         return redirect('/')
 
     search_term = request.args.get('q', '')
-    results = []
+    try:
+        results, next_cursor = search_page(search_term, request.args.get('after'), SEARCH_PAGE_SIZE)
+    except pagination.InvalidCursor:
+        return render_template("error.html", message="Invalid page link"), 400
+
+    return render_template("search.html", results=results, search_term=search_term,
+                           next_cursor=next_cursor)
+
+@app.route('/api/search')
+def search_json():
+    """One page of search results; pass "next" back as ?after= for the following page"""
+    if 'user_id' not in session:
+        return jsonify({"error": "not logged in"}), 401
 
     try:
-        query = text("""
-            (SELECT track_id::TEXT AS id, track_name AS name, 'track' AS type
-             FROM Track WHERE track_name ILIKE :term)
-            UNION
-            (SELECT artist_id::TEXT AS id, artist_name AS name, 'artist' AS type
-             FROM Artist WHERE artist_name ILIKE :term)
-            UNION
-            (SELECT album_id::TEXT AS id, album_name AS name, 'album' AS type
-             FROM Album WHERE album_name ILIKE :term)
-            UNION
-            (SELECT genre_name::TEXT AS id, genre_name AS name, 'genre' AS type
-             FROM Genre WHERE genre_name ILIKE :term)
-            LIMIT 20
-        """)
-        results = g.conn.execute(query, {"term": f"%{search_term}%"}).fetchall()
+        results, next_cursor = search_page(request.args.get('q', ''), request.args.get('after'),
+                                           page_size(SEARCH_PAGE_SIZE))
+    except pagination.InvalidCursor as e:
+        return jsonify({"error": str(e)}), 400
 
-    except Exception as e:
-        print(f"Search error: {str(e)}")
+    return jsonify({"results": [{"id": r.id, "name": r.name, "type": r.type} for r in results],
+                    "next": next_cursor})
+
+SUGGEST_LIMIT = 8
 
-    return render_template("search.html", results=results, search_term=search_term)
+@app.route('/search/suggest')
+def search_suggest():
+    """Typeahead: the most popular names starting with ?q=, from memory"""
+    if 'user_id' not in session:
+        return jsonify({"error": "not logged in"}), 401
+
+    try:
+        # Loads only in a process that has not preloaded; a stale index
+        # keeps answering while it is rebuilt in the background
+        suggest.index.ensure_fresh(g.conn)
+    except Exception as e:
+        print(f"Suggest index error: {str(e)}")
+    term = request.args.get('q', '')
+    suggestions = suggest.index.suggest(term, page_size(SUGGEST_LIMIT))
+    response = jsonify({"query": term,
+                        "suggestions": [{"id": s.id, "name": s.name, "type": s.type}
+                                        for s in suggestions]})
+    # Browsers re-ask for the same prefix as the user types and deletes
+    response.cache_control.private = True
+    response.cache_control.max_age = 60
+    return response
 
 # Recommendation engine
+ALSO_LIKED_LIMIT = 10
+
+def also_liked(user_id, recommendations):
+    """Collaborative picks from the in-memory item-item model, skipping
+    tracks already in the stored recommendations"""
+    try:
+        item_cf.index.ensure_fresh(g.conn)
+        exclude = {rec["track_id"] for rec in recommendations}
+        return item_cf.index.recommend_for_user(user_id, ALSO_LIKED_LIMIT, exclude)
+    except Exception as e:
+        print(f"Item CF error: {str(e)}")
+        return []
+
 @app.route('/recommendations')
 def recommendations():
     """Generate personalized recommendations"""
@@ -122,110 +357,68 @@ def recommendations():
         return redirect('/')
 
     user_id = session['user_id']
-    recommendations = []
 
     try:
-        # Artist-based recommendations
-        artist_recs = g.conn.execute(text("""
-            SELECT 
-                t.track_id,
-                t.track_name,
-                a.artist_id,
-                a.artist_name AS recommendation_source,
-                'artist' AS recommendation_type
-            FROM Track t
-            JOIN ArtistTrack at ON t.track_id = at.track_id
-            JOIN Artist a ON at.artist_id = a.artist_id
-            WHERE a.artist_id IN (
-                SELECT artist_id FROM userartistpreference
-                WHERE user_id = :user_id
-            )
-            AND t.track_id NOT IN (
-                SELECT track_id FROM usertrackpreference
-                WHERE user_id = :user_id
-            )
-            LIMIT 5
-        """), {"user_id": user_id}).mappings().fetchall()
-
-        # Genre-based recommendations
-        genre_recs = g.conn.execute(text("""
-            SELECT 
-                t.track_id,
-                t.track_name,
-                t.genre_name AS recommendation_source,
-                'genre' AS recommendation_type
-            FROM Track t
-            WHERE t.genre_name IN (
-                SELECT genre_name FROM usergenrepreference
-                WHERE user_id = :user_id
-            )
-            AND t.track_id NOT IN (
-                SELECT track_id FROM usertrackpreference
-                WHERE user_id = :user_id
-            )
-            LIMIT 5
-        """), {"user_id": user_id}).mappings().fetchall()
-
-        # Album-based recommendations
-        album_recs = g.conn.execute(text("""
-            SELECT 
-                t.track_id,
-                t.track_name,
-                a.album_name,
-                utp.source_track_name
-            FROM (
-                -- 获取用户收藏曲目对应的专辑ID和曲目名称
-                SELECT DISTINCT 
-                    Track.album_id, 
-                    Track.track_name AS source_track_name
-                FROM UserTrackPreference
-                JOIN Track USING (track_id)
-                WHERE user_id = :user_id
-            ) utp
-            JOIN Track t USING (album_id)
-            JOIN Album a USING (album_id)
-            WHERE t.track_id NOT IN (
-                SELECT track_id FROM UserTrackPreference
-                WHERE user_id = :user_id
-            )
-            ORDER BY t.track_popularity DESC
-            LIMIT 5
-        """), {"user_id": user_id}).mappings().fetchall()
-
-        # Process artist recommendations
-        for rec in artist_recs:
-            recommendations.append({
-                'track_id': rec['track_id'],
-                'track_name': rec['track_name'],
-                'reason': f"Similar artist: {rec['recommendation_source']}",
-                'type': rec['recommendation_type']
-            })
-
-        # Process genre recommendations
-        for rec in genre_recs:
-            recommendations.append({
-                'track_id': rec['track_id'],
-                'track_name': rec['track_name'],
-                'reason': f"Same genre: {rec['recommendation_source']}",
-                'type': rec['recommendation_type']
-            })
-
-        # Process album recommendations
-        for rec in album_recs:
-            recommendations.append({
-                'track_id': rec['track_id'],
-                'track_name': rec['track_name'],
-                'reason': f"From album '{rec['album_name']}' (you liked: {rec['source_track_name']})",
-                'type': 'album'
-            })
+        # Precomputed list; after a preference change it is computed with
+        # one combined query over the artist, genre and album sources while
+        # the stored copy is rebuilt in the background on the primary. Its
+        # markup is cached per stored version of the list.
+        version, recommendations = rec_store.get_versioned(g.conn, user_id, engine)
+        recommendations_html = page_cache.fragment(
+            "recommendations", user_id, version, "_recommendation_list.html",
+            lambda: {"recommendations": recommendations})
 
         return render_template("recommendation.html",
-                             recommendations=recommendations)
+                             recommendations_html=recommendations_html,
+                             also_liked=also_liked(user_id, recommendations))
 
     except Exception as e:
         print(f"Recommendation error: {str(e)}")
         return render_template("error.html", message="Failed to load recommendations"), 500
+
+@app.route('/api/recommendations')
+def recommendations_json():
+    """Same recommendations as /recommendations, as JSON"""
+    if 'user_id' not in session:
+        return jsonify({"error": "not logged in"}), 401
+
+    try:
+        recommendations = rec_store.get_recommendations(g.conn, session['user_id'], engine)
+        return jsonify({"recommendations": recommendations,
+                        "also_liked": also_liked(session['user_id'], recommendations)})
+
+    except Exception as e:
+        print(f"Recommendation error: {str(e)}")
+        return jsonify({"error": "Failed to load recommendations"}), 500
+
 # Preference management
+PREFERENCE_TABLES = {
+    "track": ("UserTrackPreference", "track_id", "text", "Track", "track_name"),
+    "artist": ("UserArtistPreference", "artist_id", "uuid", "Artist", "artist_name"),
+    "genre": ("UserGenrePreference", "genre_name", "text", "Genre", "genre_name"),
+}
+
+# Both return the canonical id (and the name for an add), so the handlers
+# can update the cached profile (profiles.py) without reading it back
+ADD_PREFERENCE = {pref_type: statements.register(f"add_{pref_type}_preference", f"""
+    WITH ins AS (
+        INSERT INTO {table} (user_id, {column})
+        VALUES (:user_id, :item_id)
+        ON CONFLICT DO NOTHING
+    )
+    SELECT {column}::TEXT AS id, {name} AS name
+    FROM {parent}
+    WHERE {column} = :item_id
+""", user_id="int", item_id=item_type)
+    for pref_type, (table, column, item_type, parent, name) in PREFERENCE_TABLES.items()}
+
+DELETE_PREFERENCE = {pref_type: statements.register(f"delete_{pref_type}_preference", f"""
+    DELETE FROM {table}
+    WHERE user_id = :user_id AND {column} = :item_id
+    RETURNING {column}::TEXT AS id
+""", user_id="int", item_id=item_type)
+    for pref_type, (table, column, item_type, _, _) in PREFERENCE_TABLES.items()}
+
 @app.route('/preferences', methods=['GET', 'POST', 'DELETE'])
 def preferences():
     if 'user_id' not in session:
@@ -242,26 +435,17 @@ def preferences():
 
         print(f"Processing DELETE: type={pref_type}, id={item_id}")
         try:
-            if pref_type == 'artist':
-                artist_uuid = uuid.UUID(item_id)
-                g.conn.execute(text("""
-                    DELETE FROM userartistpreference
-                    WHERE user_id = :user_id AND artist_id = :item_id
-                """), {"user_id": user_id, "item_id": artist_uuid})
-
-            elif pref_type == 'track':
-                g.conn.execute(text("""
-                    DELETE FROM usertrackpreference
-                    WHERE user_id = :user_id AND track_id = :item_id
-                """), {"user_id": user_id, "item_id": item_id})
-
-            elif pref_type == 'genre':
-                g.conn.execute(text("""
-                    DELETE FROM usergenrepreference
-                    WHERE user_id = :user_id AND genre_name = :item_id
-                """), {"user_id": user_id, "item_id": item_id})
+            removed = []
+            if pref_type in DELETE_PREFERENCE:
+                rows = statements.execute(g.conn, DELETE_PREFERENCE[pref_type],
+                                          {"user_id": user_id, "item_id": item_id})
+                removed = [(pref_type, row.id) for row in rows]
 
+            version = rec_store.mark_dirty(g.conn, user_id)
             g.conn.commit()
+            profiles.apply(user_id, version, removed=removed)
+            if pref_type == 'track':
+                item_cf.index.remove(user_id, item_id)
             print("Delete operation committed successfully")
             return redirect('/preferences')
 
@@ -276,26 +460,17 @@ def preferences():
         pref_type = request.form['type']
 
         try:
-            if pref_type == 'track':
-                g.conn.execute(text("""
-                    INSERT INTO usertrackpreference (user_id, track_id)
-                    VALUES (:user_id, :item_id)
-                    ON CONFLICT DO NOTHING
-                """), {"user_id": user_id, "item_id": item_id})
-            elif pref_type == 'artist':
-                g.conn.execute(text("""
-                    INSERT INTO userartistpreference (user_id, artist_id)
-                    VALUES (:user_id, :item_id)
-                    ON CONFLICT DO NOTHING
-                """), {"user_id": user_id, "item_id": item_id})
-            elif pref_type == 'genre':
-                g.conn.execute(text("""
-                    INSERT INTO usergenrepreference (user_id, genre_name)
-                    VALUES (:user_id, :item_id)
-                    ON CONFLICT DO NOTHING
-                """), {"user_id": user_id, "item_id": item_id})
+            added = []
+            if pref_type in ADD_PREFERENCE:
+                rows = statements.execute(g.conn, ADD_PREFERENCE[pref_type],
+                                          {"user_id": user_id, "item_id": item_id})
+                added = [(pref_type, row.id, row.name) for row in rows]
 
+            version = rec_store.mark_dirty(g.conn, user_id)
             g.conn.commit()
+            profiles.apply(user_id, version, added=added)
+            if pref_type == 'track':
+                item_cf.index.update(user_id, added=[(track_id, name) for _, track_id, name in added])
 
         except Exception as e:
             print(f"Preference error: {str(e)}")
@@ -303,26 +478,11 @@ def preferences():
 
     # get current preference
     try:
-        # Modified queries to get complete entity information
-        tracks = g.conn.execute(text("""
-                SELECT t.track_id, t.track_name 
-                FROM usertrackpreference utp
-                JOIN track t ON utp.track_id = t.track_id
-                WHERE utp.user_id = :user_id
-            """), {"user_id": user_id}).fetchall()
-
-        artists = g.conn.execute(text("""
-                SELECT a.artist_id, a.artist_name 
-                FROM userartistpreference uap
-                JOIN artist a ON uap.artist_id = a.artist_id
-                WHERE uap.user_id = :user_id
-            """), {"user_id": user_id}).fetchall()
-
-        genres = g.conn.execute(text("""
-            SELECT genre_name 
-            FROM usergenrepreference
-            WHERE user_id = :user_id
-        """), {"user_id": user_id}).fetchall()
+        # From the cached profile: one version check instead of three joins
+        profile = profiles.get(g.conn, user_id)
+        tracks = [{"track_id": k, "track_name": v} for k, v in profile.tracks.items()]
+        artists = [{"artist_id": k, "artist_name": v} for k, v in profile.artists.items()]
+        genres = [{"genre_name": k} for k in profile.genres]
 
     except Exception as e:
         print(f"Preference fetch error: {str(e)}")
@@ -333,39 +493,201 @@ def preferences():
                            artists=artists,
                            genres=genres)
 
+@app.route('/api/preferences/bulk', methods=['POST'])
+def preferences_bulk():
+    """Add and remove many preferences in one transaction.
+
+    Body: {"add": [{"type": "track", "id": "..."}, ...], "remove": [...]}
+    Returns one outcome per item, in request order (removals first).
+    """
+    if 'user_id' not in session:
+        return jsonify({"error": "not logged in"}), 401
+
+    body = request.get_json(silent=True)
+    if not isinstance(body, dict):
+        return jsonify({"error": "expected a JSON object"}), 400
+
+    try:
+        outcomes = bulk_prefs.apply(g.conn, session['user_id'],
+                                    add=body.get('add'), remove=body.get('remove'))
+    except bulk_prefs.BulkRequestError as e:
+        return jsonify({"error": str(e)}), 400
+    except Exception as e:
+        print(f"Bulk preference error: {str(e)}")
+        return jsonify({"error": "Failed to update preferences"}), 500
+
+    counts = {}
+    added, removed = [], []
+    for outcome in outcomes:
+        counts[outcome["status"]] = counts.get(outcome["status"], 0) + 1
+        if outcome["type"] == "track":
+            if outcome["status"] == "added":
+                added.append((outcome["id"], None))
+            elif outcome["status"] == "removed":
+                removed.append(outcome["id"])
+    # One model update for the whole request, so each affected row is
+    # recomputed once however many items came in
+    item_cf.index.update(session['user_id'], added=added, removed=removed)
+    return jsonify({"results": outcomes, "counts": counts})
+
 # Item detail pages
+SIMILAR_TRACKS_LIMIT = 20
+
+TRACK_DETAIL = statements.register("track_detail", """
+    SELECT 
+        t.track_id,
+        t.track_name,
+        t.track_popularity,
+        t.genre_name,
+        a.artist_id,
+        a.artist_name,
+        al.album_name,
+        concat_ws(':', t.xmin, a.xmin, al.xmin) AS row_version
+    FROM Track t
+    JOIN ArtistTrack at ON t.track_id = at.track_id
+    JOIN Artist a ON at.artist_id = a.artist_id
+    LEFT JOIN Album al ON t.album_id = al.album_id
+    WHERE t.track_id = :track_id
+    -- The first artist, as in catalog.py's snapshot
+    ORDER BY a.artist_id
+    LIMIT 1
+""", track_id="text")
+
 @app.route('/track/<track_id>')
 def track_detail(track_id):
     """Display detailed track information"""
+    def load():
+        # The preloaded snapshot (prefork.py) when it has the row
+        track = catalog.snapshot.track(track_id)
+        if track is None:
+            track = statements.execute(g.conn, TRACK_DETAIL, {"track_id": track_id}).mappings().first()
+
+        # Convert to dict with safe field access
+        return dict(track) if track else None
+
     try:
-        # Execute query with explicit safe column selection
-        track = g.conn.execute(text("""
-            SELECT 
-                t.track_id,
-                t.track_name,
-                t.track_popularity,
-                t.genre_name,
-                a.artist_id,
-                a.artist_name,
-                al.album_name
-            FROM Track t
-            JOIN ArtistTrack at ON t.track_id = at.track_id
-            JOIN Artist a ON at.artist_id = a.artist_id
-            LEFT JOIN Album al ON t.album_id = al.album_id
-            WHERE t.track_id = :track_id
-        """), {"track_id": track_id}).mappings().first()
-
-        if not track:
+        track_data = entity_cache.tracks.get_or_load(track_id, load)
+        if not track_data:
             return render_template("error.html", message="Track not found"), 404
 
-        # Convert to dict with safe field access
-        track_data = dict(track)
-        return render_template("track.html", track=track_data)
+        try:
+            item_cf.index.ensure_fresh(g.conn)
+            neighbors = item_cf.index.neighbors(track_id, ALSO_LIKED_LIMIT)
+        except Exception as e:
+            print(f"Item CF error: {str(e)}")
+            neighbors = []
+
+        # Everything the page shows is versioned without a query, so a
+        # current client copy costs neither SQL nor a render
+        similar_version = similar_tracks.index_version()
+        etag = page_cache.etag(
+            "track", track_id, track_data['row_version'],
+            [item['track_id'] for item in neighbors], similar_version)
+
+        def render():
+            try:
+                similar_html = page_cache.fragment(
+                    "similar", track_id, similar_version, "_similar_tracks.html",
+                    lambda: {"similar": similar_tracks.similar(g.conn, track_id, SIMILAR_TRACKS_LIMIT)})
+            except Exception as e:
+                print(f"Similar tracks error: {str(e)}")
+                similar_html = ""
+            return render_template("track.html", track=track_data, also_liked=neighbors,
+                                   similar_html=similar_html)
+
+        return page_cache.respond(etag, render)
 
     except Exception as e:
         print(f"Track error: {str(e)}")
         return render_template("error.html", message="Error loading track details"), 500
 
+# Track listings are ordered by (popularity, track_id), both descending, with
+# unknown popularity sorting last; later pages continue from the last row's
+# key with a row comparison instead of an OFFSET
+KEYSET_AFTER = "AND (COALESCE(t.track_popularity, -1), t.track_id) < (:after_pop, :after_id)"
+
+GENRE_TRACKS_QUERY = """
+    SELECT t.track_id, t.track_name, t.track_popularity
+    FROM Track t
+    WHERE t.genre_name = :genre_name {after}
+    ORDER BY COALESCE(t.track_popularity, -1) DESC, t.track_id DESC
+    LIMIT :limit
+"""
+KEYSET_TYPES = {"after_pop": "int", "after_id": "text"}
+
+GENRE_TRACKS = {after: statements.register("genre_tracks_after" if after else "genre_tracks",
+                                           GENRE_TRACKS_QUERY.format(after=KEYSET_AFTER if after else ""),
+                                           genre_name="text", limit="int",
+                                           **(KEYSET_TYPES if after else {}))
+                for after in (False, True)}
+
+ARTIST_TRACKS_QUERY = """
+    SELECT 
+        t.track_id AS id,
+        t.track_name AS name,
+        t.track_popularity AS popularity
+    FROM Track t
+    JOIN ArtistTrack at ON t.track_id = at.track_id
+    WHERE at.artist_id = :artist_id {after}
+    ORDER BY COALESCE(t.track_popularity, -1) DESC, t.track_id DESC
+    LIMIT :limit
+"""
+ARTIST_TRACKS = {after: statements.register("artist_tracks_after" if after else "artist_tracks",
+                                            ARTIST_TRACKS_QUERY.format(after=KEYSET_AFTER if after else ""),
+                                            artist_id="uuid", limit="int",
+                                            **(KEYSET_TYPES if after else {}))
+                 for after in (False, True)}
+
+def track_page(queries, top_query, params, id_column, pop_column, token, limit):
+    """(tracks, next token) for one page of a track listing.
+
+    The first page comes from the materialized top tracks (top_tracks.py)
+    when they hold enough rows; an empty result there (a key not yet
+    refreshed, or one waiting for a refresh) falls through to Track.
+    """
+    # The refresh writes, so it runs on the primary whatever serves this read
+    top_tracks.refresh_if_due(engine)
+    after = pagination.decode_cursor(token, 2)
+    params = dict(params, limit=limit + 1)
+    rows = []
+    if after:
+        params.update(after_pop=after[0], after_id=after[1])
+    elif limit + 1 <= top_tracks.TOP_N:
+        rows = statements.execute(g.conn, top_query, params).mappings().fetchall()
+    if not rows:
+        rows = statements.execute(g.conn, queries[after is not None], params).mappings().fetchall()
+
+    def key(track):
+        popularity = track[pop_column]
+        return (-1 if popularity is None else popularity), track[id_column]
+
+    return pagination.page_of([dict(row) for row in rows], limit, key)
+
+def genre_tracks(genre_name, token=None, limit=TRACK_PAGE_SIZE):
+    return track_page(GENRE_TRACKS, top_tracks.GENRE_TOP, {"genre_name": genre_name},
+                      'track_id', 'track_popularity', token, limit)
+
+def artist_tracks(artist_id, token=None, limit=TRACK_PAGE_SIZE):
+    return track_page(ARTIST_TRACKS, top_tracks.ARTIST_TOP, {"artist_id": artist_id},
+                      'id', 'popularity', token, limit)
+
+GENRE_DETAIL = statements.register("genre_detail", """
+    SELECT *, xmin::TEXT AS row_version FROM Genre
+    WHERE genre_name = :genre_name
+""", genre_name="text")
+
+ARTIST_DETAIL = statements.register("artist_detail", """
+    SELECT 
+        artist_id AS id,
+        artist_name AS name,
+        artist_nation AS nation,
+        artist_popularity_score AS popularity,
+        artist_tag AS tags,
+        xmin::TEXT AS row_version
+    FROM Artist
+    WHERE artist_id = :artist_id
+""", artist_id="uuid")
+
 # genre
 @app.route('/genre/<genre_name>')
 def genre_detail(genre_name):
@@ -373,69 +695,126 @@ def genre_detail(genre_name):
     if 'user_id' not in session:
         return redirect('/')
 
-    try:
-        genre = g.conn.execute(text("""
-            SELECT * FROM Genre
-            WHERE genre_name = :genre_name
-        """), {"genre_name": genre_name}).mappings().first()
+    def load():
+        genre = catalog.snapshot.genre(genre_name)
+        if genre is None:
+            genre = statements.execute(g.conn, GENRE_DETAIL, {"genre_name": genre_name}).mappings().first()
 
         if not genre:
-            return render_template("error.html", message="Genre not found"), 404
+            return None
 
-        top_tracks = g.conn.execute(text("""
-            SELECT track_id, track_name, track_popularity
-            FROM Track
-            WHERE genre_name = :genre_name
-            ORDER BY track_popularity DESC
-            LIMIT 10
-        """), {"genre_name": genre_name}).mappings().fetchall()
+        top_tracks, next_cursor = genre_tracks(genre_name)
 
-        return render_template("genre.html",
-                             genre=genre,
-                             tracks=top_tracks)
+        # Version of the whole first page: the genre row and its track list
+        genre = dict(genre)
+        version = page_cache.version_of(genre.pop('row_version'), top_tracks, next_cursor)
+        return genre, top_tracks, next_cursor, version
 
+    try:
+        cached = entity_cache.genres.get_or_load(genre_name, load)
+        if not cached:
+            return render_template("error.html", message="Genre not found"), 404
+
+        # Only the first page is cached and versioned; later pages are a
+        # single index range scan
+        genre, top_tracks, next_cursor, version = cached
+        if request.args.get('after'):
+            top_tracks, next_cursor = genre_tracks(genre_name, request.args['after'])
+            version = None
+
+        def render():
+            tracks_html = page_cache.fragment(
+                "genre_tracks", genre_name, version, "_genre_tracks.html",
+                lambda: {"genre_name": genre_name, "tracks": top_tracks, "next_cursor": next_cursor})
+            return render_template("genre.html", genre=genre, tracks_html=tracks_html)
+
+        if version is None:
+            return render()
+        return page_cache.respond(page_cache.etag("genre", genre_name, version), render)
+
+    except pagination.InvalidCursor:
+        return render_template("error.html", message="Invalid page link"), 400
     except Exception as e:
         print(f"Genre error: {str(e)}")
         return render_template("error.html", message="Error loading genre details"), 500
 
+@app.route('/api/genre/<genre_name>/tracks')
+def genre_tracks_json(genre_name):
+    """One page of a genre's tracks, most popular first"""
+    if 'user_id' not in session:
+        return jsonify({"error": "not logged in"}), 401
+
+    try:
+        tracks, next_cursor = genre_tracks(genre_name, request.args.get('after'),
+                                           page_size(TRACK_PAGE_SIZE))
+        return jsonify({"tracks": tracks, "next": next_cursor})
+
+    except pagination.InvalidCursor as e:
+        return jsonify({"error": str(e)}), 400
+    except Exception as e:
+        print(f"Genre error: {str(e)}")
+        return jsonify({"error": "Failed to load tracks"}), 500
+
 @app.route('/artist/<artist_id>')
 def artist_detail(artist_id):
     """Display detailed artist information"""
-    try:
-        # Get specific artist details with column aliases
-        artist = g.conn.execute(text("""
-            SELECT 
-                artist_id AS id,
-                artist_name AS name,
-                artist_nation AS nation,
-                artist_popularity_score AS popularity,
-                artist_tag AS tags
-            FROM Artist
-            WHERE artist_id = :artist_id
-        """), {"artist_id": artist_id}).mappings().first()
+    def load():
+        artist = catalog.snapshot.artist(artist_id)
+        if artist is None:
+            artist = statements.execute(g.conn, ARTIST_DETAIL, {"artist_id": artist_id}).mappings().first()
 
         if not artist:
-            return render_template("error.html", message="Artist not found"), 404
+            return None
+
+        tracks, next_cursor = artist_tracks(artist_id)
+
+        artist = dict(artist)
+        version = page_cache.version_of(artist.pop('row_version'), tracks, next_cursor)
+        return artist, tracks, next_cursor, version
 
-        # Get top tracks with explicit columns
-        tracks = g.conn.execute(text("""
-            SELECT 
-                t.track_id AS id,
-                t.track_name AS name,
-                t.track_popularity AS popularity
-            FROM Track t
-            JOIN ArtistTrack at ON t.track_id = at.track_id
-            WHERE at.artist_id = :artist_id
-            ORDER BY t.track_popularity DESC
-            LIMIT 10
-        """), {"artist_id": artist_id}).mappings().fetchall()
-
-        return render_template("artist.html",
-                               artist=artist,
-                               tracks=tracks)
+    try:
+        cached = entity_cache.artists.get_or_load(artist_id, load)
+        if not cached:
+            return render_template("error.html", message="Artist not found"), 404
 
+        artist, tracks, next_cursor, version = cached
+        if request.args.get('after'):
+            tracks, next_cursor = artist_tracks(artist_id, request.args['after'])
+            version = None
+
+        def render():
+            tracks_html = page_cache.fragment(
+                "artist_tracks", artist_id, version, "_artist_tracks.html",
+                lambda: {"artist_id": artist['id'], "tracks": tracks, "next_cursor": next_cursor})
+            return render_template("artist.html", artist=artist, tracks_html=tracks_html)
+
+        if version is None:
+            return render()
+        return page_cache.respond(page_cache.etag("artist", artist_id, version), render)
+
+    except pagination.InvalidCursor:
+        return render_template("error.html", message="Invalid page link"), 400
+    except ValueError:
+        # Not a UUID, so no such artist
+        return render_template("error.html", message="Artist not found"), 404
     except Exception as e:
         print(f"Artist error: {str(e)}")
         return render_template("error.html", message="Error loading artist details"), 500
+
+@app.route('/api/artist/<artist_id>/tracks')
+def artist_tracks_json(artist_id):
+    """One page of an artist's tracks, most popular first"""
+    try:
+        tracks, next_cursor = artist_tracks(artist_id, request.args.get('after'),
+                                            page_size(TRACK_PAGE_SIZE))
+        return jsonify({"tracks": tracks, "next": next_cursor})
+
+    except pagination.InvalidCursor as e:
+        return jsonify({"error": str(e)}), 400
+    except ValueError:
+        return jsonify({"error": "artist not found"}), 404
+    except Exception as e:
+        print(f"Artist error: {str(e)}")
+        return jsonify({"error": "Failed to load tracks"}), 500
 if __name__ == "__main__":
     app.run(host='0.0.0.0', port=8111, debug=True)
\ No newline at end of file
@@ -0,0 +1,412 @@
+"""
+"Similar tracks" from catalog features and an approximate nearest-neighbor
+index.
+
+Each track is embedded from its own columns and its artists' (ArtistTrack
++ Artist): every genre, album, artist, artist tag, artist nation and
+popularity bucket is a token with a random DIM-dimensional direction, and
+a track's vector is the weighted sum of its tokens' directions, L2
+normalized. Tracks sharing an artist or album therefore have a high dot
+product, and tracks sharing only a genre or nation a smaller one.
+
+Neighbors are found with an inverted-file (IVF) index: spherical k-means
+splits the vectors into about 16 * sqrt(n) lists of at least MIN_LIST_SIZE,
+stored contiguously in list order. A query scores the centroids, scans the
+closest lists and ranks their vectors by exact dot product. Query time
+follows the number of vectors scanned, so a query probes as many lists as
+hold about SCAN_BUDGET vectors, however large the catalog;
+SIMILAR_TRACKS_PROBES sets a fixed number of lists instead.
+
+The default favours latency over recall. On 1M synthetic tracks (16000
+lists, 66 probes, about 4k vectors scanned) recall@20 is 0.82 at a median
+of 0.8 ms. Recall 0.9 takes about four times the scan (some 17k vectors,
+2.3 ms): past a track's own artist and album, which sit in its own lists,
+its nearest neighbors are decided by chance overlaps of the random token
+directions and are spread over the whole index. Finer lists are the
+cheapest gain (4000 lists reach only 0.64 for the same scan); int8 and
+binary codes cost more per scanned vector in NumPy than they save.
+bench --sweep prints recall and latency side by side for other probe
+counts, and SIMILAR_TRACKS_SCAN=16384 buys the 0.9.
+
+The index is built offline into a directory of .npy files, which the
+server memory-maps, so loading is instant and the pages are shared between
+processes. Every build gets its own directory under builds/ and is
+published by atomically replacing the CURRENT manifest, so a server never
+maps files from two different builds. The index directory holds build
+output and is not part of the source tree's tracked files.
+
+    python similar_tracks.py build [--out DIR] [--url URL] [--synthetic N]
+    python similar_tracks.py bench [--index DIR] [--queries 200] [-k 20] [--probes P]
+                                   [--target-ms 1] [--sweep]
+
+bench compares the IVF results against an exact brute-force scan and
+reports recall@k next to the per-query latency, and exits non-zero when
+the median is over --target-ms; --synthetic N builds from a generated
+catalog of N tracks to measure at sizes the database does not have.
+"""
+import argparse
+import json
+import os
+import shutil
+import sys
+import time
+
+import numpy as np
+from scipy import sparse
+from sqlalchemy import create_engine, text
+
+import statements
+
+INDEX_DIR = os.environ.get("SIMILAR_TRACKS_INDEX",
+                           os.path.join(os.path.dirname(os.path.abspath(__file__)), "similar_index"))
+DIM = 64
+LISTS_PER_SQRT = 16
+MIN_LIST_SIZE = 16
+# Vectors a query scans; its probes are as many lists as hold about this many
+SCAN_BUDGET = int(os.environ.get("SIMILAR_TRACKS_SCAN", 4096))
+# Lists scanned per query, if set, instead of the scan budget
+PROBES = int(os.environ["SIMILAR_TRACKS_PROBES"]) if os.environ.get("SIMILAR_TRACKS_PROBES") else None
+# Builds kept on disk: the current one and the one before it, which a
+# server may still have mapped until its next request
+KEEP_BUILDS = 2
+
+ARTIST_WEIGHT = 3.0
+ALBUM_WEIGHT = 2.0
+GENRE_WEIGHT = 1.0
+TAG_WEIGHT = 1.0
+NATION_WEIGHT = 0.5
+POPULARITY_WEIGHT = 0.5
+
+FEATURES_QUERY = text("""
+    SELECT t.track_id, t.genre_name, t.album_id, t.track_popularity,
+           array_remove(array_agg(a.artist_id::TEXT), NULL) AS artists,
+           array_remove(array_agg(a.artist_tag), NULL) AS tags,
+           array_remove(array_agg(a.artist_nation), NULL) AS nations
+    FROM Track t
+    LEFT JOIN ArtistTrack at ON at.track_id = t.track_id
+    LEFT JOIN Artist a ON a.artist_id = at.artist_id
+    GROUP BY t.track_id
+""")
+
+NAMES_QUERY = statements.register("similar_track_names", """
+    SELECT track_id, track_name FROM Track
+    WHERE track_id = ANY(CAST(:ids AS VARCHAR[]))
+""", ids="text[]")
+
+
+def _tokens(genre, album, popularity, artists, tags, nations):
+    tokens = [(f"genre:{genre}", GENRE_WEIGHT)]
+    if album:
+        tokens.append((f"album:{album}", ALBUM_WEIGHT))
+    if popularity is not None:
+        tokens.append((f"pop:{popularity // 10}", POPULARITY_WEIGHT))
+    tokens += [(f"artist:{artist}", ARTIST_WEIGHT) for artist in set(artists)]
+    tokens += [(f"tag:{tag}", TAG_WEIGHT) for tag in set(tags)]
+    tokens += [(f"nation:{nation}", NATION_WEIGHT) for nation in set(nations)]
+    return tokens
+
+
+def embed(rows, dim=DIM, seed=0):
+    """(sorted track ids, float32 unit vectors) from feature rows"""
+    ids, token_ids, row_index, col_index, weights = [], {}, [], [], []
+    for track_id, genre, album, popularity, artists, tags, nations in rows:
+        row = len(ids)
+        ids.append(track_id)
+        for token, weight in _tokens(genre, album, popularity, artists, tags, nations):
+            row_index.append(row)
+            col_index.append(token_ids.setdefault(token, len(token_ids)))
+            weights.append(weight)
+
+    rng = np.random.default_rng(seed)
+    directions = rng.standard_normal((len(token_ids), dim)).astype(np.float32)
+    directions /= np.linalg.norm(directions, axis=1, keepdims=True)
+    features = sparse.csr_matrix((np.array(weights, dtype=np.float32), (row_index, col_index)),
+                                 shape=(len(ids), len(token_ids)))
+    vectors = np.asarray(features @ directions, dtype=np.float32)
+    vectors /= np.maximum(np.linalg.norm(vectors, axis=1, keepdims=True), 1e-12)
+
+    # Rows are kept in id order so a track is found by binary search on
+    # the memory-mapped ids instead of a dict built at load time
+    ids = np.array(ids)
+    order = np.argsort(ids, kind="stable")
+    return ids[order], vectors[order]
+
+
+def synthetic_rows(n, seed=0):
+    """A generated catalog shaped like the real one, for benchmarking at size"""
+    rng = np.random.default_rng(seed)
+    n_artists, n_albums = max(n // 10, 1), max(n // 8, 1)
+    album_artist = rng.integers(0, n_artists, n_albums)
+    artist_tag = rng.integers(0, 30, n_artists)
+    artist_nation = rng.integers(0, 40, n_artists)
+    albums = rng.integers(0, n_albums, n)
+    genres = rng.integers(0, 120, n)
+    popularity = rng.integers(0, 101, n)
+    features = rng.random(n) < 0.2
+    guests = rng.integers(0, n_artists, n)
+    for i in range(n):
+        artists = [int(album_artist[albums[i]])]
+        if features[i]:
+            artists.append(int(guests[i]))
+        yield (f"track{i:08d}", f"genre{genres[i]}", f"album{albums[i]}", int(popularity[i]),
+               [f"artist{a}" for a in artists],
+               [f"tag{artist_tag[a]}" for a in artists],
+               [f"nation{artist_nation[a]}" for a in artists])
+
+
+def _assign(vectors, centroids, chunk=65536):
+    """Nearest centroid (highest dot product) of every vector"""
+    assigned = np.empty(len(vectors), dtype=np.int32)
+    for i in range(0, len(vectors), chunk):
+        assigned[i:i + chunk] = np.argmax(vectors[i:i + chunk] @ centroids.T, axis=1)
+    return assigned
+
+
+def train(vectors, lists, iterations=10, sample=None, seed=0):
+    """Spherical k-means centroids, trained on a sample of the vectors"""
+    rng = np.random.default_rng(seed + 1)
+    sample = sample or min(len(vectors), 32 * lists)
+    points = vectors[rng.choice(len(vectors), size=sample, replace=False)]
+    centroids = points[rng.choice(len(points), size=lists, replace=False)].copy()
+    for _ in range(iterations):
+        assigned = _assign(points, centroids)
+        members = sparse.csr_matrix((np.ones(len(points), dtype=np.float32),
+                                     (assigned, np.arange(len(points)))), shape=(lists, len(points)))
+        sums = np.asarray(members @ points)
+        empty = ~sums.any(axis=1)
+        sums[empty] = points[rng.choice(len(points), size=int(empty.sum()), replace=False)]
+        centroids = sums / np.linalg.norm(sums, axis=1, keepdims=True)
+    return centroids.astype(np.float32)
+
+
+def _current_build(path):
+    """(manifest, build directory) of the published build; OSError if none"""
+    with open(os.path.join(path, "CURRENT")) as f:
+        manifest = json.load(f)
+    return manifest, os.path.join(path, "builds", manifest["build"])
+
+
+def _publish(out_dir, build_name, meta):
+    """Point CURRENT at a finished build in one rename, then drop old builds"""
+    manifest = os.path.join(out_dir, "CURRENT")
+    with open(manifest + ".tmp", "w") as f:
+        json.dump({**meta, "build": build_name}, f)
+    os.replace(manifest + ".tmp", manifest)
+
+    builds_dir = os.path.join(out_dir, "builds")
+    for name in sorted(os.listdir(builds_dir))[:-KEEP_BUILDS]:
+        if name != build_name:
+            # A process on Windows may still hold a map; it goes next time
+            shutil.rmtree(os.path.join(builds_dir, name), ignore_errors=True)
+
+
+def build(ids, vectors, out_dir, lists=None, seed=0):
+    """Write the index files for (ids, vectors) into a new build under
+    out_dir and publish it"""
+    n = len(ids)
+    if lists is None:
+        lists = int(np.clip(min(LISTS_PER_SQRT * np.sqrt(n), n / MIN_LIST_SIZE), 1, 65536))
+    lists = min(lists, n)
+    centroids = train(vectors, lists, seed=seed)
+    assigned = _assign(vectors, centroids)
+
+    # Vectors are stored grouped by list, so probing a list reads one
+    # contiguous slice
+    order = np.argsort(assigned, kind="stable")
+    offsets = np.zeros(lists + 1, dtype=np.int64)
+    np.cumsum(np.bincount(assigned, minlength=lists), out=offsets[1:])
+    positions = np.empty(n, dtype=np.int32)
+    positions[order] = np.arange(n, dtype=np.int32)
+
+    # Names sort in build order, which _publish relies on to find old builds
+    build_name = f"{time.strftime('%Y%m%dT%H%M%S')}-{os.getpid()}"
+    build_dir = os.path.join(out_dir, "builds", build_name)
+    os.makedirs(build_dir)
+    arrays = {"ids": ids, "positions": positions, "list_ids": ids[order],
+              "vectors": vectors[order], "centroids": centroids, "offsets": offsets}
+    for name, array in arrays.items():
+        np.save(os.path.join(build_dir, f"{name}.npy"), array)
+    meta = {"tracks": n, "dim": int(vectors.shape[1]), "lists": lists,
+            "built_at": time.strftime("%Y-%m-%dT%H:%M:%S")}
+    _publish(out_dir, build_name, meta)
+
+
+class SimilarityIndex:
+    """A memory-mapped IVF index: the build published in the directory
+    written by build()"""
+
+    def __init__(self, path, probes=PROBES):
+        self.path = path
+        # The manifest is read once; every file below comes from the build
+        # it names, however many builds are published meanwhile
+        self.meta, self.build_dir = _current_build(path)
+        # Plain ndarray views of the maps: slicing an np.memmap is several
+        # times slower
+        load = lambda name: np.asarray(np.load(os.path.join(self.build_dir, f"{name}.npy"), mmap_mode="r"))
+        self.ids = load("ids")
+        self.positions = load("positions")
+        self.list_ids = load("list_ids")
+        self.vectors = load("vectors")
+        # Small and read on every query, so kept in memory
+        self.centroids = np.array(load("centroids"))
+        self.offsets = np.array(load("offsets"))
+        if probes is None:
+            probes = max(1, round(SCAN_BUDGET * len(self.centroids) / max(len(self.ids), 1)))
+        self.probes = probes
+
+    def __len__(self):
+        return len(self.ids)
+
+    def position_of(self, track_id):
+        row = int(np.searchsorted(self.ids, track_id))
+        if row < len(self.ids) and self.ids[row] == track_id:
+            return int(self.positions[row])
+        return None
+
+    def search(self, vector, k=20, exclude=None):
+        """(positions, scores) of the k nearest stored vectors, best first"""
+        probes = min(self.probes, len(self.centroids))
+        lists = np.argpartition(-(self.centroids @ vector), probes - 1)[:probes]
+        starts, ends = self.offsets[lists], self.offsets[lists + 1]
+        scores = np.concatenate([self.vectors[start:end] for start, end in zip(starts, ends)]) @ vector
+        # Map offsets in the concatenated candidates back to stored positions
+        before = np.cumsum(ends - starts) - (ends - starts)
+        if len(scores) > k + 1:
+            best = np.argpartition(-scores, k)[:k + 1]
+        else:
+            best = np.arange(len(scores))
+        segment = np.searchsorted(before, best, "right") - 1
+        positions = starts[segment] + (best - before[segment])
+        scores = scores[best]
+        if exclude is not None:
+            keep = positions != exclude
+            positions, scores = positions[keep], scores[keep]
+        order = np.argsort(-scores, kind="stable")[:k]
+        return positions[order], scores[order]
+
+    def similar(self, track_id, k=20):
+        """[(track_id, score)] of the k most similar tracks"""
+        position = self.position_of(track_id)
+        if position is None:
+            return []
+        positions, scores = self.search(np.asarray(self.vectors[position]), k, exclude=position)
+        return [(str(self.list_ids[p]), float(s)) for p, s in zip(positions, scores)]
+
+
+_index = None
+_index_version = None
+
+
+def get_index(path=INDEX_DIR):
+    """The index at path, reloaded when it is rebuilt; None if not built yet"""
+    global _index, _index_version
+    try:
+        version = os.stat(os.path.join(path, "CURRENT")).st_mtime_ns
+        if _index is None or version != _index_version:
+            _index, _index_version = SimilarityIndex(path), version
+    except OSError:
+        return _index
+    return _index
+
+
+def index_version(path=INDEX_DIR):
+    """Build version (CURRENT mtime) of the index similar() serves, or None"""
+    return _index_version if get_index(path) is not None else None
+
+
+def similar(conn, track_id, limit=20):
+    """[{track_id, track_name, score}] for the track detail page"""
+    index = get_index()
+    if index is None:
+        return []
+    neighbors = index.similar(track_id, limit)
+    if not neighbors:
+        return []
+    names = dict(statements.execute(conn, NAMES_QUERY, {"ids": [n for n, _ in neighbors]}).fetchall())
+    return [{"track_id": n, "track_name": names[n], "score": round(score, 4)}
+            for n, score in neighbors if n in names]
+
+
+def benchmark(index, queries=200, k=20, seed=0):
+    """Recall@k of the IVF results against an exact scan, and latencies"""
+    rng = np.random.default_rng(seed)
+    sample = rng.choice(len(index), size=min(queries, len(index)), replace=False)
+    vectors = np.asarray(index.vectors)
+    # The two passes are timed separately so the exact scans do not evict
+    # the index pages the IVF queries read
+    found, ann_times = [], []
+    for position in sample:
+        started = time.perf_counter()
+        found.append(index.search(vectors[position], k, exclude=position)[0])
+        ann_times.append(time.perf_counter() - started)
+
+    recalls, exact_times = [], []
+    for position, positions in zip(sample, found):
+        started = time.perf_counter()
+        scores = vectors @ vectors[position]
+        scores[position] = -np.inf
+        exact = np.argpartition(-scores, k - 1)[:k]
+        exact_times.append(time.perf_counter() - started)
+
+        # Ties at the k-th score are common (identical feature sets), so any
+        # result scoring at least the exact k-th best counts as a hit
+        threshold = scores[exact].min() - 1e-6
+        recalls.append(min(np.count_nonzero(scores[positions] >= threshold), k) / k)
+
+    ms = lambda times, q: round(float(np.percentile(times, q)) * 1000, 3)
+    probes = min(index.probes, len(index.centroids))
+    return {"tracks": len(index), "lists": len(index.centroids), "probes": probes,
+            "scanned": round(probes * len(index) / len(index.centroids)),
+            "queries": len(sample), "k": k, "recall": round(float(np.mean(recalls)), 4),
+            "ann_ms_p50": ms(ann_times, 50), "ann_ms_p99": ms(ann_times, 99),
+            "exact_ms_p50": ms(exact_times, 50)}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Build or benchmark the similar-tracks index")
+    parser.add_argument("command", choices=["build", "bench"])
+    parser.add_argument("--out", "--index", dest="path", default=INDEX_DIR, help="index directory")
+    parser.add_argument("--url", help="database URL (defaults to the server's)")
+    parser.add_argument("--synthetic", type=int, metavar="N", help="build from N generated tracks")
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("-k", type=int, default=20)
+    parser.add_argument("--probes", type=int, default=PROBES,
+                        help=f"lists scanned per query (default: about {SCAN_BUDGET} vectors' worth)")
+    parser.add_argument("--target-ms", type=float, default=1.0, help="largest allowed median latency")
+    parser.add_argument("--sweep", action="store_true",
+                        help="also report recall and latency at 1/4 to 16 times the probes")
+    args = parser.parse_args()
+
+    if args.command == "build":
+        started = time.perf_counter()
+        if args.synthetic:
+            ids, vectors = embed(synthetic_rows(args.synthetic))
+        else:
+            if args.url:
+                engine = create_engine(args.url)
+            else:
+                from server import engine
+            with engine.connect() as conn:
+                ids, vectors = embed(conn.execute(FEATURES_QUERY,
+                                                  execution_options={"yield_per": 10000}).tuples())
+        embedded = time.perf_counter()
+        build(ids, vectors, args.path)
+        print(f"Embedded {len(ids)} tracks in {embedded - started:.1f}s, "
+              f"indexed in {time.perf_counter() - embedded:.1f}s -> {args.path}")
+    else:
+        if not os.path.exists(os.path.join(args.path, "CURRENT")):
+            parser.error(f"no index at {args.path}; run build first")
+        index = SimilarityIndex(args.path, probes=args.probes)
+        report = benchmark(index, args.queries, args.k)
+        print(report)
+        if args.sweep:
+            probes = index.probes
+            for factor in (0.25, 0.5, 2, 4, 8, 16):
+                index.probes = max(1, round(probes * factor))
+                swept = benchmark(index, args.queries, args.k)
+                print(f"probes {swept['probes']:6}  scanned {swept['scanned']:8}  "
+                      f"recall {swept['recall']:.4f}  p50 {swept['ann_ms_p50']:8.3f} ms  "
+                      f"p99 {swept['ann_ms_p99']:8.3f} ms")
+        if report["ann_ms_p50"] > args.target_ms:
+            print(f"Median {report['ann_ms_p50']} ms is over {args.target_ms} ms")
+            sys.exit(1)
@@ -0,0 +1,256 @@
+"""
+Registry of the routes' SQL statements, compiled once at import and run as
+server-side prepared statements.
+
+Each statement is declared once with the type of every bind parameter:
+
+    USER_BY_EMAIL = statements.register("user_by_email", '''
+        SELECT user_id FROM "User" WHERE user_email = :email
+    ''', email="text")
+
+Parameters are coerced to their declared type before they reach the
+database (a malformed UUID raises ValueError instead of failing in SQL).
+The first time a pooled connection runs a statement it sends
+PREPARE name (types) AS ...; afterwards the statement is run with
+EXECUTE name(...), so Postgres parses it once per connection and, after its
+first few executions, reuses a cached plan instead of planning every call.
+The set of prepared names lives in the connection record's info, which the
+pool clears when it replaces the connection.
+
+Postgres still plans a prepared statement afresh for each call while it
+estimates a custom plan to be cheaper than the cached generic one. For a
+large statement whose plan does not depend on the values (the combined
+recommendation query spends several times longer planning than running),
+register(..., generic=True) runs every EXECUTE with plan_cache_mode =
+force_generic_plan, set with SET LOCAL in the same round trip. The next
+other statement run on the connection puts the setting back the same way,
+so neither costs a round trip of its own.
+
+    DB_PREPARED_STATEMENTS  1/0, prepare per connection (default 1); turn
+                            off behind a transaction-mode pooler (pgbouncer)
+    STATEMENT_PLAN_SAMPLE   EXPLAIN every Nth execution of a statement to
+                            sample its planning time (default 100, 0 = off)
+
+Sampled planning times and call counts are exported on /metrics through
+gauges(). To compare plain and prepared planning directly:
+
+    python statements.py [--url URL] [--runs 20]
+"""
+import argparse
+import os
+import re
+import threading
+import uuid
+
+from sqlalchemy import ARRAY, Boolean, Integer, String, Uuid, bindparam, create_engine, text
+
+PREPARED = os.environ.get("DB_PREPARED_STATEMENTS", "1") != "0"
+PLAN_SAMPLE = int(os.environ.get("STATEMENT_PLAN_SAMPLE", 100))
+
+# declared type -> (SQLAlchemy bind type, coercion)
+TYPES = {
+    "int": (Integer(), int),
+    "text": (String(), str),
+    "bool": (Boolean(), bool),
+    "uuid": (Uuid(), lambda value: value if isinstance(value, uuid.UUID) else uuid.UUID(str(value))),
+    # any array of ids; CAST it in the SQL where a uuid[] is needed
+    "text[]": (ARRAY(String()), lambda value: [str(item) for item in value]),
+}
+
+# :name but not the second colon of a ::cast
+_PARAM = re.compile(r"(?<![:\w]):(\w+)")
+
+registry = {}
+
+
+class Statement:
+    def __init__(self, name, sql, /, generic=False, **types):
+        names = list(dict.fromkeys(_PARAM.findall(sql)))
+        if set(names) != set(types):
+            raise ValueError(f"{name}: parameters {names} do not match declared types {sorted(types)}")
+        for param_type in types.values():
+            if param_type not in TYPES:
+                raise ValueError(f"{name}: unknown parameter type {param_type}")
+        self.name = name
+        self.text = sql
+        self.types = types
+        self.generic = generic
+        self._binds = [bindparam(param, type_=TYPES[types[param]][0]) for param in names]
+        self.clause = text(sql).bindparams(*self._binds)
+
+        positional = _PARAM.sub(lambda m: f"${names.index(m.group(1)) + 1}", sql)
+        signature = f" ({', '.join(types[param] for param in names)})" if names else ""
+        self.prepare_sql = f"PREPARE {name}{signature} AS {positional}"
+        arguments = f"({', '.join(f'CAST(:{param} AS {types[param]})' for param in names)})" if names else ""
+        self.execute_sql = f"EXECUTE {name}{arguments}"
+        mode = "force_generic_plan" if generic else "DEFAULT"
+        self.execute_clause = text(self.execute_sql).bindparams(*self._binds)
+        self.mode_execute_clause = text(f"SET LOCAL plan_cache_mode = {mode}; "
+                                        + self.execute_sql).bindparams(*self._binds)
+
+        self._lock = threading.Lock()
+        self.calls = 0
+        self.prepared_calls = 0
+        self.prepares = 0
+        self.plan_samples = {"plain": [0, 0.0], "prepared": [0, 0.0]}    # mode -> [count, ms]
+
+    def bind(self, params):
+        """Parameters coerced to their declared types; raises ValueError"""
+        bound = {}
+        for param, param_type in self.types.items():
+            value = params[param]
+            bound[param] = None if value is None else TYPES[param_type][1](value)
+        return bound
+
+    def _count(self, prepared, prepares):
+        with self._lock:
+            self.calls += 1
+            self.prepared_calls += prepared
+            self.prepares += prepares
+            return self.calls
+
+    def record_plan(self, mode, ms):
+        with self._lock:
+            sample = self.plan_samples[mode]
+            sample[0] += 1
+            sample[1] += ms
+
+
+def register(name, sql, /, generic=False, **types):
+    """Declare a statement once, at import.
+
+    A module run as a script is imported a second time by the server, so
+    registering identical SQL again returns the existing statement.
+    """
+    existing = registry.get(name)
+    if existing is not None:
+        if existing.text != sql or existing.types != types or existing.generic != generic:
+            raise ValueError(f"statement {name} registered twice with different SQL")
+        return existing
+    statement = registry[name] = Statement(name, sql, generic=generic, **types)
+    return statement
+
+
+def _prepared_names(conn):
+    return conn.connection.info.setdefault("prepared_statements", set())
+
+
+def planning_ms(conn, statement, params, prepared):
+    """Planning time of one EXPLAIN (nothing is executed)"""
+    sql = statement.execute_sql if prepared else statement.text
+    explain = text("EXPLAIN (SUMMARY ON, FORMAT JSON) " + sql).bindparams(*statement._binds)
+    plan = conn.execute(explain.execution_options(plan_sample=True), params).scalar()
+    return plan[0]["Planning Time"]
+
+
+def execute(conn, statement, params=None, prepared=None):
+    """conn.execute() for a registered statement, prepared on first use"""
+    params = statement.bind(params or {})
+    prepared = PREPARED if prepared is None else prepared
+    prepares = 0
+    if prepared:
+        names = _prepared_names(conn)
+        if statement.name not in names:
+            conn.exec_driver_sql(statement.prepare_sql)
+            names.add(statement.name)
+            prepares = 1
+        # SET LOCAL lasts until the transaction it was sent in ends, so
+        # the forced mode is remembered with that transaction; getting it
+        # wrong costs a plan, never a result
+        info = conn.connection.info
+        transaction = conn.get_transaction()
+        generic = transaction is not None and info.get("generic_plan") is transaction
+        if generic != statement.generic:
+            result = conn.execute(statement.mode_execute_clause, params)
+            info["generic_plan"] = conn.get_transaction() if statement.generic else None
+        else:
+            result = conn.execute(statement.execute_clause, params)
+    else:
+        result = conn.execute(statement.clause, params)
+
+    calls = statement._count(prepared, prepares)
+    if PLAN_SAMPLE and calls % PLAN_SAMPLE == 1 % PLAN_SAMPLE:
+        try:
+            # A savepoint keeps a failed EXPLAIN from aborting the caller's
+            # transaction; the result above is already fetched by the driver
+            with conn.begin_nested():
+                mode = "prepared" if prepared else "plain"
+                statement.record_plan(mode, planning_ms(conn, statement, params, prepared))
+        except Exception as e:
+            print(f"Plan sample error ({statement.name}): {str(e)}")
+    return result
+
+
+def stats():
+    report = {}
+    for name, statement in sorted(registry.items()):
+        with statement._lock:
+            report[name] = {
+                "calls": statement.calls,
+                "prepared_calls": statement.prepared_calls,
+                "prepares": statement.prepares,
+                "plan_ms_avg": {mode: round(ms / count, 4) if count else None
+                                for mode, (count, ms) in statement.plan_samples.items()},
+            }
+    return report
+
+
+def gauges():
+    """Per-statement counters and sampled planning time, for /metrics"""
+    values = {}
+    for name, statement in sorted(registry.items()):
+        with statement._lock:
+            values[f'app_statement_calls_total{{statement="{name}"}}'] = statement.calls
+            values[f'app_statement_prepared_calls_total{{statement="{name}"}}'] = statement.prepared_calls
+            values[f'app_statement_prepares_total{{statement="{name}"}}'] = statement.prepares
+            for mode, (count, ms) in statement.plan_samples.items():
+                values[f'app_statement_plan_samples{{statement="{name}",mode="{mode}"}}'] = count
+                values[f'app_statement_plan_ms_sum{{statement="{name}",mode="{mode}"}}'] = round(ms, 4)
+    return values
+
+
+def compare(conn, samples, runs=20):
+    """Average planning ms per read statement, plain vs prepared.
+
+    `samples` holds a value for each parameter name; statements needing
+    others are skipped, as are writes (they are executed to warm the plan
+    cache). The prepared figure is taken after six executions, once
+    Postgres has had the chance to switch to its cached generic plan.
+    """
+    report = {}
+    for name, statement in sorted(registry.items()):
+        if not set(statement.types) <= set(samples):
+            continue
+        if not statement.text.lstrip().lstrip("(").upper().startswith(("SELECT", "WITH")):
+            continue
+        params = statement.bind({param: samples[param] for param in statement.types})
+        names = _prepared_names(conn)
+        if name not in names:
+            conn.exec_driver_sql(statement.prepare_sql)
+            names.add(name)
+        for _ in range(6):
+            conn.execute(statement.execute_clause, params).fetchall()
+        plain = sum(planning_ms(conn, statement, params, False) for _ in range(runs)) / runs
+        prepared = sum(planning_ms(conn, statement, params, True) for _ in range(runs)) / runs
+        report[name] = {"plain_ms": round(plain, 4), "prepared_ms": round(prepared, 4)}
+    conn.rollback()
+    return report
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compare planning time of plain and prepared statements")
+    parser.add_argument("--url", help="database URL (defaults to the server's)")
+    parser.add_argument("--runs", type=int, default=20, help="EXPLAINs per statement and mode")
+    args = parser.parse_args()
+
+    # Importing the server registers the route statements, in the
+    # imported statements module rather than this __main__ copy
+    import migrate
+    import server
+    import statements
+    engine = create_engine(args.url) if args.url else server.engine
+
+    with engine.connect() as conn:
+        samples = migrate.sample_params(conn)
+        for name, result in statements.compare(conn, samples, args.runs).items():
+            print(f"{name:<24} plain {result['plain_ms']:>8.3f} ms   prepared {result['prepared_ms']:>8.3f} ms")
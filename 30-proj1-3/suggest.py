@@ -0,0 +1,229 @@
+"""
+In-memory typeahead for /search/suggest: popularity-weighted prefix
+completion over Track, Artist, Album and Genre names.
+
+Names are folded (case, accents, punctuation) and kept in one sorted
+array, each under its full name and under the suffix starting at each of
+its first few words, so "beat" completes "The Beatles". A prefix is then a
+contiguous range of that array, found with two binary searches. Every
+entry carries its item's weight (track_popularity, artist_popularity_score,
+and for albums and genres their most popular track), and a max segment
+tree over the weights yields the k heaviest entries of a range best first
+by descending only into the subtrees that can still win, so the cost
+depends on k and not on how many names share the prefix.
+
+Suggestions never query the database. The index is loaded by the prefork
+master before forking (prefork.py), and once stale it is rebuilt on a
+background thread (refresh.py) started by the next suggestion. Only a
+process that has not preloaded loads it, on its first suggestion.
+
+    python suggest.py [--url URL] PREFIX...
+"""
+import argparse
+import bisect
+import heapq
+import re
+import threading
+import time
+import unicodedata
+from array import array
+from collections import namedtuple
+
+from sqlalchemy import create_engine, text
+
+import refresh
+
+# Seconds between re-reads of the catalog tables
+REFRESH_INTERVAL = 300
+
+# Word suffixes indexed per name, besides the name itself
+MAX_WORD_SUFFIXES = 4
+
+Suggestion = namedtuple("Suggestion", ["id", "name", "type"])
+
+SUGGEST_QUERY = text("""
+    SELECT track_id::TEXT AS id, track_name AS name, 'track' AS type,
+           COALESCE(track_popularity, 0) AS weight
+    FROM Track
+    UNION ALL
+    SELECT artist_id::TEXT, artist_name, 'artist', COALESCE(artist_popularity_score, 0)
+    FROM Artist
+    UNION ALL
+    SELECT al.album_id::TEXT, al.album_name, 'album', COALESCE(t.weight, 0)
+    FROM Album al
+    LEFT JOIN (SELECT album_id, MAX(track_popularity) AS weight
+               FROM Track GROUP BY album_id) t ON t.album_id = al.album_id
+    UNION ALL
+    SELECT g.genre_name::TEXT, g.genre_name, 'genre', COALESCE(t.weight, 0)
+    FROM Genre g
+    LEFT JOIN (SELECT genre_name, MAX(track_popularity) AS weight
+               FROM Track GROUP BY genre_name) t ON t.genre_name = g.genre_name
+""")
+
+_SEPARATORS = re.compile(r"[\W_]+")
+
+
+def fold(name):
+    """Lower case, no accents, words separated by single spaces"""
+    decomposed = unicodedata.normalize("NFKD", (name or "").casefold())
+    stripped = "".join(c for c in decomposed if not unicodedata.combining(c))
+    return _SEPARATORS.sub(" ", stripped).strip()
+
+
+def completion_keys(name):
+    """The folded name and the suffixes starting at its next few words"""
+    folded = fold(name)
+    if not folded:
+        return []
+    keys = [folded]
+    pos = 0
+    for _ in range(MAX_WORD_SUFFIXES):
+        pos = folded.find(" ", pos) + 1
+        if pos == 0:
+            break
+        keys.append(folded[pos:])
+    return keys
+
+
+class Snapshot:
+    """One immutable build of the index; replaced whole on refresh"""
+
+    def __init__(self, rows):
+        self.items = []         # item number -> (Suggestion, weight)
+        entries = []            # (key, item number)
+        for item_id, name, item_type, weight in rows:
+            number = len(self.items)
+            self.items.append((Suggestion(str(item_id), name, item_type), float(weight)))
+            entries.extend((key, number) for key in completion_keys(name))
+        entries.sort()
+
+        self.keys = [key for key, _ in entries]
+        self.entry_items = array("i", (number for _, number in entries))
+        # Implicit binary tree: leaves at size..size+n-1 hold entry weights,
+        # every inner node the maximum of its two children
+        self.size = 1
+        while self.size < len(entries):
+            self.size *= 2
+        self.tree = array("d", [-1.0]) * (2 * self.size)
+        for pos, (_, number) in enumerate(entries):
+            self.tree[self.size + pos] = self.items[number][1]
+        for node in range(self.size - 1, 0, -1):
+            self.tree[node] = max(self.tree[2 * node], self.tree[2 * node + 1])
+
+    def __len__(self):
+        return len(self.items)
+
+    def prefix_range(self, prefix):
+        """[lo, hi) of the entries starting with `prefix`"""
+        lo = bisect.bisect_left(self.keys, prefix)
+        hi = bisect.bisect_left(self.keys, prefix + "\U0010ffff", lo)
+        return lo, hi
+
+    def top(self, lo, hi, limit):
+        """Up to `limit` distinct items of entries [lo, hi), heaviest first.
+
+        Ties go to the alphabetically first entry. Only the nodes on the
+        paths to the returned entries (and their siblings) are visited.
+        """
+        heap = []
+        left, right = lo + self.size, hi + self.size
+        # The O(log n) subtrees exactly covering the range
+        while left < right:
+            if left & 1:
+                heap.append((-self.tree[left], left))
+                left += 1
+            if right & 1:
+                right -= 1
+                heap.append((-self.tree[right], right))
+            left //= 2
+            right //= 2
+        heapq.heapify(heap)
+
+        results, seen = [], set()
+        while heap and len(results) < limit:
+            _, node = heapq.heappop(heap)
+            if node < self.size:
+                heapq.heappush(heap, (-self.tree[2 * node], 2 * node))
+                heapq.heappush(heap, (-self.tree[2 * node + 1], 2 * node + 1))
+                continue
+            number = self.entry_items[node - self.size]
+            # A name can match under several of its keys
+            if number in seen:
+                continue
+            seen.add(number)
+            results.append(self.items[number][0])
+        return results
+
+
+class SuggestIndex:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._snapshot = Snapshot([])
+        self.loaded_at = None
+        self.refresher = refresh.Refresher("suggest", self)
+
+    def __len__(self):
+        return len(self._snapshot)
+
+    def load(self, conn):
+        snapshot = Snapshot(conn.execute(SUGGEST_QUERY).fetchall())
+        with self._lock:
+            self._snapshot = snapshot
+            self.loaded_at = time.monotonic()
+
+    def ensure_fresh(self, conn, max_age=REFRESH_INTERVAL):
+        """Load on first use; rebuild in the background once older than max_age"""
+        self.refresher.ensure_fresh(conn, max_age)
+
+    def suggest(self, term, limit=8):
+        """Up to `limit` Suggestions completing `term`, most popular first"""
+        prefix = fold(term)
+        if not prefix:
+            return []
+        # "love " should only complete the word "love"
+        if not term[-1].isalnum():
+            prefix += " "
+        snapshot = self._snapshot
+        lo, hi = snapshot.prefix_range(prefix)
+        return snapshot.top(lo, hi, limit)
+
+    def stats(self):
+        snapshot = self._snapshot
+        return {
+            "items": len(snapshot.items),
+            "entries": len(snapshot.keys),
+            "age_seconds": None if self.loaded_at is None
+            else round(time.monotonic() - self.loaded_at, 1),
+        }
+
+
+# Shared by every request in this process
+index = SuggestIndex()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Load the typeahead index and time some prefixes")
+    parser.add_argument("--url", help="database URL (defaults to the server's)")
+    parser.add_argument("--limit", type=int, default=8, help="suggestions per prefix")
+    parser.add_argument("prefixes", nargs="*", default=["a", "lo", "the", "beat"])
+    args = parser.parse_args()
+
+    if args.url:
+        engine = create_engine(args.url)
+    else:
+        from server import engine
+
+    started = time.perf_counter()
+    with engine.connect() as conn:
+        index.load(conn)
+    print(f"Loaded in {time.perf_counter() - started:.2f}s: {index.stats()}")
+
+    for prefix in args.prefixes:
+        runs = 1000
+        started = time.perf_counter()
+        for _ in range(runs):
+            suggestions = index.suggest(prefix, args.limit)
+        elapsed_us = (time.perf_counter() - started) / runs * 1e6
+        lo, hi = index._snapshot.prefix_range(fold(prefix))
+        print(f"{prefix!r:12} {hi - lo:7} matches  {elapsed_us:7.1f} us  "
+              + ", ".join(f"{s.name} ({s.type})" for s in suggestions))
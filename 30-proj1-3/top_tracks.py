@@ -0,0 +1,239 @@
+"""
+Materialized top-N tracks per genre and per artist.
+
+GenreTopTrack and ArtistTopTrack hold the first TOP_N tracks of each genre
+and artist in listing order, so the first page of /genre/<name> and
+/artist/<id> and the genre recommendations are primary key range reads
+instead of a sort over Track.
+
+Triggers on Track and ArtistTrack (migration 0005) record every genre and
+artist a change may affect in TopTrackDirty. refresh() claims those keys in
+chunks and rebuilds only them, each with one LATERAL ... LIMIT per key that
+walks the listing indexes:
+
+    python top_tracks.py refresh [--full] [--url URL]
+    python top_tracks.py status [--url URL]
+
+status reports, per scope, how many keys are waiting and how long the
+oldest has been waiting; the server serves the same as /top-tracks/status.
+
+Reads never serve a stale list: GENRE_TOP and ARTIST_TOP return nothing
+for a key that is waiting in TopTrackDirty, and the routes then fall back
+to the live query. The server also keeps the lists fresh by itself:
+refresh_if_due() starts an incremental refresh on a background thread at
+most every TOP_TRACKS_REFRESH_INTERVAL seconds (refresh.py), and
+/cache/invalidate starts one at once. Concurrent refreshers, one per
+server process, split the dirty keys with SKIP LOCKED.
+
+    TOP_TRACKS_REFRESH_INTERVAL     seconds between background refreshes (default 60)
+"""
+import argparse
+import os
+import time
+
+from sqlalchemy import create_engine, text
+
+import statements
+from refresh import Refresher
+
+TOP_N = int(os.environ.get("TOP_TRACKS_N", 50))
+REFRESH_CHUNK = int(os.environ.get("TOP_TRACKS_REFRESH_CHUNK", 1000))
+REFRESH_INTERVAL = float(os.environ.get("TOP_TRACKS_REFRESH_INTERVAL", 60))
+
+SCOPES = ("genre", "artist")
+TABLES = {"genre": "GenreTopTrack", "artist": "ArtistTopTrack"}
+
+GENRE_TOP = statements.register("genre_top", """
+    SELECT track_id, track_name, track_popularity
+    FROM GenreTopTrack
+    WHERE genre_name = :genre_name AND rank <= :limit
+      AND NOT EXISTS (SELECT 1 FROM TopTrackDirty
+                      WHERE scope = 'genre' AND key = :genre_name)
+    ORDER BY rank
+""", genre_name="text", limit="int")
+
+ARTIST_TOP = statements.register("artist_top", """
+    SELECT track_id AS id, track_name AS name, track_popularity AS popularity
+    FROM ArtistTopTrack
+    WHERE artist_id = :artist_id AND rank <= :limit
+      AND NOT EXISTS (SELECT 1 FROM TopTrackDirty
+                      WHERE scope = 'artist' AND key = CAST(:artist_id AS TEXT))
+    ORDER BY rank
+""", artist_id="uuid", limit="int")
+
+CLAIM_DIRTY = text("""
+    DELETE FROM TopTrackDirty
+    WHERE (scope, key) IN (
+        SELECT scope, key FROM TopTrackDirty
+        WHERE scope = :scope
+        ORDER BY key
+        LIMIT :limit
+        FOR UPDATE SKIP LOCKED
+    )
+    RETURNING key
+""")
+
+ALL_KEYS = {
+    "genre": text("SELECT genre_name FROM Genre ORDER BY genre_name"),
+    "artist": text("SELECT artist_id::TEXT FROM Artist ORDER BY artist_id"),
+}
+
+CLEAR = {
+    "genre": text("DELETE FROM GenreTopTrack WHERE genre_name = ANY(CAST(:keys AS VARCHAR[]))"),
+    "artist": text("DELETE FROM ArtistTopTrack WHERE artist_id = ANY(CAST(:keys AS UUID[]))"),
+}
+
+REBUILD = {
+    "genre": text("""
+        INSERT INTO GenreTopTrack (genre_name, rank, track_id, track_name, track_popularity)
+        SELECT k.genre_name, top.rank, top.track_id, top.track_name, top.track_popularity
+        FROM unnest(CAST(:keys AS VARCHAR[])) AS k(genre_name)
+        CROSS JOIN LATERAL (
+            SELECT t.track_id, t.track_name, t.track_popularity,
+                   row_number() OVER (ORDER BY COALESCE(t.track_popularity, -1) DESC,
+                                               t.track_id DESC) AS rank
+            FROM Track t
+            WHERE t.genre_name = k.genre_name
+            ORDER BY COALESCE(t.track_popularity, -1) DESC, t.track_id DESC
+            LIMIT :top_n
+        ) top
+    """),
+    "artist": text("""
+        INSERT INTO ArtistTopTrack (artist_id, rank, track_id, track_name, track_popularity)
+        SELECT k.artist_id, top.rank, top.track_id, top.track_name, top.track_popularity
+        FROM unnest(CAST(:keys AS UUID[])) AS k(artist_id)
+        JOIN Artist a ON a.artist_id = k.artist_id
+        CROSS JOIN LATERAL (
+            SELECT t.track_id, t.track_name, t.track_popularity,
+                   row_number() OVER (ORDER BY COALESCE(t.track_popularity, -1) DESC,
+                                               t.track_id DESC) AS rank
+            FROM ArtistTrack at
+            JOIN Track t ON t.track_id = at.track_id
+            WHERE at.artist_id = k.artist_id
+            ORDER BY COALESCE(t.track_popularity, -1) DESC, t.track_id DESC
+            LIMIT :top_n
+        ) top
+    """),
+}
+
+MARK_REFRESHED = text("""
+    INSERT INTO TopTrackState (scope, top_n, refreshed_at, full_refreshed_at)
+    VALUES (:scope, :top_n, NOW(), CASE WHEN :full THEN NOW() END)
+    ON CONFLICT (scope) DO UPDATE
+    SET top_n = EXCLUDED.top_n,
+        refreshed_at = EXCLUDED.refreshed_at,
+        full_refreshed_at = COALESCE(EXCLUDED.full_refreshed_at, TopTrackState.full_refreshed_at)
+""")
+
+STATUS_QUERY = text("""
+    SELECT sc.scope, s.top_n, s.refreshed_at, s.full_refreshed_at,
+           COUNT(d.key) AS pending,
+           MIN(d.marked_at) AS oldest_pending,
+           COALESCE(EXTRACT(EPOCH FROM NOW() - MIN(d.marked_at)), 0) AS stale_seconds
+    FROM unnest(CAST(:scopes AS VARCHAR[])) AS sc(scope)
+    LEFT JOIN TopTrackState s ON s.scope = sc.scope
+    LEFT JOIN TopTrackDirty d ON d.scope = sc.scope
+    GROUP BY sc.scope, s.top_n, s.refreshed_at, s.full_refreshed_at
+    ORDER BY sc.scope
+""")
+
+
+def rebuild_keys(conn, scope, keys):
+    """Replace the stored lists of `keys`; runs in the caller's transaction"""
+    if keys:
+        conn.execute(CLEAR[scope], {"keys": keys})
+        conn.execute(REBUILD[scope], {"keys": keys, "top_n": TOP_N})
+
+
+def refresh(conn, scopes=SCOPES, full=False):
+    """Rebuild dirty keys (or every key with full=True); returns {scope: keys rebuilt}.
+
+    Incremental refreshes claim up to REFRESH_CHUNK dirty keys per
+    transaction with SKIP LOCKED, so concurrent refreshers split the work
+    and a change that lands mid-refresh stays dirty for the next run.
+    """
+    rebuilt = {}
+    for scope in scopes:
+        count = 0
+        if full:
+            conn.execute(text("DELETE FROM TopTrackDirty WHERE scope = :scope"), {"scope": scope})
+            keys = list(conn.execute(ALL_KEYS[scope]).scalars())
+            conn.execute(text(f"DELETE FROM {TABLES[scope]}"))
+            for i in range(0, len(keys), REFRESH_CHUNK):
+                rebuild_keys(conn, scope, keys[i:i + REFRESH_CHUNK])
+            count = len(keys)
+            conn.execute(MARK_REFRESHED, {"scope": scope, "top_n": TOP_N, "full": True})
+            conn.commit()
+        else:
+            while True:
+                keys = list(conn.execute(CLAIM_DIRTY, {"scope": scope, "limit": REFRESH_CHUNK}).scalars())
+                if not keys:
+                    conn.rollback()
+                    break
+                rebuild_keys(conn, scope, keys)
+                conn.execute(MARK_REFRESHED, {"scope": scope, "top_n": TOP_N, "full": False})
+                conn.commit()
+                count += len(keys)
+        rebuilt[scope] = count
+    return rebuilt
+
+
+class _Background:
+    """Refresher target: one incremental refresh() per run"""
+
+    def __init__(self):
+        self.loaded_at = None
+
+    def load(self, conn):
+        refresh(conn)
+        self.loaded_at = time.monotonic()
+
+
+background = _Background()
+refresher = Refresher("top_tracks", background)
+
+
+def refresh_if_due(engine, max_age=REFRESH_INTERVAL):
+    """Start a background refresh on `engine` (the primary) when one is due"""
+    if background.loaded_at is None or time.monotonic() - background.loaded_at > max_age:
+        refresher.start(engine)
+
+
+def status(conn):
+    """Per-scope staleness: pending keys and how long the oldest has waited"""
+    rows = conn.execute(STATUS_QUERY, {"scopes": list(SCOPES)}).mappings().fetchall()
+    report = {}
+    for row in rows:
+        report[row["scope"]] = {
+            "top_n": row["top_n"],
+            "refreshed_at": row["refreshed_at"].isoformat() if row["refreshed_at"] else None,
+            "full_refreshed_at": row["full_refreshed_at"].isoformat() if row["full_refreshed_at"] else None,
+            "pending": row["pending"],
+            "oldest_pending": row["oldest_pending"].isoformat() if row["oldest_pending"] else None,
+            "stale_seconds": round(float(row["stale_seconds"]), 3),
+        }
+    return report
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Refresh or inspect the materialized top tracks")
+    parser.add_argument("command", nargs="?", default="refresh", choices=["refresh", "status"])
+    parser.add_argument("--full", action="store_true", help="rebuild every genre and artist")
+    parser.add_argument("--scope", choices=SCOPES, help="only this scope")
+    parser.add_argument("--url", help="database URL (defaults to the server's)")
+    args = parser.parse_args()
+
+    if args.url:
+        engine = create_engine(args.url)
+    else:
+        from server import engine
+
+    with engine.connect() as conn:
+        if args.command == "refresh":
+            scopes = (args.scope,) if args.scope else SCOPES
+            for scope, count in refresh(conn, scopes, full=args.full).items():
+                print(f"{scope:<7} rebuilt {count} lists")
+        else:
+            for scope, stats in status(conn).items():
+                print(f"{scope:<7} pending {stats['pending']:>6}  stale {stats['stale_seconds']:>10}s  "
+                      f"refreshed {stats['refreshed_at']}  full {stats['full_refreshed_at']}")
@@ -0,0 +1,240 @@
+"""
+Connection pool configuration and lazy per-request connections.
+
+Shared by every app in this repository: webapplication/ and 30-proj1-3/
+add the repository root to sys.path and import it from here.
+
+Pool settings come from the environment so deployments can size the pool
+against the database's connection limit without code changes:
+
+    DB_POOL_SIZE       connections kept open (default 5)
+    DB_MAX_OVERFLOW    extra connections allowed under burst (default 10)
+    DB_POOL_TIMEOUT    seconds to wait for a free connection (default 30)
+    DB_POOL_RECYCLE    reconnect connections older than this, seconds (default 1800)
+    DB_POOL_PRE_PING   test connections on checkout, 1/0 (default 1)
+    DB_STICKY_SECONDS  after a write, keep the session's reads on the
+                       primary this long (default 10; see Router)
+"""
+import itertools
+import os
+import threading
+import time
+
+from sqlalchemy import create_engine, event, exc
+
+
+def _env_int(name, default):
+    return int(os.environ.get(name, default))
+
+
+def create_pooled_engine(uri, read_only=False, **kwargs):
+    """create_engine() with an explicitly configured QueuePool.
+
+    read_only engines (replicas) open every connection with
+    default_transaction_read_only, so a write routed to one by mistake
+    fails instead of diverging from the primary.
+    """
+    options = {
+        "pool_size": _env_int("DB_POOL_SIZE", 5),
+        "max_overflow": _env_int("DB_MAX_OVERFLOW", 10),
+        "pool_timeout": _env_int("DB_POOL_TIMEOUT", 30),
+        "pool_recycle": _env_int("DB_POOL_RECYCLE", 1800),
+        "pool_pre_ping": os.environ.get("DB_POOL_PRE_PING", "1") != "0",
+    }
+    if read_only:
+        options["connect_args"] = {"options": "-c default_transaction_read_only=on"}
+    options.update(kwargs)
+    engine = create_engine(uri, **options)
+    PoolStats(engine)
+    return engine
+
+
+class PoolStats:
+    """Counters fed by pool events; one instance per engine (engine.pool_stats)"""
+
+    def __init__(self, engine):
+        self.engine = engine
+        self._lock = threading.Lock()
+        self.connects = 0           # new DBAPI connections opened
+        self.checkouts = 0
+        self.checkins = 0
+        self.timeouts = 0
+        self.connect_errors = 0     # checkouts that failed to reach the server
+        self.waits = 0              # engine.connect() calls timed
+        self.wait_seconds = 0.0     # total time spent in engine.connect()
+        self.max_wait_seconds = 0.0
+        self.max_overflow_seen = 0
+        engine.pool_stats = self
+
+        event.listen(engine, "connect", self._on_connect)
+        event.listen(engine, "checkout", self._on_checkout)
+        event.listen(engine, "checkin", self._on_checkin)
+
+    def _on_connect(self, dbapi_connection, connection_record):
+        with self._lock:
+            self.connects += 1
+
+    def _on_checkout(self, dbapi_connection, connection_record, connection_proxy):
+        overflow = self._pool_call("overflow")
+        with self._lock:
+            self.checkouts += 1
+            if overflow is not None and overflow > self.max_overflow_seen:
+                self.max_overflow_seen = overflow
+
+    def _on_checkin(self, dbapi_connection, connection_record):
+        with self._lock:
+            self.checkins += 1
+
+    def record_wait(self, seconds, timed_out=False):
+        with self._lock:
+            self.waits += 1
+            self.wait_seconds += seconds
+            self.max_wait_seconds = max(self.max_wait_seconds, seconds)
+            if timed_out:
+                self.timeouts += 1
+
+    def record_error(self):
+        with self._lock:
+            self.connect_errors += 1
+
+    def _pool_call(self, name):
+        # NullPool/StaticPool do not implement the QueuePool accessors
+        method = getattr(self.engine.pool, name, None)
+        try:
+            return method() if method else None
+        except NotImplementedError:
+            return None
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                "pool_size": self._pool_call("size"),
+                "checked_out": self._pool_call("checkedout"),
+                "checked_in": self._pool_call("checkedin"),
+                "overflow": self._pool_call("overflow"),
+                "max_overflow_seen": self.max_overflow_seen,
+                "connects": self.connects,
+                "checkouts": self.checkouts,
+                "checkins": self.checkins,
+                "timeouts": self.timeouts,
+                "connect_errors": self.connect_errors,
+                "wait_seconds_total": round(self.wait_seconds, 6),
+                "wait_seconds_max": round(self.max_wait_seconds, 6),
+                "wait_seconds_avg": round(self.wait_seconds / self.waits, 6) if self.waits else 0.0,
+            }
+
+
+class LazyConnection:
+    """Stand-in for g.conn that only checks a connection out on first use.
+
+    Routes keep calling g.conn.execute()/commit()/rollback() as before;
+    requests that never touch the database never take a pool slot. When
+    the engine cannot be reached the connection comes from `fallback`
+    instead, if given (a replica falling back to the primary).
+    """
+
+    def __init__(self, engine, fallback=None):
+        self._engine = engine
+        self._fallback = fallback
+        self._conn = None
+        self.wait_seconds = 0.0
+
+    @property
+    def engine(self):
+        return self._engine
+
+    @property
+    def connected(self):
+        return self._conn is not None
+
+    def _connect(self):
+        stats = getattr(self._engine, "pool_stats", None)
+        started = time.perf_counter()
+        try:
+            self._conn = self._engine.connect()
+        except exc.TimeoutError:
+            self.wait_seconds = time.perf_counter() - started
+            if stats:
+                stats.record_wait(self.wait_seconds, timed_out=True)
+            raise
+        except exc.DBAPIError as e:
+            if stats:
+                stats.record_error()
+            if self._fallback is None:
+                raise
+            print(f"Connection error, falling back: {str(e).splitlines()[0]}")
+            self._engine, self._fallback = self._fallback, None
+            return self._connect()
+        self.wait_seconds = time.perf_counter() - started
+        if stats:
+            stats.record_wait(self.wait_seconds)
+        return self._conn
+
+    def __getattr__(self, name):
+        conn = self._conn if self._conn is not None else self._connect()
+        return getattr(conn, name)
+
+    def close(self):
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+
+
+class Router:
+    """Picks the engine behind each request's g.conn.
+
+    Read-only requests go to the replicas, round robin; everything else
+    goes to the primary. A session that wrote is pinned to the primary for
+    sticky_seconds (read-your-writes), so its own changes are not hidden
+    by replication lag. The pin is a timestamp in the session, so it holds
+    whichever server process handles the next request. Without replicas
+    every request uses the primary and nothing is pinned.
+
+    To try it locally, stream a replica from a local primary and list it
+    in the server's DATABASE_REPLICA_URLS:
+
+        pg_basebackup -h localhost -D /tmp/replica -R -X stream
+        pg_ctl -D /tmp/replica -o "-p 5433" start
+        DATABASE_REPLICA_URLS=postgresql://localhost:5433/musicbench python server.py
+    """
+
+    PIN_KEY = "primary_until"
+
+    def __init__(self, primary, replicas=(), sticky_seconds=None):
+        self.primary = primary
+        self.replicas = list(replicas)
+        self.sticky_seconds = (_env_int("DB_STICKY_SECONDS", 10)
+                               if sticky_seconds is None else sticky_seconds)
+        self._next = itertools.count()
+        self._lock = threading.Lock()
+        self.routed = {"primary": 0, "replica": 0, "pinned": 0}
+
+    def _count(self, target):
+        with self._lock:
+            self.routed[target] += 1
+
+    def pinned(self, session):
+        return session.get(self.PIN_KEY, 0) > time.time()
+
+    def pin(self, session):
+        """Keep this session's reads on the primary for sticky_seconds"""
+        if self.replicas:
+            session[self.PIN_KEY] = time.time() + self.sticky_seconds
+
+    def connection(self, read_only, session):
+        """LazyConnection for one request"""
+        if not read_only or not self.replicas:
+            self._count("primary")
+            return LazyConnection(self.primary)
+        if self.pinned(session):
+            self._count("pinned")
+            return LazyConnection(self.primary)
+        self._count("replica")
+        replica = self.replicas[next(self._next) % len(self.replicas)]
+        return LazyConnection(replica, fallback=self.primary)
+
+    def stats(self):
+        with self._lock:
+            report = {"routed": dict(self.routed), "sticky_seconds": self.sticky_seconds}
+        report["replicas"] = [replica.pool_stats.snapshot() for replica in self.replicas]
+        return report
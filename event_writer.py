@@ -0,0 +1,236 @@
+"""
+Buffered group-commit writer for high-frequency inserts (feedback events).
+
+Request handlers call submit(), which only appends to a bounded in-memory
+queue. A background thread drains the queue and writes each batch with one
+multi-row INSERT and one commit, flushing when FEEDBACK_BATCH_SIZE events
+are waiting or FEEDBACK_FLUSH_INTERVAL seconds after the first one arrived,
+whichever comes first. Many clicks therefore share a single fsync.
+
+    FEEDBACK_BATCH_SIZE       events per INSERT/commit (default 500)
+    FEEDBACK_FLUSH_INTERVAL   max seconds an event waits (default 0.2)
+    FEEDBACK_QUEUE_SIZE       events buffered before backpressure (default 10000)
+    FEEDBACK_PUT_TIMEOUT      seconds submit() blocks on a full queue (default 1)
+    FEEDBACK_RETRY_MAX        longest pause between retries of a batch (default 5)
+
+When the queue is full submit() blocks for up to FEEDBACK_PUT_TIMEOUT and
+then raises WriterFull, so a stalled database slows and then rejects
+callers instead of growing memory. close() (also run at interpreter exit)
+writes everything still queued.
+
+A batch that fails because the database is unreachable (connection,
+pool or other operational errors, and SQL errors such as a missing
+table, which a migration fixes) is retried whole, with exponential
+backoff, until it is written; meanwhile new events wait in the queue,
+which bounds what an outage can hold. Only a data error (a constraint
+violation, a bad value) is retried row by row, on one connection with a
+savepoint per row, so the one bad row is dropped and the rest committed.
+A closing writer stops retrying when close()'s timeout runs out.
+
+Events are acknowledged before they are durable: anything queued when the
+process is killed with SIGKILL is lost.
+"""
+import atexit
+import os
+import queue
+import threading
+import time
+
+from sqlalchemy import exc
+
+_STOP = object()
+
+# Errors caused by the rows themselves; retrying the batch cannot help
+DATA_ERRORS = (exc.IntegrityError, exc.DataError)
+
+
+class WriterFull(Exception):
+    pass
+
+
+class EventWriter:
+    def __init__(self, engine, statement, batch_size=None, flush_interval=None,
+                 max_queue=None, put_timeout=None, name="events"):
+        self.engine = engine
+        self.statement = statement
+        self.name = name
+        self.batch_size = batch_size or int(os.environ.get("FEEDBACK_BATCH_SIZE", 500))
+        self.flush_interval = flush_interval or float(os.environ.get("FEEDBACK_FLUSH_INTERVAL", 0.2))
+        self.put_timeout = put_timeout if put_timeout is not None else \
+            float(os.environ.get("FEEDBACK_PUT_TIMEOUT", 1))
+        self.retry_max = float(os.environ.get("FEEDBACK_RETRY_MAX", 5))
+        self._queue = queue.Queue(max_queue or int(os.environ.get("FEEDBACK_QUEUE_SIZE", 10000)))
+        self._lock = threading.Lock()
+        self._thread = None
+        self._closed = False
+        self._give_up_at = None
+        self.submitted = 0
+        self.written = 0
+        self.failed = 0
+        self.rejected = 0
+        self.batches = 0
+        self.retries = 0
+        self.retrying = False
+        self.last_flush_seconds = 0.0
+
+    def start(self):
+        with self._lock:
+            if self._thread is None and not self._closed:
+                self._thread = threading.Thread(target=self._run, name=f"{self.name}-writer", daemon=True)
+                self._thread.start()
+                atexit.register(self.close)
+
+    def submit(self, params):
+        """Queue one row of bind parameters; raises WriterFull under backpressure"""
+        if self._closed:
+            raise WriterFull(f"{self.name} writer is closed")
+        if self._thread is None:
+            self.start()
+        try:
+            self._queue.put(params, timeout=self.put_timeout)
+        except queue.Full:
+            with self._lock:
+                self.rejected += 1
+            raise WriterFull(f"{self.name} queue full ({self._queue.maxsize} pending)")
+        with self._lock:
+            self.submitted += 1
+
+    def flush(self):
+        """Block until everything submitted so far has been written (or failed)"""
+        if self._thread is not None:
+            self._queue.join()
+
+    def close(self, timeout=30):
+        """Stop accepting events, write what is queued and stop the thread"""
+        with self._lock:
+            if self._closed:
+                return
+            self._closed = True
+            self._give_up_at = time.monotonic() + timeout
+            thread = self._thread
+        if thread is not None:
+            try:
+                # The queue can be full behind a stalled batch; the stop
+                # marker waits no longer than the batch does
+                self._queue.put(_STOP, timeout=timeout)
+            except queue.Full:
+                print(f"{self.name} writer closing, {self._queue.qsize()} events not written")
+                return
+            # A retrying batch gives up at the deadline; leave it time to
+            # count what it dropped
+            thread.join(timeout + 1)
+
+    def _collect(self):
+        """Next batch: wait for one event, then up to flush_interval for more"""
+        batch = [self._queue.get()]
+        if batch[0] is _STOP:
+            return batch
+        deadline = time.monotonic() + self.flush_interval
+        while len(batch) < self.batch_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                item = self._queue.get(timeout=remaining)
+            except queue.Empty:
+                break
+            batch.append(item)
+            if item is _STOP:
+                break
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._collect()
+            stop = batch[-1] is _STOP
+            rows = [item for item in batch if item is not _STOP]
+            try:
+                if rows:
+                    self._write(rows)
+            finally:
+                for _ in batch:
+                    self._queue.task_done()
+            if stop:
+                # close() waits for this thread, so drain anything that
+                # raced in after the stop marker
+                rest = []
+                while True:
+                    try:
+                        rest.append(self._queue.get_nowait())
+                    except queue.Empty:
+                        break
+                if rest:
+                    self._write(rest)
+                    for _ in rest:
+                        self._queue.task_done()
+                return
+
+    def _write(self, rows):
+        started = time.perf_counter()
+        delay = 0.1
+        while True:
+            try:
+                written, failed = self._write_once(rows)
+                break
+            except Exception as e:
+                if self._give_up_at is not None and time.monotonic() > self._give_up_at:
+                    print(f"{self.name} writer closing, dropped {len(rows)} rows: {str(e)}")
+                    written, failed = 0, len(rows)
+                    break
+                print(f"{self.name} batch write error ({len(rows)} rows), "
+                      f"retrying in {delay:.1f}s: {str(e)}")
+                with self._lock:
+                    self.retries += 1
+                    self.retrying = True
+                if self._give_up_at is not None:
+                    delay = max(min(delay, self._give_up_at - time.monotonic()), 0.01)
+                time.sleep(delay)
+                delay = min(delay * 2, self.retry_max)
+        with self._lock:
+            self.retrying = False
+            self.written += written
+            self.failed += failed
+            self.batches += 1
+            self.last_flush_seconds = round(time.perf_counter() - started, 6)
+
+    def _write_once(self, rows):
+        """(written, dropped) for one attempt; raises when the database is unavailable"""
+        with self.engine.connect() as conn:
+            try:
+                conn.execute(self.statement, rows)
+                conn.commit()
+                return len(rows), 0
+            except DATA_ERRORS as e:
+                print(f"{self.name} batch write error ({len(rows)} rows): {str(e)}")
+                conn.rollback()
+
+            # Find the bad rows: one savepoint each, one commit for the rest
+            written = failed = 0
+            for row in rows:
+                try:
+                    with conn.begin_nested():
+                        conn.execute(self.statement, row)
+                    written += 1
+                except DATA_ERRORS as e:
+                    failed += 1
+                    print(f"{self.name} write error, dropped {row}: {str(e)}")
+            conn.commit()
+            return written, failed
+
+    def stats(self):
+        with self._lock:
+            return {
+                "queued": self._queue.qsize(),
+                "max_queue": self._queue.maxsize,
+                "batch_size": self.batch_size,
+                "flush_interval": self.flush_interval,
+                "submitted": self.submitted,
+                "written": self.written,
+                "failed": self.failed,
+                "rejected": self.rejected,
+                "batches": self.batches,
+                "retries": self.retries,
+                "retrying": self.retrying,
+                "last_flush_seconds": self.last_flush_seconds,
+                "running": self._thread is not None and self._thread.is_alive(),
+            }
@@ -11,26 +11,49 @@ Read about it online.
 import os
   # accessible as a variable in index.html:
 from sqlalchemy import *
-from sqlalchemy.pool import NullPool
-from flask import Flask, request, render_template, g, redirect, Response
+from flask import Flask, request, render_template, g, redirect, Response, jsonify, session
+import db_pool
+import event_writer
 
 tmpl_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'templates')
 app = Flask(__name__, template_folder=tmpl_dir)
+app.secret_key = os.urandom(24)  # Required for session management
 
 DATABASE_USERNAME = "zf2342"
 DATABASE_PASSWRD = "399067"
 DATABASE_HOST = "34.148.223.31"
 DATABASEURI = f"postgresql://{DATABASE_USERNAME}:{DATABASE_PASSWRD}@{DATABASE_HOST}/proj1part2"
 
-engine = create_engine(DATABASEURI)
+# Comma separated read replica URLs; read-only routes are spread over them
+REPLICA_URIS = [uri.strip() for uri in os.environ.get("DATABASE_REPLICA_URLS", "").split(",") if uri.strip()]
+
+engine = db_pool.create_pooled_engine(DATABASEURI)
+replicas = [db_pool.create_pooled_engine(uri, read_only=True) for uri in REPLICA_URIS]
+router = db_pool.Router(engine, replicas)
+
+# GET routes that only read; everything else runs on the primary
+READ_ONLY_ENDPOINTS = {"index", "search", "artist_detail", "user_preferences"}
+
+# Like/skip clicks are queued and written in batches by a background thread
+# (a Core insert, so each batch is sent as multi-row INSERT ... VALUES)
+user_action = table("useraction", column("user_id"), column("track_id"), column("action_type"))
+feedback_writer = event_writer.EventWriter(engine, insert(user_action), name="feedback")
 
 @app.before_request
 def before_request():
-    try:
-        g.conn = engine.connect()
-    except:
-        print("Database connection error")
-        g.conn = None
+    # Connection is checked out of the pool on first use of g.conn; reads
+    # go to a replica unless this session wrote recently (db_pool.Router)
+    read_only = request.method in ('GET', 'HEAD') and request.endpoint in READ_ONLY_ENDPOINTS
+    g.conn = router.connection(read_only, session)
+
+@app.after_request
+def pin_writer(response):
+    # Read-your-writes: after a successful write the session reads from the
+    # primary until the replicas have had time to catch up. Every visitor
+    # is user 1 here, so there is no login to check
+    if request.method not in ('GET', 'HEAD') and response.status_code < 400:
+        router.pin(session)
+    return response
 
 @app.teardown_request
 def teardown_request(exception):
@@ -38,6 +61,12 @@ def teardown_request(exception):
         g.conn.close()
     except Exception as e:
         pass
+
+@app.route('/pool')
+def pool_status():
+    """Connection pool statistics, with the replicas' and request routing"""
+    return jsonify(dict(engine.pool_stats.snapshot(), routing=router.stats()))
+
 @app.route('/')
 def index():
     """Main page showing personalized recommendations"""
@@ -98,24 +127,28 @@ def handle_feedback():
         if action not in ['like', 'skip'] or not track_id:
             return redirect('/')
         
-        # Record user action
-        query = text("""
-            INSERT INTO UserAction (user_id, track_id, action_type)
-            VALUES (:user_id, :track_id, :action)
-        """)
-        g.conn.execute(query, {
+        # Queued for the next group commit; the response does not wait on it
+        feedback_writer.submit({
             "user_id": user_id,
             "track_id": track_id,
-            "action": action
+            "action_type": action
         })
-        g.conn.commit()
         
         return redirect('/')
     
+    except event_writer.WriterFull as e:
+        print(f"Feedback error: {str(e)}")
+        return render_template("error.html", message="Too busy to record feedback, try again"), 503
+
     except Exception as e:
         print(f"Feedback error: {str(e)}")
         return render_template("error.html", message="Failed to record feedback")
 
+@app.route('/feedback/stats')
+def feedback_stats():
+    """Feedback writer queue and batch counters"""
+    return jsonify(feedback_writer.stats())
+
 @app.route('/artist/<artist_id>')
 def artist_detail(artist_id):
     """Display artist details and related tracks"""
@@ -169,6 +202,8 @@ def user_preferences():
 
 if __name__ == "__main__":
     import click
+    import signal
+    import sys
 
     @click.command()
     @click.option('--debug', is_flag=True)
@@ -177,6 +212,8 @@ if __name__ == "__main__":
     @click.argument('PORT', default=8111, type=int)
     def run(debug, threaded, host, port):
         HOST, PORT = host, port
+        # Exit normally on SIGTERM so atexit flushes the feedback queue
+        signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
         print("Starting server...")
         app.run(host=HOST, port=PORT, debug=debug, threaded=threaded)
 
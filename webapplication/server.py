@@ -3,9 +3,14 @@ Columbia's COMS W4111.001 Introduction to Databases
 Music Recommendation System Web Server
 """
 import os
+import sys
+
+# db_pool.py is shared by the apps in this repository and lives at its root
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
 from sqlalchemy import *
-from sqlalchemy.pool import NullPool
-from flask import Flask, request, render_template, g, redirect, Response, session
+from flask import Flask, request, render_template, g, redirect, Response, session, jsonify
+import db_pool
 
 tmpl_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'templates')
 app = Flask(__name__, template_folder=tmpl_dir)
@@ -16,16 +21,30 @@ DATABASE_USERNAME = "zf2342"
 DATABASE_PASSWRD = "your_password"
 DATABASE_HOST = "34.148.223.31"
 DATABASEURI = f"postgresql://{DATABASE_USERNAME}:{DATABASE_PASSWRD}@{DATABASE_HOST}/proj1part2"
+# Comma separated read replica URLs; read-only routes are spread over them
+REPLICA_URIS = [uri.strip() for uri in os.environ.get("DATABASE_REPLICA_URLS", "").split(",") if uri.strip()]
+
+engine = db_pool.create_pooled_engine(DATABASEURI)
+replicas = [db_pool.create_pooled_engine(uri, read_only=True) for uri in REPLICA_URIS]
+router = db_pool.Router(engine, replicas)
 
-engine = create_engine(DATABASEURI)
+# GET routes that only read; everything else runs on the primary
+READ_ONLY_ENDPOINTS = {"search", "recommendations", "preferences", "track_detail", "artist_detail"}
 
 @app.before_request
 def before_request():
-    try:
-        g.conn = engine.connect()
-    except:
-        print("Database connection error")
-        g.conn = None
+    # Connection is checked out of the pool on first use of g.conn; reads
+    # go to a replica unless this session wrote recently (db_pool.Router)
+    read_only = request.method in ('GET', 'HEAD') and request.endpoint in READ_ONLY_ENDPOINTS
+    g.conn = router.connection(read_only, session)
+
+@app.after_request
+def pin_writer(response):
+    # Read-your-writes: after a successful write the session reads from the
+    # primary until the replicas have had time to catch up
+    if request.method not in ('GET', 'HEAD') and response.status_code < 400 and 'user_id' in session:
+        router.pin(session)
+    return response
 
 @app.teardown_request
 def teardown_request(exception):
@@ -34,6 +53,11 @@ def teardown_request(exception):
     except Exception as e:
         pass
 
+@app.route('/pool')
+def pool_status():
+    """Connection pool statistics, with the replicas' and request routing"""
+    return jsonify(dict(engine.pool_stats.snapshot(), routing=router.stats()))
+
 # Authentication routes
 @app.route('/', methods=['GET', 'POST'])
 def index():